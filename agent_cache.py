@@ -0,0 +1,84 @@
+import os
+import hashlib
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+from query_parser import normalize_query
+from tracing import record_cache
+
+# Agent answers are reused for AGENT_CACHE_TTL seconds when the same question is asked about the
+# same holdings while every price stays in the same AGENT_PRICE_BUCKET relative step (0.01 = 1%)
+AGENT_CACHE_TTL = float(os.getenv("AGENT_CACHE_TTL", "300"))
+AGENT_CACHE_SIZE = int(os.getenv("AGENT_CACHE_SIZE", "500"))
+AGENT_PRICE_BUCKET = float(os.getenv("AGENT_PRICE_BUCKET", "0.01"))
+
+# Bounds on one agent conversation: once it reaches AGENT_MAX_TURNS model calls or has used
+# AGENT_MAX_TOKENS tokens, the next call must answer without tools
+AGENT_MAX_TURNS = int(os.getenv("AGENT_MAX_TURNS", "5"))
+AGENT_MAX_TOKENS = int(os.getenv("AGENT_MAX_TOKENS", "20000"))
+
+
+def holdings_hash(wallet_tokens: List[Dict[str, Any]]) -> str:
+    """Hash of the wallet's symbols and balances, independent of token order"""
+    holdings = sorted((token["symbol"], token.get("address") or "", repr(token["balance"])) for token in wallet_tokens)
+    return hashlib.sha256(json.dumps(holdings).encode()).hexdigest()
+
+
+def price_bucket(prices: Dict[str, float], step: float = AGENT_PRICE_BUCKET) -> tuple:
+    """Maps each price to the index of its step-wide logarithmic bucket"""
+    return tuple(sorted(
+        (symbol, math.floor(math.log(price) / math.log1p(step)) if price and price > 0 else None)
+        for symbol, price in prices.items()
+    ))
+
+
+def agent_tool_key(function_name: str, function_args: Dict[str, Any]) -> tuple:
+    """Key under which a tool result is reused within one conversation"""
+    if function_name == "get_live_prices":
+        return function_name, tuple(sorted({symbol.upper() for symbol in function_args.get("symbols", [])}))
+    return function_name, json.dumps(function_args, sort_keys=True)
+
+
+class AgentResponseCache:
+    """LRU with TTL of (normalized message, holdings hash, price bucket) -> agent response and data"""
+
+    def __init__(self, max_size: int = AGENT_CACHE_SIZE, ttl: float = AGENT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lru = OrderedDict()  # key -> (response, stored_at)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def key(user_message: str, wallet_tokens: List[Dict[str, Any]], prices: Dict[str, float]) -> tuple:
+        return normalize_query(user_message), holdings_hash(wallet_tokens), price_bucket(prices)
+
+    def get(self, key: tuple) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            cached = self._lru.get(key)
+            if cached is None or time.time() - cached[1] > self.ttl:
+                self._lru.pop(key, None)
+                self._stats["misses"] += 1
+                record_cache("agent_response", 0, 1)
+                return None
+            self._stats["hits"] += 1
+            record_cache("agent_response", 1, 0)
+            self._lru.move_to_end(key)
+            return cached[0]
+
+    def put(self, key: tuple, response: Dict[str, Any]):
+        with self._lock:
+            self._lru[key] = (response, time.time())
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns a snapshot of the hit/miss counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._lru)
+        return stats
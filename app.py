@@ -1,16 +1,44 @@
 import os
 import json
-import requests
+import logging
 import time
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from typing import List, Dict, Any
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, g, render_template, request, jsonify, stream_with_context
 from flask_cors import CORS
 from web3 import Web3
 from dotenv import load_dotenv
 from openai import OpenAI
+from openai.types.chat import ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion_message_tool_call import Function
 
+# Load .env before importing our modules, which read their settings at import time
 load_dotenv()
 
+# Log level for the app and its modules; DEBUG also logs every request's upstream call tree
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+from multicall import read_balances, read_erc20_metadata, read_erc20_tokens
+from token_cache import TokenMetadataCache
+from price_cache import PriceCache
+from http_client import http_session, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+from coingecko import CoinGeckoIndex, TrendingFeed, fetch_simple_prices, search_coin_id
+from etherscan import WalletDiscoveryIndex, fetch_token_addresses
+from wallet_snapshot import WalletSnapshotCache, WALLET_SNAPSHOT_MAX_SIZE
+from query_parser import ParsedQueryCache, parse_allocation
+from holdings import from_raw
+from rebalance import compute_rebalance, compute_rebalance_batch, plan_swaps
+from quotes import QuoteCache, WETH_ADDRESS, quote_legs
+from refresher import BackgroundRefresher, SSE_KEEPALIVE_INTERVAL
+from agent_cache import AgentResponseCache, AGENT_MAX_TOKENS, AGENT_MAX_TURNS, agent_tool_key
+from tracing import (SERVER_TIMING_ENABLED, current_span, end_request, finish_request, metrics, record_cache,
+                     register_service, server_timing, span, start_request, submit)
+
 # Initialize OpenAI client
 openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
@@ -18,10 +46,69 @@ openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
 
+class TracedHTTPProvider(Web3.HTTPProvider):
+    """HTTPProvider that times each JSON-RPC call in an upstream span.
+
+    Every call is posted through the pooled http_session. HTTPProvider(session=...) would only
+    register the session for the constructing thread; request and worker threads would each get
+    a plain requests.Session without the pooling, retries and per-host limits.
+    """
+
+    def make_request(self, method, params):
+        with span(method, "infura"):
+            request_data = self.encode_rpc_request(method, params)
+            response = http_session.post(self.endpoint_uri, data=request_data, **self.get_request_kwargs())
+            response.raise_for_status()
+            return self.decode_rpc_response(response.content)
+
 # API Keys, URLs
 ETHERSCAN_API_KEY = os.getenv("ETHERSCAN_API_KEY")
 INFURA_URL = os.getenv("INFURA_URL")
-w3 = Web3(Web3.HTTPProvider(INFURA_URL))
+register_service("infura", INFURA_URL)
+w3 = Web3(TracedHTTPProvider(
+    INFURA_URL,
+    request_kwargs={"timeout": (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)}
+))
+
+# Persistent token metadata store (symbol/name/decimals never change for a deployed token)
+token_metadata_cache = TokenMetadataCache()
+logger.info("Loaded %s cached token metadata entries", token_metadata_cache.warm())
+
+# Local symbol/contract -> CoinGecko id index, loaded and refreshed in the background
+coingecko_index = CoinGeckoIndex()
+coingecko_index.start_background_refresh()
+
+# Trending coins with USD prices, fetched and refreshed in the background from startup
+trending_feed = TrendingFeed()
+trending_feed.start_background_refresh()
+
+# Per-wallet token contracts and last scanned block, so Etherscan scans are incremental
+wallet_discovery_index = WalletDiscoveryIndex()
+
+# Revalidating a cached wallet snapshot asks Etherscan for new transfers at most this often per wallet
+WALLET_TRANSFER_CHECK_INTERVAL = float(os.getenv("WALLET_TRANSFER_CHECK_INTERVAL", "30"))
+_transfer_checks = OrderedDict()  # wallet -> time of the last Etherscan transfer check
+_transfer_checks_lock = threading.Lock()
+
+# Normalized allocation query -> parsed allocation, for both rule-based and OpenAI parses
+parsed_query_cache = ParsedQueryCache()
+
+# getAmountsOut results per (path, amount bucket, block)
+quote_cache = QuoteCache()
+
+# Agent answers per (question, holdings, price bucket)
+agent_response_cache = AgentResponseCache()
+
+# Tool calls from one agent turn run concurrently, each bounded by AGENT_TOOL_TIMEOUT seconds
+AGENT_TOOL_TIMEOUT = float(os.getenv("AGENT_TOOL_TIMEOUT", "30"))
+agent_tool_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="agent-tool")
+
+# /api/detect_tokens_batch accepts up to BATCH_MAX_WALLETS addresses and reads them BATCH_CHUNK_SIZE
+# wallets at a time. Etherscan discovery for all batches shares BATCH_CONCURRENCY worker threads.
+BATCH_MAX_WALLETS = int(os.getenv("BATCH_MAX_WALLETS", "500"))
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "50"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+batch_discovery_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix="batch-discovery")
 
 # ABI for ERC20 tokens
 ERC20_ABI = [
@@ -48,9 +135,38 @@ ERC20_ABI = [
         "name": "symbol",
         "outputs": [{"name": "", "type": "string"}],
         "type": "function"
+    },
+    # name function
+    {
+        "constant": True,
+        "inputs": [],
+        "name": "name",
+        "outputs": [{"name": "", "type": "string"}],
+        "type": "function"
     }
 ]
 
+@app.before_request
+def _start_request_trace():
+    # Under asgi.py the ASGI app has already started the trace
+    if current_span() is None:
+        g.request_trace = start_request(request.method, request.url_rule.rule if request.url_rule else 'unmatched')
+
+@app.after_request
+def _finish_request_trace(response):
+    if 'request_trace' in g:
+        root = finish_request(g.request_trace[0], response.status_code)
+        if SERVER_TIMING_ENABLED:
+            response.headers['Server-Timing'] = server_timing(root)
+    return response
+
+@app.teardown_request
+def _end_request_trace(error=None):
+    # Runs after a streamed body is fully sent, so the logged trace includes its upstream calls
+    request_trace = g.pop('request_trace', None)
+    if request_trace:
+        end_request(request_trace)
+
 # Routes
 @app.route('/')
 def index():
@@ -70,136 +186,78 @@ def detect_tokens():
     except:
         return jsonify({'error': 'Invalid wallet address'}), 400
         
-    # Get ETH balance
-    eth_balance = w3.eth.get_balance(wallet_address)
-    eth_balance_in_eth = eth_balance / 10**18
-    
-    # Initialize tokens dictionary
-    detected_tokens = {}
-    
-    # Only add ETH if the balance is greater than 0
-    if eth_balance_in_eth > 0:
-        detected_tokens["ETH"] = {
-            "address": None,  # Native ETH
-            "decimals": 18,
-            "balance": eth_balance_in_eth,
-            "symbol": "ETH"
-        }
-        print(f"Added ETH with balance: {eth_balance_in_eth}")
-    
-    # Get token addresses from Etherscan
-    print(f"Fetching tokens for wallet {wallet_address}")
-    token_addresses_to_check = _fetch_token_addresses(wallet_address)
-    
-    # STEP 2: Now check the balance of each token address we found
-    print(f"Checking balances for {len(token_addresses_to_check)} tokens...")
-    for token_address in token_addresses_to_check:
-        try:
-            token_contract = w3.eth.contract(
-                address=token_address,
-                abi=ERC20_ABI
-            )
-            
-            # Get token info
-            symbol = token_contract.functions.symbol().call()
-            decimals = token_contract.functions.decimals().call()
-            raw_balance = token_contract.functions.balanceOf(wallet_address).call()
-            token_balance = raw_balance / (10 ** decimals)
-            
-            print(f"Token {symbol} at {token_address} has balance: {token_balance}")
-            
-            # Only add tokens with non-zero balance
-            if token_balance > 0:
-                detected_tokens[symbol] = {
-                    "address": token_address,
-                    "decimals": decimals,
-                    "balance": token_balance,
-                    "symbol": symbol,
-                    "coingecko_id": token_address.lower()
-                }
-                print(f"Added token {symbol} with balance {token_balance}")
-        except Exception as e:
-            print(f"Error checking token {token_address}: {str(e)}")
-    
-    # As a fallback or supplement, also check token addresses provided by the frontend
-    if 'token_addresses' in data and isinstance(data['token_addresses'], list):
-        for token_address in data['token_addresses']:
-            # Skip if we already have this token
-            token_address = Web3.to_checksum_address(token_address)
-            token_address_lower = token_address.lower()
-            
-            # Check if we already have this token
-            already_added = False
-            for symbol, token in detected_tokens.items():
-                if token.get('address') and token['address'].lower() == token_address_lower:
-                    already_added = True
-                    break
-            
-            if already_added:
-                continue
-                
-            try:
-                token_contract = w3.eth.contract(
-                    address=token_address,
-                    abi=ERC20_ABI
-                )
-                
-                # Get token info
-                symbol = token_contract.functions.symbol().call()
-                name = None
-                try:
-                    name = token_contract.functions.name().call()
-                except:
-                    name = symbol  # Fallback to symbol if name isn't available
-                
-                decimals = token_contract.functions.decimals().call()
-                raw_balance = token_contract.functions.balanceOf(wallet_address).call()
-                token_balance = raw_balance / (10 ** decimals)
-                
-                # Only add tokens with non-zero balance
-                if token_balance > 0:
-                    detected_tokens[symbol] = {
-                        "address": token_address,
-                        "decimals": decimals,
-                        "balance": token_balance,
-                        "symbol": symbol,
-                        "coingecko_id": token_address_lower
-                    }
-            except Exception as e:
-                print(f"Error getting token data for {token_address}: {str(e)}")
+    # ETH balance and token balances (Etherscan tokens plus any provided by the frontend),
+    # all read at one block and served from the wallet snapshot cache unless a new block touched the wallet
+    logger.debug("Fetching tokens for wallet %s", wallet_address)
+    try:
+        snapshot = _get_wallet_snapshot(wallet_address, data.get('token_addresses'))
+    except Exception as e:
+        logger.error("Error reading wallet %s: %s", wallet_address, e)
+        return jsonify({'error': f'Could not read wallet balances: {str(e)}'}), 502
+    detected_tokens = _build_detected_tokens(snapshot["eth_balance"], snapshot["token_reads"])
     
     # Get live prices for all tokens using the same function that the AI agent uses
     token_symbols = list(detected_tokens.keys())
-    print(f"Getting live prices for {len(token_symbols)} tokens: {token_symbols}")
+    logger.debug("Getting live prices for %s tokens: %s", len(token_symbols), token_symbols)
     
     try:
         # Get accurate prices using the same function the AI agent uses
-        token_prices = get_live_prices(token_symbols)
-        print(f"Got prices: {token_prices}")
+        token_prices = get_live_prices(token_symbols, _token_contracts(detected_tokens))
+        logger.debug("Got prices: %s", token_prices)
+        
+        # Keep this wallet's prices warm in the background
+        background_refresher.touch(wallet_address, _price_keys(token_symbols, _token_contracts(detected_tokens)))
         
         # Return both tokens and their live prices
         return jsonify({
             'wallet': wallet_address,
+            'block_number': snapshot["block_number"],
             'tokens': detected_tokens,
             'prices': token_prices  # Add real prices to the response
         })
     except Exception as e:
-        print(f"Failed to get live prices: {str(e)}")
+        logger.error("Failed to get live prices: %s", e)
         # Fall back to just tokens if price fetch fails
         return jsonify({
             'wallet': wallet_address,
+            'block_number': snapshot["block_number"],
             'tokens': detected_tokens
         })
 
+@app.route('/api/detect_tokens_batch', methods=['POST'])
+def detect_tokens_batch():
+    """Detects tokens and prices for many wallets, streamed back as one NDJSON line per wallet.
+
+    Takes {"wallet_addresses": [...]} plus optional "token_addresses" checked in every wallet.
+    """
+    data = request.json or {}
+    wallet_addresses = data.get('wallet_addresses')
+
+    if not isinstance(wallet_addresses, list) or not wallet_addresses:
+        return jsonify({'error': 'No wallet addresses provided'}), 400
+    if len(wallet_addresses) > BATCH_MAX_WALLETS:
+        return jsonify({'error': f'Too many wallet addresses (at most {BATCH_MAX_WALLETS} per request)'}), 400
+
+    # Every wallet in the batch is read at the same block
+    try:
+        block_number = w3.eth.block_number
+    except Exception as e:
+        logger.error("Error getting block number for wallet batch: %s", e)
+        return jsonify({'error': f'Could not read the latest block: {str(e)}'}), 502
+    return Response(
+        stream_with_context(_stream_wallet_batch(wallet_addresses, data.get('token_addresses'), block_number)),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/calculate_rebalance', methods=['POST'])
 def calculate_rebalance():
     try:
         data = request.json
-        print(f"/api/calculate_rebalance received data: {data}")
         
         # Validate required fields with a single check
         required_fields = ['tokens', 'target_allocation']
-        missing = [field for field in required_fields if field not in data]
+        missing = [field for field in required_fields if field not in data] if data else []
         
         if not data or missing:
             return jsonify({'error': f'Missing required data: {", ".join(missing) if missing else "request body"}'}), 400
@@ -207,69 +265,64 @@ def calculate_rebalance():
         tokens = data['tokens']
         target_allocation = data['target_allocation']
         
-        print(f"Tokens: {tokens}")
-        print(f"Target allocation: {target_allocation}")
-        
         # Get token prices using our existing get_live_prices function
-        token_symbols = list(tokens.keys())
-        token_prices = get_live_prices(token_symbols)
-    
-        # Add fallback prices for any tokens that weren't found
-        for symbol in tokens:
-            if symbol not in token_prices:
-                token_prices[symbol] = 1.0  # Fallback price
+        token_symbols = _rebalance_symbols(tokens)
+        token_prices = get_live_prices(token_symbols, _token_contracts(tokens))
     
-        # Calculate total portfolio value
         try:
-            total_value = sum(tokens[token]['balance'] * token_prices[token] for token in tokens)
-            if total_value == 0:
-                return jsonify({'error': 'Total portfolio value is zero'}), 400
-        except Exception as e:
-            print(f"Failed to calculate total value: {str(e)}")
-            # Print the tokens and prices for debugging
-            for token in tokens:
-                print(f"Token: {token}, Balance: {tokens[token].get('balance')}, Price: {token_prices.get(token)}")
-            return jsonify({'error': f'Error calculating portfolio value: {str(e)}'}), 500
-    
-        # Calculate current allocation percentages
-        current_allocation = {
-            token: (tokens[token]['balance'] * token_prices[token]) / total_value * 100 if total_value != 0 else 0
-            for token in tokens
-        }
-    
-        # Generate rebalance actions
-        actions = []
-        for token in tokens:
-            if token in target_allocation:
-                diff = current_allocation[token] - target_allocation[token]
-                if abs(diff) > 0.0000001:  # Only suggest changes if difference is significant
-                    direction = "sell" if diff > 0 else "buy"
-                    amount_usd = abs(diff) * total_value / 100
-                    token_price = token_prices[token]
-                    token_amount = amount_usd / token_price
-                    print(f"{token} diff: {diff}, amount_usd: {amount_usd}, token_amount: {token_amount}")
-                    actions.append({
-                        'token': token,
-                        'action': direction,
-                        'amount': token_amount,
-                        'percentage_change': abs(diff)
-                    })
-    
-        response_data = {
-            'total_value': total_value,
-            'current_allocation': current_allocation,
-            'target_allocation': target_allocation,
-            'rebalance_actions': actions,
-            'token_prices': token_prices
-        }
+            response_data = _compute_rebalance(
+                tokens, target_allocation, token_prices, _get_gas_price(), **_rebalance_options(data)
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        print(f"Sending response: {response_data}")
         return jsonify(response_data)
         
     except Exception as e:
-        print(f"Unhandled exception in calculate_rebalance: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Unhandled exception in calculate_rebalance: %s", e)
+        return jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500
+
+@app.route('/api/calculate_rebalance_batch', methods=['POST'])
+def calculate_rebalance_batch():
+    """Rebalances many portfolios, or one portfolio against many candidate targets, in one pass.
+    
+    Body: {"portfolios": [{"tokens": ..., "target_allocation": ...}, ...]} or
+    {"tokens": ..., "target_allocations": [...]} for a what-if sweep.
+    """
+    try:
+        data = request.json or {}
+        
+        if 'portfolios' in data:
+            portfolios = [(portfolio['tokens'], portfolio['target_allocation']) for portfolio in data['portfolios']]
+        elif 'tokens' in data and 'target_allocations' in data:
+            portfolios = [(data['tokens'], target_allocation) for target_allocation in data['target_allocations']]
+        else:
+            return jsonify({'error': 'Missing required data: portfolios, or tokens and target_allocations'}), 400
+        
+        if not portfolios:
+            return jsonify({'results': []})
+        
+        try:
+            options = _rebalance_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # One price lookup for every symbol in the batch
+        coingecko_ids = {}
+        for tokens, _ in portfolios:
+            for symbol, token in tokens.items():
+                coingecko_ids.setdefault(symbol, token.get("coingecko_id"))
+        token_prices = get_live_prices(_rebalance_symbols(coingecko_ids), coingecko_ids)
+        
+        results = _compute_rebalance_batch(portfolios, token_prices, _get_gas_price(), **options)
+        return jsonify({'results': [
+            result if result is not None else {'error': 'Total portfolio value is zero'} for result in results
+        ]})
+    
+    except (KeyError, TypeError, AttributeError) as e:
+        return jsonify({'error': f'Invalid batch request: {str(e)}'}), 400
+    except Exception as e:
+        logger.exception("Unhandled exception in calculate_rebalance_batch: %s", e)
         return jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500
 
 @app.route('/api/parse_query', methods=['POST'])
@@ -280,89 +333,594 @@ def parse_query():
     if not user_query:
         return jsonify({'error': 'No query provided'}), 400
     
-    try:
-        # Use OpenAI to parse the query and extract target allocations
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",  # Using gpt-3.5-turbo for better compatibility
-            messages=[
-                {"role": "system", "content": "You are a financial assistant that extracts target portfolio allocations from user queries. Extract token symbols and their target percentage allocations. Return ONLY a valid JSON object with token symbols as keys and percentage values as numbers. Format: {\"TOKEN1\": 25, \"TOKEN2\": 75}. The response must be valid JSON with no additional text, markdown, or formatting."},
-                {"role": "user", "content": user_query}
-            ]
-        )
-        
-        # Extract the response content and parse it as JSON
-        content = response.choices[0].message.content.strip()
-        
-        # Clean the response in case it contains markdown or other formatting
-        if content.startswith('```json'):
-            content = content.split('```json')[1]
-        if content.endswith('```'):
-            content = content.split('```')[0]
-        content = content.strip()
-        
-        try:
-            target_allocation = json.loads(content)
-        
-            # Validate the response to ensure it contains percentages that sum to approximately 100%
-            total_percentage = sum(target_allocation.values())
-            if not (95 <= total_percentage <= 105):  # Allow for small rounding errors
-                # Normalize to 100%
-                target_allocation = {k: (v / total_percentage * 100) for k, v in target_allocation.items()}
-        except json.JSONDecodeError as json_error:
-            print(f"Error parsing JSON from OpenAI response: {json_error}")
-            print(f"Raw content: {content}")
-            raise Exception(f"Failed to parse JSON from AI response: {content}")
-        
+    # Symbols detected in the wallet; allocations parsed locally may only use these, and
+    # without any the query always goes to OpenAI
+    known_symbols = [symbol for symbol in data.get('symbols') or [] if isinstance(symbol, str)]
+    
+    cache_key = parsed_query_cache.key(user_query, known_symbols)
+    target_allocation = parsed_query_cache.get(cache_key)
+    if target_allocation is not None:
         return jsonify({
             'query': user_query,
-            'parsed_allocation': target_allocation
+            'parsed_allocation': target_allocation,
+            'parser': 'cache'
         })
     
+    # Common phrasings ("50% ETH 50% USDC", "60/40 ETH/USDC", "equal weight", "all in ETH")
+    # are parsed locally; only anything else goes to OpenAI
+    target_allocation = parse_allocation(user_query, known_symbols)
+    parser = 'rules'
+    
+    if target_allocation is None:
+        try:
+            target_allocation = _parse_query_with_openai(user_query)
+            parser = 'openai'
+        except Exception as e:
+            logger.error("Error parsing query with OpenAI: %s", e)
+            return jsonify({'error': f'Failed to parse query: {str(e)}'}), 500
+    
+    parsed_query_cache.put(cache_key, target_allocation)
+    return jsonify({
+        'query': user_query,
+        'parsed_allocation': target_allocation,
+        'parser': parser
+    })
+
+@app.route('/api/quote', methods=['POST'])
+def quote():
+    """Quotes swap legs with the router's getAmountsOut, batched into one multicall.
+    
+    Body: {"legs": [{"token_in": address or "ETH", "token_out": address or "ETH",
+    "amount_in": raw units}], "slippage_bps": 50}
+    """
+    data = request.json or {}
+    
+    try:
+        legs = [
+            (_quote_token(leg.get('token_in')), _quote_token(leg.get('token_out')), int(leg['amount_in']))
+            for leg in data.get('legs') or []
+        ]
+        slippage_bps = int(data.get('slippage_bps', 50))
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        return jsonify({'error': f'Invalid quote request: {str(e)}'}), 400
+    
+    if not legs:
+        return jsonify({'error': 'No legs provided'}), 400
+    if any(amount_in <= 0 for _, _, amount_in in legs) or not 0 <= slippage_bps <= 10000:
+        return jsonify({'error': 'amount_in must be positive and slippage_bps between 0 and 10000'}), 400
+    
+    try:
+        block_number = w3.eth.block_number
+        quotes = quote_legs(w3, legs, block_number, quote_cache, slippage_bps)
     except Exception as e:
-        print(f"Error parsing query with OpenAI: {str(e)}")
-        return jsonify({'error': f'Failed to parse query: {str(e)}'}), 500
+        logger.error("Error quoting swaps: %s", e)
+        return jsonify({'error': f'Failed to get quotes: {str(e)}'}), 500
+    
+    return jsonify({
+        'block_number': block_number,
+        'quotes': quotes
+    })
+
+@app.route('/api/subscribe', methods=['GET'])
+def subscribe():
+    """Streams a wallet's price and balance updates as Server-Sent Events"""
+    wallet_address = request.args.get('wallet_address')
+    
+    if not wallet_address:
+        return jsonify({'error': 'No wallet address provided'}), 400
+    
+    try:
+        wallet_address = Web3.to_checksum_address(wallet_address)
+    except:
+        return jsonify({'error': 'Invalid wallet address'}), 400
+    
+    events = queue.Queue()
+    
+    def publish(event, data):
+        events.put((event, data))
+    
+    def generate():
+        background_refresher.subscribe(wallet_address, publish)
+        try:
+            # Sends the response headers now rather than with the first update
+            yield ": subscribed\n\n"
+            while True:
+                try:
+                    event, data = events.get(timeout=SSE_KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    # Keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _sse_event(event, data)
+        finally:
+            background_refresher.unsubscribe(wallet_address, publish)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    """Returns hit/miss counters for the shared caches"""
+    return jsonify({
+        'price_cache': price_cache.stats(),
+        'wallet_snapshot_cache': wallet_snapshot_cache.stats(),
+        'parsed_query_cache': parsed_query_cache.stats(),
+        'quote_cache': quote_cache.stats(),
+        'agent_response_cache': agent_response_cache.stats(),
+        'background_refresher': background_refresher.stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Returns request, upstream call and cache counters in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # Helper functions
-def _fetch_token_addresses(wallet_address: str) -> list:
-    """Helper function to fetch token addresses from Etherscan"""
-    token_addresses = []
-    network = "api-sepolia"  # Correct API endpoint for Sepolia
+def _openai_chat(**kwargs):
+    """Helper function to create a chat completion inside an upstream span, noting token usage"""
+    with span("chat.completions", "openai", model=kwargs["model"]) as call:
+        response = openai_client.chat.completions.create(**kwargs)
+        if response.usage:
+            call.set(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+    return response
+
+def _openai_chat_stream(**kwargs):
+    """Helper function to stream a chat completion, timing the whole stream in one upstream span.
+    
+    The last chunk carries the token usage of the whole completion.
+    """
+    with span("chat.completions", "openai", model=kwargs["model"], stream=True) as call:
+        chunks = 0
+        for chunk in openai_client.chat.completions.create(
+            stream=True, extra_body={"stream_options": {"include_usage": True}}, **kwargs
+        ):
+            chunks += 1
+            if getattr(chunk, "usage", None):
+                call.set(total_tokens=_usage_tokens(chunk.usage))
+            yield chunk
+        call.set(chunks=chunks)
+
+def _parse_query_with_openai(user_query: str) -> dict:
+    """Helper function to extract target allocations from a free-form query with OpenAI"""
+    response = _openai_chat(
+        model="gpt-3.5-turbo",  # Using gpt-3.5-turbo for better compatibility
+        messages=[
+            {"role": "system", "content": "You are a financial assistant that extracts target portfolio allocations from user queries. Extract token symbols and their target percentage allocations. Return ONLY a valid JSON object with token symbols as keys and percentage values as numbers. Format: {\"TOKEN1\": 25, \"TOKEN2\": 75}. The response must be valid JSON with no additional text, markdown, or formatting."},
+            {"role": "user", "content": user_query}
+        ]
+    )
+    
+    # Extract the response content and parse it as JSON
+    content = response.choices[0].message.content.strip()
+    
+    # Clean the response in case it contains markdown or other formatting
+    if content.startswith('```json'):
+        content = content.split('```json')[1]
+    if content.endswith('```'):
+        content = content.split('```')[0]
+    content = content.strip()
     
     try:
-        # Method 1: Get token transactions
-        tokentx_url = f"https://{network}.etherscan.io/api?module=account&action=tokentx&address={wallet_address}&sort=desc&apikey={ETHERSCAN_API_KEY}"
-        response = requests.get(tokentx_url).json()
+        target_allocation = json.loads(content)
+    except json.JSONDecodeError as json_error:
+        logger.error("Error parsing JSON from OpenAI response: %s", json_error)
+        logger.debug("Raw content: %s", content)
+        raise Exception(f"Failed to parse JSON from AI response: {content}")
+    
+    # Validate the response to ensure it contains percentages that sum to approximately 100%
+    total_percentage = sum(target_allocation.values())
+    if not (95 <= total_percentage <= 105):  # Allow for small rounding errors
+        # Normalize to 100%
+        target_allocation = {k: (v / total_percentage * 100) for k, v in target_allocation.items()}
+    return target_allocation
+
+def _quote_token(token) -> str:
+    """Helper function to map a quote leg's token to a router path address (ETH trades as WETH)"""
+    if not token or str(token).upper() == "ETH":
+        return WETH_ADDRESS
+    return Web3.to_checksum_address(token)
+
+def _merge_token_addresses(token_addresses: list, extra_addresses) -> list:
+    """Helper function to append frontend-provided token addresses we don't already have"""
+    if not isinstance(extra_addresses, list):
+        return token_addresses
+    
+    known_addresses = set(token_addresses)
+    for token_address in extra_addresses:
+        try:
+            token_address = Web3.to_checksum_address(token_address)
+        except Exception as e:
+            logger.error("Error getting token data for %s: %s", token_address, e)
+            continue
         
-        if response.get('status') == '1' and 'result' in response:
-            token_txs = response['result']
-            print(f"Found {len(token_txs)} token transactions")
-            
-            # Extract unique token addresses from transactions
-            for tx in token_txs:
-                if 'contractAddress' in tx and tx['contractAddress']:
-                    token_address = Web3.to_checksum_address(tx['contractAddress'])
-                    if token_address not in token_addresses:
-                        token_addresses.append(token_address)
-        
-        # Method 2: Try the tokenlist API too
-        tokenlist_url = f"https://{network}.etherscan.io/api?module=account&action=tokenlist&address={wallet_address}&apikey={ETHERSCAN_API_KEY}"
-        tokenlist_response = requests.get(tokenlist_url).json()
-        
-        if tokenlist_response.get('status') == '1' and 'result' in tokenlist_response:
-            tokens_data = tokenlist_response['result']
-            
-            for token_data in tokens_data:
-                try:
-                    if 'contractAddress' in token_data and token_data['contractAddress']:
-                        token_address = Web3.to_checksum_address(token_data['contractAddress'])
-                        if token_address not in token_addresses:
-                            token_addresses.append(token_address)
-                except Exception as e:
-                    print(f"Error processing tokenlist data: {str(e)}")
+        # Skip if we already have this token
+        if token_address not in known_addresses:
+            known_addresses.add(token_address)
+            token_addresses.append(token_address)
+    return token_addresses
+
+def _build_detected_tokens(eth_balance: int, token_reads: dict) -> dict:
+    """Helper function to build the detect_tokens response from raw ETH and token reads.
+    
+    raw_balance is the exact uint256 balance as a decimal string; balance is for display only.
+    """
+    detected_tokens = {}
+    
+    # Only add ETH if the balance is greater than 0
+    if eth_balance > 0:
+        detected_tokens["ETH"] = {
+            "address": None,  # Native ETH
+            "decimals": 18,
+            "balance": from_raw(eth_balance, 18),
+            "raw_balance": str(eth_balance),
+            "symbol": "ETH"
+        }
+        logger.debug("Added ETH with balance: %s wei", eth_balance)
+    
+    for token_address, token_info in token_reads.items():
+        symbol = token_info["symbol"]
+        decimals = token_info["decimals"]
+        raw_balance = token_info["raw_balance"]
+        
+        # Only add tokens with non-zero balance
+        if raw_balance > 0:
+            detected_tokens[symbol] = {
+                "address": token_address,
+                "decimals": decimals,
+                "balance": from_raw(raw_balance, decimals),
+                "raw_balance": str(raw_balance),
+                "symbol": symbol,
+                "coingecko_id": token_address.lower()
+            }
+            logger.debug("Added token %s with raw balance %s", symbol, raw_balance)
+    return detected_tokens
+
+def _rebalance_options(data: dict) -> dict:
+    """Helper function to read the optional trade threshold and cost settings from a request.
+    
+    Raises ValueError naming the option when a value is not a number.
+    """
+    options = {}
+    for option in ('min_trade_usd', 'fee_rate', 'slippage'):
+        if data.get(option) is not None:
+            try:
+                options[option] = float(data[option])
+            except (TypeError, ValueError):
+                raise ValueError(f'{option} must be a number')
+    return options
+
+def _rebalance_symbols(symbols) -> list:
+    """Helper function to list the symbols to price for a rebalance, always including ETH.
+    
+    The swap plan pays for unmatched buys with ETH, so it needs an ETH price even when the wallet holds none.
+    """
+    symbols = list(symbols)
+    return symbols if "ETH" in symbols else symbols + ["ETH"]
+
+def _with_fallback_prices(symbols, token_prices: dict) -> dict:
+    """Helper function to add fallback prices for any tokens that weren't found"""
+    for symbol in symbols:
+        if symbol not in token_prices:
+            token_prices[symbol] = 1.0  # Fallback price
+    return token_prices
+
+def _compute_rebalance(tokens: dict, target_allocation: dict, token_prices: dict, gas_price_wei: int = None,
+                       **options) -> dict:
+    """Helper function to compute current allocation, rebalance actions and the swaps that execute them.
+    
+    Raises ValueError if the portfolio has no value.
+    """
+    response_data = compute_rebalance(tokens, target_allocation, _with_fallback_prices(tokens, token_prices), **options)
+    response_data['swap_plan'] = plan_swaps(response_data['rebalance_actions'], token_prices, gas_price_wei=gas_price_wei)
+    return response_data
+
+def _compute_rebalance_batch(portfolios: list, token_prices: dict, gas_price_wei: int = None, **options) -> list:
+    """Helper function to rebalance many (tokens, target_allocation) pairs at once"""
+    symbols = {symbol for tokens, _ in portfolios for symbol in tokens}
+    results = compute_rebalance_batch(portfolios, _with_fallback_prices(symbols, token_prices), **options)
+    for result in results:
+        if result is not None:
+            result['swap_plan'] = plan_swaps(result['rebalance_actions'], token_prices, gas_price_wei=gas_price_wei)
+    return results
+
+def _get_gas_price():
+    """Helper function to get the current gas price in wei, or None if the node can't be reached"""
+    try:
+        return w3.eth.gas_price
     except Exception as e:
-        print(f"Error fetching token data from Etherscan: {str(e)}")
+        logger.error("Error getting gas price: %s", e)
+        return None
+
+def _build_wallet_tokens(eth_balance: int, token_reads: dict) -> List[Dict[str, Any]]:
+    """Helper function to build the get_wallet_tokens tool result from raw ETH and token reads"""
+    wallet_tokens = []
+    
+    if eth_balance > 0:
+        wallet_tokens.append({
+            "symbol": "ETH",
+            "name": "Ethereum",
+            "balance": from_raw(eth_balance, 18),  # Convert from wei to ETH
+            "decimals": 18,
+            "address": None  # Native ETH has no contract address
+        })
+    
+    for token_address, token_info in token_reads.items():
+        # Only add tokens with non-zero balance
+        if token_info["raw_balance"] > 0:
+            wallet_tokens.append({
+                "symbol": token_info["symbol"],
+                "name": token_info["name"],
+                "balance": from_raw(token_info["raw_balance"], token_info["decimals"]),
+                "decimals": token_info["decimals"],
+                "address": token_address
+            })
+    return wallet_tokens
+
+def _analyze_portfolio(tokens: List[Dict[str, Any]], prices: Dict[str, float]) -> tuple:
+    """Helper function to compute USD values, percentages and weight status per token.
+    
+    Returns (portfolio_analysis sorted by percentage, total_value).
+    """
+    total_value = 0
+    portfolio_analysis = []
+    
+    for token in tokens:
+        symbol = token["symbol"]
+        balance = token["balance"]
+        price = prices.get(symbol, 0)
+        usd_value = balance * price
+        total_value += usd_value
+    
+    for token in tokens:
+        symbol = token["symbol"]
+        balance = token["balance"]
+        price = prices.get(symbol, 0)
+        usd_value = balance * price
+        percentage = (usd_value / total_value * 100) if total_value > 0 else 0
+        status = "overweight" if percentage > 30 else "underweight" if percentage < 5 else "balanced"
         
-    return token_addresses
+        portfolio_analysis.append({
+            "symbol": symbol,
+            "balance": balance,
+            "price": price,
+            "usd_value": usd_value,
+            "percentage": percentage,
+            "status": status
+        })
+    
+    # Sort by percentage (descending)
+    portfolio_analysis.sort(key=lambda x: x["percentage"], reverse=True)
+    return portfolio_analysis, total_value
+
+def _fetch_token_addresses(wallet_address: str) -> list:
+    """Helper function to fetch token addresses from Etherscan"""
+    return fetch_token_addresses(wallet_address, ETHERSCAN_API_KEY, wallet_discovery_index)
+
+_chain_id = None
+
+def _get_chain_id() -> int:
+    """Returns the connected chain id, fetched from the node once per process"""
+    global _chain_id
+    if _chain_id is None:
+        _chain_id = w3.eth.chain_id
+    return _chain_id
+
+def _read_wallet_tokens(wallet_address: str, token_addresses: list, block_number: int) -> dict:
+    """Helper function to read token metadata and balances at a block, using cached metadata where possible"""
+    chain_id = _get_chain_id()
+    known_metadata = token_metadata_cache.get_many(chain_id, token_addresses)
+    record_cache("token_metadata", len(known_metadata), len(token_addresses) - len(known_metadata))
+    
+    token_reads = read_erc20_tokens(w3, wallet_address, token_addresses, block_number, known_metadata=known_metadata)
+    
+    # Persist metadata for tokens we just read for the first time
+    token_metadata_cache.put_many(chain_id, {
+        address: info for address, info in token_reads.items() if address not in known_metadata
+    })
+    return token_reads
+
+def _last_transfer_block(wallet_address: str) -> int:
+    """Helper function to get the block of the wallet's latest indexed token transfer"""
+    known = wallet_discovery_index.get(wallet_address)
+    return known[0] if known else -1
+
+def _snapshot_transfer_block(wallet_address: str, block_number: int) -> int:
+    """Helper function to get the latest indexed token transfer a snapshot at block_number includes.
+    
+    Etherscan may already have indexed transfers after the pinned block; capping at block_number
+    makes the next revalidation see them as new.
+    """
+    return min(_last_transfer_block(wallet_address), block_number)
+
+def _scan_wallet(wallet_address: str, block_number: int, extra_addresses: list) -> dict:
+    """Helper function to read the wallet's ETH balance and every known token's balance.
+    
+    Every read is pinned to block_number, so the snapshot is one consistent state of the wallet.
+    """
+    eth_balance = w3.eth.get_balance(wallet_address, block_identifier=block_number)
+    
+    # Get token addresses from Etherscan, plus any provided by the caller
+    token_addresses = _merge_token_addresses(_fetch_token_addresses(wallet_address), extra_addresses)
+    
+    # Read symbol/decimals/balance of every token in one batched multicall
+    logger.debug("Checking balances for %s tokens...", len(token_addresses))
+    token_reads = _read_wallet_tokens(wallet_address, token_addresses, block_number)
+    
+    return {
+        "block_number": block_number,
+        "eth_balance": eth_balance,
+        **WalletSnapshotCache.address_fields(token_addresses, token_reads),
+        "token_reads": token_reads,
+        "transfer_block": _snapshot_transfer_block(wallet_address, block_number)
+    }
+
+def _transfer_check_due(wallet_address: str) -> bool:
+    """Helper function to rate-limit Etherscan transfer checks to one per wallet every WALLET_TRANSFER_CHECK_INTERVAL seconds"""
+    now = time.time()
+    with _transfer_checks_lock:
+        if now - _transfer_checks.get(wallet_address, 0) < WALLET_TRANSFER_CHECK_INTERVAL:
+            return False
+        _transfer_checks[wallet_address] = now
+        _transfer_checks.move_to_end(wallet_address)
+        while len(_transfer_checks) > WALLET_SNAPSHOT_MAX_SIZE:
+            _transfer_checks.popitem(last=False)
+    return True
+
+def _wallet_unchanged(wallet_address: str, snapshot: dict, block_number: int) -> bool:
+    """Helper function to check that no block since the snapshot touched the wallet.
+    
+    The wallet is unchanged if its ETH balance at block_number is the same and the incremental
+    Etherscan scan finds no token transfer after the one the snapshot has seen. Etherscan is
+    asked at most every WALLET_TRANSFER_CHECK_INTERVAL seconds; in between, the last scan is used.
+    """
+    if w3.eth.get_balance(wallet_address, block_identifier=block_number) != snapshot["eth_balance"]:
+        return False
+    if _transfer_check_due(wallet_address):
+        _fetch_token_addresses(wallet_address)
+    return _last_transfer_block(wallet_address) <= snapshot["transfer_block"]
+
+# Latest balances of each wallet, shared by detect_tokens and the agent's get_wallet_tokens tool
+wallet_snapshot_cache = WalletSnapshotCache(_scan_wallet, _read_wallet_tokens, _wallet_unchanged)
+
+def _get_wallet_snapshot(wallet_address: str, extra_addresses=None) -> dict:
+    """Helper function to get the wallet's snapshot for the current block"""
+    return wallet_snapshot_cache.get(
+        wallet_address, w3.eth.block_number, _merge_token_addresses([], extra_addresses)
+    )
+
+def _token_metadata(token_addresses: list, block_number: int) -> dict:
+    """Helper function to get metadata for many tokens, reading only uncached ones in batched multicalls"""
+    chain_id = _get_chain_id()
+    known_metadata = token_metadata_cache.get_many(chain_id, token_addresses)
+    record_cache("token_metadata", len(known_metadata), len(token_addresses) - len(known_metadata))
+
+    new_metadata = read_erc20_metadata(
+        w3, [address for address in token_addresses if address not in known_metadata], block_number
+    )
+    token_metadata_cache.put_many(chain_id, new_metadata)
+    return {**known_metadata, **new_metadata}
+
+def _scan_wallet_batch(wallet_addresses: list, block_number: int, extra_addresses: list) -> tuple:
+    """Helper function to snapshot many wallets at one block.
+
+    Cached snapshots are reused. The other wallets' token contracts are discovered on Etherscan
+    (BATCH_CONCURRENCY wallets at a time), the metadata of their union is read once, and every
+    ETH and token balance is read in shared multicalls. Returns (snapshots, errors), both keyed by wallet.
+    """
+    snapshots = {}
+    errors = {}
+
+    to_scan = []
+    for wallet_address in wallet_addresses:
+        cached = wallet_snapshot_cache.peek(wallet_address, block_number, extra_addresses)
+        if cached:
+            snapshots[wallet_address] = cached
+        else:
+            to_scan.append(wallet_address)
+    if not to_scan:
+        return snapshots, errors
+
+    futures = {
+        wallet_address: submit(batch_discovery_executor, _fetch_token_addresses, wallet_address)
+        for wallet_address in to_scan
+    }
+    wallet_token_addresses = {}
+    for wallet_address, future in futures.items():
+        try:
+            wallet_token_addresses[wallet_address] = _merge_token_addresses(future.result(), extra_addresses)
+        except Exception as e:
+            logger.error("Error discovering tokens for %s: %s", wallet_address, e)
+            errors[wallet_address] = f'Token discovery failed: {e}'
+
+    all_token_addresses = list(dict.fromkeys(
+        address for token_addresses in wallet_token_addresses.values() for address in token_addresses
+    ))
+    metadata = _token_metadata(all_token_addresses, block_number)
+    balances = read_balances(w3, {
+        wallet_address: [address for address in token_addresses if address in metadata]
+        for wallet_address, token_addresses in wallet_token_addresses.items()
+    }, block_number)
+
+    for wallet_address, (eth_balance, token_balances) in balances.items():
+        try:
+            if eth_balance is None:
+                eth_balance = w3.eth.get_balance(wallet_address, block_identifier=block_number)
+        except Exception as e:
+            logger.error("Error getting ETH balance of %s: %s", wallet_address, e)
+            errors[wallet_address] = f'Balance read failed: {e}'
+            continue
+
+        token_reads = {
+            address: {**metadata[address], "raw_balance": raw_balance}
+            for address, raw_balance in token_balances.items()
+        }
+        snapshot = {
+            "block_number": block_number,
+            "eth_balance": eth_balance,
+            **WalletSnapshotCache.address_fields(wallet_token_addresses[wallet_address], token_reads),
+            "token_reads": token_reads,
+            "transfer_block": _snapshot_transfer_block(wallet_address, block_number),
+            "scanned_at": time.time()
+        }
+        wallet_snapshot_cache.put(wallet_address, snapshot)
+        snapshots[wallet_address] = snapshot
+    return snapshots, errors
+
+def _stream_wallet_batch(wallet_addresses: list, extra_addresses, block_number: int):
+    """Generator yielding one NDJSON line per wallet, BATCH_CHUNK_SIZE wallets at a time.
+
+    Prices are looked up once per symbol across the whole batch.
+    """
+    extra_addresses = _merge_token_addresses([], extra_addresses)
+
+    valid_addresses = []
+    for wallet_address in wallet_addresses:
+        try:
+            valid_addresses.append(Web3.to_checksum_address(wallet_address))
+        except Exception:
+            yield _ndjson_line({'wallet': wallet_address, 'error': 'Invalid wallet address'})
+    valid_addresses = list(dict.fromkeys(valid_addresses))
+
+    token_prices = {}
+    for start in range(0, len(valid_addresses), BATCH_CHUNK_SIZE):
+        chunk = valid_addresses[start:start + BATCH_CHUNK_SIZE]
+        try:
+            snapshots, errors = _scan_wallet_batch(chunk, block_number, extra_addresses)
+        except Exception as e:
+            logger.error("Error scanning wallet batch: %s", e)
+            snapshots, errors = {}, {wallet_address: f'Scan failed: {e}' for wallet_address in chunk}
+
+        detected = {
+            wallet_address: _build_detected_tokens(snapshot["eth_balance"], snapshot["token_reads"])
+            for wallet_address, snapshot in snapshots.items()
+        }
+
+        # Only symbols not priced by an earlier chunk
+        contract_addresses = {}
+        for detected_tokens in detected.values():
+            for symbol, token in detected_tokens.items():
+                if symbol not in token_prices:
+                    contract_addresses.setdefault(symbol, token.get("coingecko_id"))
+        if contract_addresses:
+            try:
+                token_prices.update(get_live_prices(list(contract_addresses), contract_addresses))
+            except Exception as e:
+                logger.error("Failed to get live prices: %s", e)
+
+        for wallet_address in chunk:
+            if wallet_address in errors:
+                yield _ndjson_line({'wallet': wallet_address, 'error': errors[wallet_address]})
+                continue
+            detected_tokens = detected[wallet_address]
+            yield _ndjson_line({
+                'wallet': wallet_address,
+                'block_number': block_number,
+                'tokens': detected_tokens,
+                'prices': {symbol: token_prices[symbol] for symbol in detected_tokens if symbol in token_prices}
+            })
 
 # AI Agent Functions
 
@@ -376,218 +934,533 @@ def get_wallet_tokens(wallet_address: str = None) -> List[Dict[str, Any]]:
     try:
         wallet_address = Web3.to_checksum_address(wallet_address)
     except:
-        print(f"Invalid wallet address: {wallet_address}")
+        logger.warning("Invalid wallet address: %s", wallet_address)
         return []
         
-    wallet_tokens = []
-    
-    # Add ETH balance
     try:
-        eth_balance = w3.eth.get_balance(wallet_address)
-        eth_balance_in_eth = eth_balance / 10**18  # Convert from wei to ETH
-        
-        if eth_balance_in_eth > 0:
-            wallet_tokens.append({
-                "symbol": "ETH",
-                "name": "Ethereum",
-                "balance": eth_balance_in_eth,
-                "decimals": 18,
-                "address": None  # Native ETH has no contract address
-            })
+        # Usually already scanned by detect_tokens or an earlier tool call
+        snapshot = _get_wallet_snapshot(wallet_address)
     except Exception as e:
-        print(f"Error getting ETH balance: {str(e)}")
+        logger.error("Error in get_wallet_tokens: %s", e)
+        return []
     
-    try:
-        # Get all token addresses for this wallet using our helper function
-        token_addresses_to_check = _fetch_token_addresses(wallet_address)
-        
-        # Process each token
-        for token_address in token_addresses_to_check:
-            try:
-                token_contract = w3.eth.contract(
-                    address=token_address,
-                    abi=ERC20_ABI
-                )
-                
-                # Get token info using contract calls
-                symbol = token_contract.functions.symbol().call()
-                name = None
-                try:
-                    name = token_contract.functions.name().call()
-                except:
-                    name = symbol  # Fallback to symbol if name isn't available
-                
-                decimals = token_contract.functions.decimals().call()
-                balance_raw = token_contract.functions.balanceOf(wallet_address).call()
-                balance = balance_raw / (10 ** decimals)
-                
-                # Only add tokens with non-zero balance
-                if balance > 0:
-                    wallet_tokens.append({
-                        "symbol": symbol,
-                        "name": name or symbol,
-                        "balance": balance,
-                        "decimals": decimals,
-                        "address": token_address
-                    })
-            except Exception as e:
-                print(f"Error getting token data for {token_address}: {str(e)}")
-                continue
-        
-        return wallet_tokens
-    except Exception as e:
-        print(f"Error in get_wallet_tokens: {str(e)}")
-        return wallet_tokens  # Return any tokens we found before the error
+    return _build_wallet_tokens(snapshot["eth_balance"], snapshot["token_reads"])
+
+# Fallback prices for test tokens; symbols CoinGecko cannot price default to $1
+FALLBACK_PRICES = {
+    "ETH": 3500.00,
+    "USDC": 1.00,
+    "USDT": 1.00,
+    "DAI": 1.00,
+    "WETH": 3500.00,
+    "WBTC": 62000.00,
+    "LUSD": 1.00,
+    "EUSD": 1.00,
+    "LUSDG": 1.00,
+    "TIGER": 5.00,
+    "WLETH": 3500.00,
+    "aEthWETH": 3500.00,
+}
 
 # Tool: Get live token prices
-def get_live_prices(symbols: List[str]) -> Dict[str, float]:
+def get_live_prices(symbols: List[str], contract_addresses: Dict[str, str] = None) -> Dict[str, float]:
     """Returns current USD prices for each token symbol"""
-    try:
-        # Create a dictionary to store prices
-        prices = {}
-        
-        # Define fallback prices for test tokens
-        test_token_prices = {
-            "ETH": 3500.00,
-            "USDC": 1.00,
-            "USDT": 1.00,
-            "DAI": 1.00,
-            "WETH": 3500.00,
-            "WBTC": 62000.00,
-            "LUSD": 1.00,
-            "EUSD": 1.00,
-            "LUSDG": 1.00,
-            "TIGER": 5.00,
-            "WLETH": 3500.00,
-            "aEthWETH": 3500.00,
-        }
-        
-        # Handle ETH price separately
-        if "ETH" in symbols:
-            # Get ETH price from CoinGecko API
-            eth_price_url = "https://api.coingecko.com/api/v3/simple/price?ids=ethereum&vs_currencies=usd"
-            try:
-                eth_response = requests.get(eth_price_url).json()
-                if "ethereum" in eth_response:
-                    prices["ETH"] = eth_response["ethereum"]["usd"]
-                    print(f"[INFO] Got ETH price from CoinGecko: ${prices['ETH']}")
-                else:
-                    # Fallback price if API fails
-                    prices["ETH"] = test_token_prices["ETH"]
-                    print(f"[INFO] Using fallback ETH price: ${prices['ETH']}")
-            except Exception as e:
-                # Fallback price if API fails
-                prices["ETH"] = test_token_prices["ETH"]
-                print(f"[INFO] Error getting ETH price, using fallback: ${prices['ETH']}. Error: {str(e)}")
-        
-        # For other tokens, try to get prices or use reasonable fallbacks
-        for symbol in symbols:
-            # Skip ETH since we already handled it
-            if symbol == "ETH" or symbol in prices:
-                continue
-                
-            # First check if we have a fallback price for this token
-            if symbol in test_token_prices:
-                prices[symbol] = test_token_prices[symbol]
-                print(f"[INFO] Using predefined price for {symbol}: ${prices[symbol]}")
-                continue
-                
-            # Known tokens with CoinGecko IDs
-            token_lookup = {
-                "USDC": "usd-coin",
-                "USDT": "tether",
-                "DAI": "dai",
-                "WETH": "weth",
-                "WBTC": "wrapped-bitcoin",
-            }
-            
-            if symbol in token_lookup:
-                # This is a known token with a CoinGecko ID
-                coingecko_id = token_lookup[symbol]
-                price_url = f"https://api.coingecko.com/api/v3/simple/price?ids={coingecko_id}&vs_currencies=usd"
-                
-                try:
-                    response = requests.get(price_url).json()
-                    if coingecko_id in response:
-                        prices[symbol] = response[coingecko_id]["usd"]
-                        print(f"[INFO] Got {symbol} price from CoinGecko: ${prices[symbol]}")
-                    else:
-                        # Use fallback from our predefined list or reasonable defaults
-                        prices[symbol] = test_token_prices.get(symbol, 1.0)
-                        print(f"[INFO] No price data for {symbol}, using fallback: ${prices[symbol]}")
-                except Exception as e:
-                    # Use fallback from our list
-                    prices[symbol] = test_token_prices.get(symbol, 1.0)
-                    print(f"[INFO] Error getting {symbol} price, using fallback: ${prices[symbol]}. Error: {str(e)}")
+    # Contract addresses let the CoinGecko index resolve the exact coin for a symbol
+    price_keys = _price_keys(symbols, contract_addresses)
+    key_prices = _priced_with_fallbacks(price_keys, price_cache.get_prices)
+    return {symbol: key_prices[price_key] for price_key, symbol in price_keys.items()}
+
+def _price_keys(symbols: List[str], contract_addresses: Dict[str, str] = None) -> Dict[str, str]:
+    """Helper function to map the price cache key of each symbol to the symbol.
+    
+    A symbol read from a known contract is keyed as "SYMBOL@address", so tokens sharing a
+    symbol are priced and cached separately.
+    """
+    contract_addresses = contract_addresses or {}
+    return {
+        f"{symbol}@{contract_addresses[symbol].lower()}" if contract_addresses.get(symbol) else symbol: symbol
+        for symbol in symbols
+    }
+
+def _token_contracts(tokens: Dict[str, Dict[str, Any]]) -> Dict[str, str]:
+    """Helper function to map each token symbol to its contract address (sent as coingecko_id)"""
+    return {symbol: token.get("coingecko_id") for symbol, token in tokens.items()}
+
+def _wallet_token_contracts(wallet_tokens: List[Dict[str, Any]]) -> Dict[str, str]:
+    """Helper function to map each get_wallet_tokens symbol to its contract address"""
+    return {token["symbol"]: token.get("address") for token in wallet_tokens}
+
+def _refresh_live_prices(price_keys: Dict[str, str]) -> Dict[str, float]:
+    """Helper function to refetch prices for the background refresher, with the same fallbacks as get_live_prices"""
+    return _priced_with_fallbacks(price_keys, price_cache.refresh)
+
+def _priced_with_fallbacks(price_keys: Dict[str, str], lookup) -> Dict[str, float]:
+    """Helper function to price keys through lookup(keys), filling in fallbacks for those without a live price"""
+    # ETH is always priced live; other test tokens use their predefined price
+    live_keys = [price_key for price_key, symbol in price_keys.items() if symbol == "ETH" or symbol not in FALLBACK_PRICES]
+    prices = lookup(live_keys) if live_keys else {}
+    
+    # Fallbacks only fill this result; the cache keeps live prices only
+    for price_key, symbol in price_keys.items():
+        if price_key not in prices:
+            prices[price_key] = FALLBACK_PRICES.get(symbol, 1.0)
+            logger.debug("Using fallback price for %s: $%s", symbol, prices[price_key])
+    return prices
+
+def _fetch_live_prices(price_keys: List[str]) -> Dict[str, float]:
+    """Fetches current USD prices from CoinGecko for _price_keys() keys, bypassing the price cache.
+    
+    Keys CoinGecko could not price are left out of the result.
+    """
+    # Known tokens with CoinGecko IDs
+    token_lookup = {
+        "ETH": "ethereum",
+        "USDC": "usd-coin",
+        "USDT": "tether",
+        "DAI": "dai",
+        "WETH": "weth",
+        "WBTC": "wrapped-bitcoin",
+    }
+    
+    # STEP 1: Resolve every key to a CoinGecko id before fetching any price
+    key_ids = {}
+    for price_key in dict.fromkeys(price_keys):
+        symbol, _, address = price_key.partition("@")
+        if symbol in token_lookup:
+            key_ids[price_key] = token_lookup[symbol]
+        else:
+            # For unknown tokens, use the local CoinGecko index (by contract, then symbol).
+            # Only search by name while the index has not been loaded yet.
+            coin_id = coingecko_index.resolve(symbol, address)
+            if not coin_id and not coingecko_index.loaded:
+                coin_id = search_coin_id(symbol)
+            if coin_id:
+                key_ids[price_key] = coin_id
             else:
-                # For unknown tokens, try to search by name
-                try:
-                    search_url = f"https://api.coingecko.com/api/v3/search?query={symbol}"
-                    search_results = requests.get(search_url).json()
-                    
-                    if search_results.get("coins") and len(search_results["coins"]) > 0:
-                        # Take the first result
-                        coin_id = search_results["coins"][0]["id"]
-                        price_url = f"https://api.coingecko.com/api/v3/simple/price?ids={coin_id}&vs_currencies=usd"
-                        price_data = requests.get(price_url).json()
-                        
-                        if coin_id in price_data:
-                            prices[symbol] = price_data[coin_id]["usd"]
-                            print(f"[INFO] Found {symbol} via search, price: ${prices[symbol]}")
-                        else:
-                            # Default to our predefined list or fallback value
-                            prices[symbol] = test_token_prices.get(symbol, 1.0)
-                            print(f"[INFO] Found {symbol} via search but no price, using fallback: ${prices[symbol]}")
-                    else:
-                        # No search results - this is likely a test token
-                        prices[symbol] = test_token_prices.get(symbol, 1.0)
-                        print(f"[INFO] {symbol} not found in CoinGecko, using fallback: ${prices[symbol]}")
-                except Exception as e:
-                    # Use fallback from our list or default
-                    prices[symbol] = test_token_prices.get(symbol, 1.0)
-                    print(f"[INFO] Error searching for {symbol}, using fallback: ${prices[symbol]}. Error: {str(e)}")
-        
-        return prices
+                # No search results - this is likely a test token
+                logger.info("%s not found in CoinGecko", symbol)
+    
+    # STEP 2: Fetch all resolved ids in bulk ids= requests
+    id_prices = fetch_simple_prices(list(key_ids.values()))
+    prices = {}
+    for price_key, coin_id in key_ids.items():
+        if coin_id in id_prices:
+            prices[price_key] = id_prices[coin_id]
+            logger.debug("Got %s price from CoinGecko: $%s", price_key, prices[price_key])
+        else:
+            logger.info("No price data for %s", price_key)
+    
+    return prices
+
+# Shared price cache in front of CoinGecko
+price_cache = PriceCache(_fetch_live_prices)
+
+_block_filter = None
+_last_polled_block = None
+
+def _poll_new_block():
+    """Helper function to return the latest block number if a block arrived since the last poll"""
+    global _block_filter, _last_polled_block
+    try:
+        if _block_filter is None:
+            _block_filter = w3.eth.filter('latest')
+        if not _block_filter.get_new_entries():
+            return None
     except Exception as e:
-        print(f"Error in get_live_prices: {str(e)}")
-        # Return best-effort prices or fallbacks
-        fallback_prices = {}
-        for symbol in symbols:
-            fallback_prices[symbol] = test_token_prices.get(symbol, 1.0)
-        return fallback_prices
+        # Nodes drop idle filters; fall back to comparing block numbers and recreate it next time
+        logger.warning("Block filter unavailable, polling block number: %s", e)
+        _block_filter = None
+    
+    block_number = w3.eth.block_number
+    if block_number == _last_polled_block:
+        return None
+    _last_polled_block = block_number
+    return block_number
+
+def _refresh_wallet_balances(wallet_address: str, block_number: int) -> dict:
+    """Helper function to get a subscribed wallet's tokens at a new block"""
+    snapshot = wallet_snapshot_cache.get(wallet_address, block_number)
+    detected_tokens = _build_detected_tokens(snapshot["eth_balance"], snapshot["token_reads"])
+    background_refresher.touch(wallet_address, _price_keys(detected_tokens, _token_contracts(detected_tokens)))
+    return {'tokens': detected_tokens}
+
+# Refreshes prices of active wallets and balances of subscribed wallets, pushed via /api/subscribe
+background_refresher = BackgroundRefresher(_refresh_live_prices, _poll_new_block, _refresh_wallet_balances)
+
+def _portfolio_analysis_result(wallet_tokens: List[Dict[str, Any]], prices: Dict[str, float]) -> Dict[str, Any]:
+    """Helper function to build the get_portfolio_analysis tool result, rounded to cents and hundredths of a percent"""
+    portfolio_analysis, total_value = _analyze_portfolio(wallet_tokens, prices)
+    return {
+        "portfolio_analysis": [
+            {**token, "usd_value": round(token["usd_value"], 2), "percentage": round(token["percentage"], 2)}
+            for token in portfolio_analysis
+        ],
+        "total_value": round(total_value, 2)
+    }
+
+# Tool: Get portfolio analysis
+def get_portfolio_analysis(wallet_address: str = None) -> Dict[str, Any]:
+    """Returns each held token's USD value, share of the portfolio and weight status"""
+    wallet_tokens = get_wallet_tokens(wallet_address)
+    prices = get_live_prices([token["symbol"] for token in wallet_tokens], _wallet_token_contracts(wallet_tokens))
+    return _portfolio_analysis_result(wallet_tokens, prices)
 
 # Tool: Get trending tokens
-def get_trending_tokens() -> List[Dict[str, Any]]:
-    """Returns currently trending cryptocurrencies with price data"""
+def get_trending_tokens() -> Dict[str, Any]:
+    """Returns currently trending cryptocurrencies with USD prices, and how old that snapshot is"""
+    return trending_feed.get()
+
+# Tools available to the AI agent
+AGENT_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_portfolio_analysis",
+            "description": "Returns every token in the user's wallet with its balance, USD price, USD value, percentage of the portfolio and status (overweight, underweight or balanced), plus the total USD value. Use this instead of combining get_wallet_tokens and get_live_prices.",
+            "parameters": {
+                "type": "object",
+                "properties": {},
+                "required": []
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_wallet_tokens",
+            "description": "Returns the user's ERC-20 token balances from their wallet.",
+            "parameters": {
+                "type": "object",
+                "properties": {},
+                "required": []
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_live_prices",
+            "description": "Returns current USD prices for each token symbol.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "symbols": {
+                        "type": "array",
+                        "items": {
+                            "type": "string"
+                        },
+                        "description": "List of token symbols to get prices for."
+                    }
+                },
+                "required": ["symbols"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_trending_tokens",
+            "description": "Returns currently trending cryptocurrencies with USD prices, and the age of that data in seconds.",
+            "parameters": {
+                "type": "object",
+                "properties": {},
+                "required": []
+            }
+        }
+    }
+]
+
+
+# Instructions for the AI agent
+AGENT_SYSTEM_MESSAGE = """
+You are CryptoPortfolioAgent — an AI assistant embedded in a web app. Your job is to help users analyze the tokens in their MetaMask wallet and advise whether their portfolio is balanced, underweight, or overweight using live market prices. Always think in clear, numbered "Thought:" steps. Whenever you need on-chain balances or market data, call the appropriate tool.
+
+Guidelines:
+- Start every response with "Thought: 1. ..." and enumerate your reasoning steps.
+- After you receive function output, continue your chain of thought.
+- get_portfolio_analysis gives each token's USD value, its percentage of the total portfolio and its status (overweight above 30%, underweight below 5%, otherwise balanced). Use these numbers as given instead of recomputing them.
+- In your final "Answer:" section, provide clear analysis and rebalancing suggestions.
+- When asked about hot/trending tokens, call get_trending_tokens() to identify potential investments.
+- Remember, the portfolio might be of Test Tokens which don't actually have real prices. In this case use fall back prices.
+
+Remember, users are looking for actionable portfolio advice. Be specific and reasoned in your analysis.
+"""
+
+
+def _run_agent_tool(function_name: str, function_args: dict, wallet_address: str):
+    """Helper function to execute one of the agent's tools by name"""
+    if function_name == "get_portfolio_analysis":
+        return get_portfolio_analysis(wallet_address)
+    elif function_name == "get_wallet_tokens":
+        return get_wallet_tokens(wallet_address)
+    elif function_name == "get_live_prices":
+        return get_live_prices(function_args.get("symbols", []))
+    elif function_name == "get_trending_tokens":
+        return get_trending_tokens()
+    return None
+
+def _timed_agent_tool(function_name: str, function_args: dict, wallet_address: str) -> tuple:
+    """Helper function to run an agent tool and measure its wall time in seconds"""
+    started = time.perf_counter()
+    with span(f"tool:{function_name}"):
+        function_response = _run_agent_tool(function_name, function_args, wallet_address)
+    return function_response, time.perf_counter() - started
+
+def _run_agent_tools_parallel(tool_calls: list, wallet_address: str, response_data: dict, tool_memo: dict):
+    """Helper function to run one turn's tool calls concurrently.
+    
+    Yields (tool_call, function_response, timed_out) in the original call order as each
+    result is collected, and records each tool's wall time in response_data["tool_timings"].
+    Calls whose result is already in tool_memo, including repeats within the turn, are not run again.
+    """
+    tool_args = [json.loads(tool_call.function.arguments) for tool_call in tool_calls]
+    tool_keys = [agent_tool_key(tool_call.function.name, args) for tool_call, args in zip(tool_calls, tool_args)]
+    futures = {}
+    for tool_call, args, key in zip(tool_calls, tool_args, tool_keys):
+        if key not in tool_memo and key not in futures:
+            futures[key] = submit(agent_tool_executor, _timed_agent_tool, tool_call.function.name, args, wallet_address)
+    
+    # All tools start together, so they share one deadline
+    deadline = time.perf_counter() + AGENT_TOOL_TIMEOUT
+    for tool_call, key in zip(tool_calls, tool_keys):
+        function_name = tool_call.function.name
+        cached = key in tool_memo
+        timed_out = False
+        if cached:
+            function_response, elapsed = tool_memo[key], 0.0
+        else:
+            try:
+                function_response, elapsed = futures[key].result(timeout=max(0, deadline - time.perf_counter()))
+                tool_memo[key] = function_response
+            except FuturesTimeoutError:
+                logger.warning("Tool %s timed out after %ss", function_name, AGENT_TOOL_TIMEOUT)
+                function_response = {"error": f"{function_name} timed out after {AGENT_TOOL_TIMEOUT} seconds"}
+                elapsed = AGENT_TOOL_TIMEOUT
+                timed_out = True
+        
+        response_data.setdefault("tool_timings", []).append({
+            "tool": function_name,
+            "seconds": round(elapsed, 4),
+            "timed_out": timed_out,
+            "cached": cached
+        })
+        yield tool_call, function_response, timed_out
+
+def _record_agent_tool_result(messages: list, response_data: dict, tool_call, function_response, timed_out: bool):
+    """Helper function to add a tool's result to the conversation and the frontend data"""
+    function_name = tool_call.function.name
+    
+    # Add any function responses to our answer content
+    if function_response:
+        messages.append({
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            "name": function_name,
+            "content": json.dumps(function_response)
+        })
+    
+    # For portfolio analysis, store relevant data to return to frontend
+    if not timed_out:
+        _store_agent_tool_result(response_data, function_name, function_response)
+
+def _store_agent_tool_result(response_data: dict, function_name: str, function_response):
+    """Helper function to keep tool results the frontend and portfolio analysis need"""
+    if function_name == "get_portfolio_analysis":
+        response_data.update(function_response)
+    elif function_name == "get_wallet_tokens":
+        response_data["wallet_tokens"] = function_response
+    elif function_name == "get_live_prices":
+        response_data["token_prices"] = function_response
+    elif function_name == "get_trending_tokens":
+        response_data["trending_tokens"] = function_response["tokens"]
+        response_data["trending_age_seconds"] = function_response["age_seconds"]
+
+def _add_portfolio_analysis(response_data: dict):
+    """Helper function to add portfolio_analysis once both balances and prices are known"""
+    if "wallet_tokens" in response_data and "token_prices" in response_data:
+        portfolio_analysis, total_value = _analyze_portfolio(
+            response_data["wallet_tokens"], response_data["token_prices"]
+        )
+        response_data["portfolio_analysis"] = portfolio_analysis
+        response_data["total_value"] = total_value
+
+def _agent_messages(user_message: str) -> list:
+    """Helper function to begin the conversation with the AI"""
+    return [
+        {"role": "system", "content": AGENT_SYSTEM_MESSAGE},
+        {"role": "user", "content": user_message}
+    ]
+
+def _start_agent_conversation(user_message: str, tool_memo: dict) -> tuple:
+    """Helper function to begin the conversation with get_portfolio_analysis already answered.
+    
+    The analysis computed up front goes in as a completed tool call, so the model can answer in
+    its first turn. Returns (messages, response_data).
+    """
+    messages = _agent_messages(user_message)
+    portfolio = tool_memo.get(agent_tool_key("get_portfolio_analysis", {}))
+    if not portfolio:
+        return messages, {}
+    
+    messages.append({"role": "assistant", "content": None, "tool_calls": [{
+        "id": "call_portfolio_analysis",
+        "type": "function",
+        "function": {"name": "get_portfolio_analysis", "arguments": "{}"}
+    }]})
+    messages.append({
+        "role": "tool",
+        "tool_call_id": "call_portfolio_analysis",
+        "name": "get_portfolio_analysis",
+        "content": json.dumps(portfolio)
+    })
+    return messages, dict(portfolio)
+
+def _agent_context(user_message: str, wallet_tokens: list, prices: dict) -> tuple:
+    """Helper function to set up an agent conversation from the wallet's current holdings and prices.
+    
+    Returns (response cache key, tool memo already holding the get_wallet_tokens, get_live_prices
+    and get_portfolio_analysis results). The key is None when the wallet could not be read, so nothing is cached for it.
+    """
+    if not wallet_tokens:
+        return None, {}
+    symbols = [token["symbol"] for token in wallet_tokens]
+    tool_memo = {
+        agent_tool_key("get_wallet_tokens", {}): wallet_tokens,
+        agent_tool_key("get_live_prices", {"symbols": symbols}): prices,
+        agent_tool_key("get_portfolio_analysis", {}): _portfolio_analysis_result(wallet_tokens, prices)
+    }
+    return agent_response_cache.key(user_message, wallet_tokens, prices), tool_memo
+
+def _prepare_agent(user_message: str, wallet_address: str) -> tuple:
+    """Helper function to return (response cache key, tool memo, cached response or None)"""
+    wallet_tokens = get_wallet_tokens(wallet_address)
+    cache_key, tool_memo = _agent_context(
+        user_message, wallet_tokens,
+        get_live_prices([token["symbol"] for token in wallet_tokens], _wallet_token_contracts(wallet_tokens))
+    )
+    return cache_key, tool_memo, agent_response_cache.get(cache_key) if cache_key else None
+
+def _cache_agent_response(cache_key, full_response: str, response_data: dict):
+    """Helper function to remember a finished answer, unless a tool timed out while producing it"""
+    if cache_key and not any(timing["timed_out"] for timing in response_data.get("tool_timings", [])):
+        agent_response_cache.put(cache_key, {'response': full_response, 'data': response_data})
+
+def _agent_turn_options(turn: int, tokens_used: int) -> dict:
+    """Helper function to pick a turn's tool_choice.
+    
+    The last turn allowed by AGENT_MAX_TURNS, or any turn after AGENT_MAX_TOKENS were used,
+    must answer without calling tools.
+    """
+    final = turn + 1 >= AGENT_MAX_TURNS or tokens_used >= AGENT_MAX_TOKENS
+    return {"tool_choice": "none" if final else "auto"}
+
+def _usage_tokens(usage) -> int:
+    """Helper function to read total_tokens from a completion's usage (an object, or a dict on stream chunks)"""
+    if not usage:
+        return 0
+    return usage["total_tokens"] if isinstance(usage, dict) else usage.total_tokens
+
+def _sse_event(event: str, data) -> str:
+    """Helper function to format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _ndjson_line(data) -> str:
+    """Helper function to format one newline-delimited JSON record"""
+    return json.dumps(data) + "\n"
+
+def _accumulate_tool_call_deltas(tool_call_parts: dict, delta_tool_calls):
+    """Helper function to merge streamed tool call fragments, keyed by their index"""
+    for delta in delta_tool_calls or []:
+        part = tool_call_parts.setdefault(delta.index, {"id": "", "name": "", "arguments": ""})
+        if delta.id:
+            part["id"] = delta.id
+        if delta.function:
+            part["name"] += delta.function.name or ""
+            part["arguments"] += delta.function.arguments or ""
+
+def _streamed_assistant_message(content: str, tool_call_parts: dict) -> tuple:
+    """Helper function to rebuild a streamed turn's assistant message.
+    
+    Returns (message for the conversation, list of tool calls).
+    """
+    tool_calls = [
+        ChatCompletionMessageToolCall(
+            id=part["id"],
+            type="function",
+            function=Function(name=part["name"], arguments=part["arguments"] or "{}")
+        )
+        for _, part in sorted(tool_call_parts.items())
+    ]
+    
+    assistant_message = {"role": "assistant", "content": content or None}
+    if tool_calls:
+        assistant_message["tool_calls"] = [tool_call.model_dump() for tool_call in tool_calls]
+    return assistant_message, tool_calls
+
+def _stream_portfolio_agent(user_message: str, wallet_address: str):
+    """Streaming version of the agent loop, yielding Server-Sent Events as work happens.
+    
+    Events: token (response text), tool_start and tool_end (with timings), then done with
+    the same response/data payload as the JSON endpoint, or error.
+    """
     try:
-        # Use CoinGecko's trending API
-        url = "https://api.coingecko.com/api/v3/search/trending"
-        response = requests.get(url).json()
-        
-        trending_tokens = []
-        if "coins" in response:
-            # Extract relevant data for each trending token
-            for item in response["coins"][:10]:  # Limit to top 10
-                coin = item["item"]
-                trending_tokens.append({
-                    "symbol": coin["symbol"],
-                    "name": coin["name"],
-                    "market_cap_rank": coin.get("market_cap_rank"),
-                    "price_btc": coin.get("price_btc", 0)
-                })
+        cache_key, tool_memo, cached = _prepare_agent(user_message, wallet_address)
+        if cached:
+            yield _sse_event("token", {"content": cached['response']})
+            yield _sse_event("done", {**cached, 'cached': True})
+            return
+        
+        messages, response_data = _start_agent_conversation(user_message, tool_memo)
+        full_response = ""
+        tokens_used = 0
+        
+        for turn in range(AGENT_MAX_TURNS):
+            turn_options = _agent_turn_options(turn, tokens_used)
+            stream = _openai_chat_stream(
+                model="gpt-4-0125-preview",
+                messages=messages,
+                tools=AGENT_TOOLS,
+                **turn_options
+            )
+            
+            content = ""
+            tool_call_parts = {}
+            for chunk in stream:
+                if not chunk.choices:
+                    # The usage chunk at the end of the stream
+                    tokens_used += _usage_tokens(getattr(chunk, "usage", None))
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content += delta.content
+                    yield _sse_event("token", {"content": delta.content})
+                _accumulate_tool_call_deltas(tool_call_parts, delta.tool_calls)
             
-            # Get USD prices for these tokens
-            symbols = [token["symbol"] for token in trending_tokens]
-            prices = get_live_prices(symbols)
+            assistant_message, tool_calls = _streamed_assistant_message(content, tool_call_parts)
+            messages.append(assistant_message)
+            full_response += content
+            
+            if not tool_calls or turn_options["tool_choice"] == "none":
+                # No more tool calls needed
+                break
+            
+            for tool_call in tool_calls:
+                yield _sse_event("tool_start", {"id": tool_call.id, "tool": tool_call.function.name})
             
-            # Add USD prices to the trending tokens
-            for token in trending_tokens:
-                token["price_usd"] = prices.get(token["symbol"], 0)
+            tool_results = _run_agent_tools_parallel(tool_calls, wallet_address, response_data, tool_memo)
+            for tool_call, function_response, timed_out in tool_results:
+                _record_agent_tool_result(messages, response_data, tool_call, function_response, timed_out)
+                yield _sse_event("tool_end", {"id": tool_call.id, **response_data["tool_timings"][-1]})
+        
+        # When calculating portfolio, perform additional analysis
+        _add_portfolio_analysis(response_data)
+        _cache_agent_response(cache_key, full_response, response_data)
         
-        return trending_tokens
+        yield _sse_event("done", {'response': full_response, 'data': response_data})
+    
     except Exception as e:
-        print(f"Error in get_trending_tokens: {str(e)}")
-        return []
+        logger.exception("Error in portfolio_agent stream: %s", e)
+        yield _sse_event("error", {'response': f"An error occurred: {str(e)}. Please try again."})
 
 # The AI Portfolio Agent endpoint
 @app.route('/api/portfolio-agent', methods=['POST'])
@@ -603,166 +1476,54 @@ def portfolio_agent():
                 'response': "Please connect your wallet first. I need to access your token balances to analyze your portfolio."
             })
         
-        # Define the tools available to the AI agent
-        tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "get_wallet_tokens",
-                    "description": "Returns the user's ERC-20 token balances from their wallet.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {},
-                        "required": []
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "get_live_prices",
-                    "description": "Returns current USD prices for each token symbol.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "symbols": {
-                                "type": "array",
-                                "items": {
-                                    "type": "string"
-                                },
-                                "description": "List of token symbols to get prices for."
-                            }
-                        },
-                        "required": ["symbols"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "get_trending_tokens",
-                    "description": "Returns currently trending cryptocurrencies with price data.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {},
-                        "required": []
-                    }
-                }
-            }
-        ]
-        
-        # Initialize the AI agent conversation
-        system_message = """
-        You are CryptoPortfolioAgent — an AI assistant embedded in a web app. Your job is to help users analyze the tokens in their MetaMask wallet and advise whether their portfolio is balanced, underweight, or overweight using live market prices. Always think in clear, numbered "Thought:" steps. Whenever you need on-chain balances or market data, call the appropriate tool.
-        
-        Guidelines:
-        - Start every response with "Thought: 1. ..." and enumerate your reasoning steps.
-        - After you receive function output, continue your chain of thought.
-        - Compute USD value for each token and its percentage of total portfolio.
-        - If % > 30%, label overweight; if % < 5%, label underweight; otherwise OK.
-        - In your final "Answer:" section, provide clear analysis and rebalancing suggestions.
-        - When asked about hot/trending tokens, call get_trending_tokens() to identify potential investments.
-        - Remember, the portfolio might be of Test Tokens which don't actually have real prices. In this case use fall back prices.
+        # Streaming mode sends tokens and tool progress as Server-Sent Events
+        if data.get('stream'):
+            return Response(
+                stream_with_context(_stream_portfolio_agent(user_message, wallet_address)),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
         
-        Remember, users are looking for actionable portfolio advice. Be specific and reasoned in your analysis.
-        """
+        # Same question about the same holdings at about the same prices
+        cache_key, tool_memo, cached = _prepare_agent(user_message, wallet_address)
+        if cached:
+            return jsonify({**cached, 'cached': True})
         
         # Begin the conversation with the AI
-        messages = [
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": user_message}
-        ]
+        messages, response_data = _start_agent_conversation(user_message, tool_memo)
         
         # Process user message and manage tool calling flow
         full_response = ""
-        response_data = {}
+        tokens_used = 0
         
-        while True:
+        for turn in range(AGENT_MAX_TURNS):
             # Call OpenAI API
-            response = openai_client.chat.completions.create(
+            turn_options = _agent_turn_options(turn, tokens_used)
+            response = _openai_chat(
                 model="gpt-4-0125-preview",  # Or other model with function calling
                 messages=messages,
-                tools=tools,
-                tool_choice="auto"
+                tools=AGENT_TOOLS,
+                **turn_options
             )
+            tokens_used += _usage_tokens(response.usage)
             
             assistant_message = response.choices[0].message
             messages.append(assistant_message)
             full_response += assistant_message.content if assistant_message.content else ""
             
             # Check if tool calling is required
-            if hasattr(assistant_message, 'tool_calls') and assistant_message.tool_calls:
-                # Execute each tool call
-                for tool_call in assistant_message.tool_calls:
-                    function_name = tool_call.function.name
-                    function_args = json.loads(tool_call.function.arguments)
-                    
-                    function_response = None
-                    if function_name == "get_wallet_tokens":
-                        function_response = get_wallet_tokens(wallet_address)
-                    elif function_name == "get_live_prices":
-                        function_response = get_live_prices(function_args.get("symbols", []))
-                    elif function_name == "get_trending_tokens":
-                        function_response = get_trending_tokens()
-                    
-                    # Add any function responses to our answer content
-                    if function_response:
-                        messages.append({
-                            "role": "tool",
-                            "tool_call_id": tool_call.id,
-                            "name": function_name,
-                            "content": json.dumps(function_response)
-                        })
-
-                    
-                    # For portfolio analysis, store relevant data to return to frontend
-                    if function_name == "get_wallet_tokens":
-                        response_data["wallet_tokens"] = function_response
-                    elif function_name == "get_live_prices":
-                        response_data["token_prices"] = function_response
-                    elif function_name == "get_trending_tokens":
-                        response_data["trending_tokens"] = function_response
+            if assistant_message.tool_calls and turn_options["tool_choice"] != "none":
+                # Execute this turn's tool calls concurrently, keeping their original order
+                tool_results = _run_agent_tools_parallel(assistant_message.tool_calls, wallet_address, response_data, tool_memo)
+                for tool_call, function_response, timed_out in tool_results:
+                    _record_agent_tool_result(messages, response_data, tool_call, function_response, timed_out)
             else:
                 # No more tool calls needed
                 break
         
         # When calculating portfolio, perform additional analysis
-        if "wallet_tokens" in response_data and "token_prices" in response_data:
-            # Calculate portfolio value and allocations
-            tokens = response_data["wallet_tokens"]
-            prices = response_data["token_prices"]
-            
-            total_value = 0
-            portfolio_analysis = []
-            
-            for token in tokens:
-                symbol = token["symbol"]
-                balance = token["balance"]
-                price = prices.get(symbol, 0)
-                usd_value = balance * price
-                total_value += usd_value
-            
-            for token in tokens:
-                symbol = token["symbol"]
-                balance = token["balance"]
-                price = prices.get(symbol, 0)
-                usd_value = balance * price
-                percentage = (usd_value / total_value * 100) if total_value > 0 else 0
-                status = "overweight" if percentage > 30 else "underweight" if percentage < 5 else "balanced"
-                
-                portfolio_analysis.append({
-                    "symbol": symbol,
-                    "balance": balance,
-                    "price": price,
-                    "usd_value": usd_value,
-                    "percentage": percentage,
-                    "status": status
-                })
-            
-            # Sort by percentage (descending)
-            portfolio_analysis.sort(key=lambda x: x["percentage"], reverse=True)
-            response_data["portfolio_analysis"] = portfolio_analysis
-            response_data["total_value"] = total_value
+        _add_portfolio_analysis(response_data)
+        _cache_agent_response(cache_key, full_response, response_data)
         
         return jsonify({
             'response': full_response,
@@ -770,9 +1531,7 @@ def portfolio_agent():
         })
         
     except Exception as e:
-        print(f"Error in portfolio_agent: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in portfolio_agent: %s", e)
         return jsonify({
             'response': f"An error occurred: {str(e)}. Please try again."
         }), 500
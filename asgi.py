@@ -0,0 +1,599 @@
+import os
+import json
+import asyncio
+import logging
+from typing import List, Dict, Any
+import aiohttp
+from a2wsgi import WSGIMiddleware
+from openai import AsyncOpenAI
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from web3 import AsyncWeb3, Web3
+
+# Shares configuration, caches and helpers with the Flask app
+import app as flask_app
+from http_client import AsyncPooledClient, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_MAX_CONCURRENCY_PER_HOST
+from multicall import async_read_erc20_tokens
+from etherscan import async_fetch_token_addresses
+from wallet_snapshot import WalletSnapshotCache
+from refresher import SSE_KEEPALIVE_INTERVAL
+from agent_cache import AGENT_MAX_TURNS, agent_tool_key
+from tracing import (SERVER_TIMING_ENABLED, current_span, end_request, finish_request, record_cache, server_timing,
+                     span, start_request)
+
+logger = logging.getLogger(__name__)
+
+
+class TracedAsyncHTTPProvider(AsyncWeb3.AsyncHTTPProvider):
+    """AsyncHTTPProvider that times each JSON-RPC call in an upstream span"""
+
+    async def make_request(self, method, params):
+        with span(method, "infura"):
+            return await super().make_request(method, params)
+
+
+async def _count_response_bytes(session, context, params):
+    """aiohttp trace hook adding received body bytes to the current upstream span"""
+    current = current_span()
+    if current is not None:
+        current.attributes["bytes"] = current.attributes.get("bytes", 0) + len(params.chunk)
+
+# Async clients for OpenAI and Infura
+async_openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+async_w3 = AsyncWeb3(TracedAsyncHTTPProvider(flask_app.INFURA_URL))
+
+# Created on startup, inside the server's event loop
+async_http_client = None
+
+# Paths served by the async handlers below; everything else goes to the Flask app
+ASYNC_PATHS = {'/api/detect_tokens', '/api/calculate_rebalance', '/api/portfolio-agent', '/api/subscribe'}
+
+
+async def startup():
+    global async_http_client
+    async_http_client = AsyncPooledClient()
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_response_chunk_received.append(_count_response_bytes)
+
+    # Pooled keep-alive session with timeouts and a per-host limit for the async Infura provider
+    await async_w3.provider.cache_async_session(aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=HTTP_MAX_CONCURRENCY_PER_HOST),
+        timeout=aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT),
+        raise_for_status=True,
+        trace_configs=[trace_config]
+    ))
+
+
+async def shutdown():
+    if async_http_client:
+        await async_http_client.aclose()
+
+
+# Helper functions
+_chain_id = None
+
+async def _async_get_chain_id() -> int:
+    """Returns the connected chain id, fetched from the node once per process"""
+    global _chain_id
+    if _chain_id is None:
+        _chain_id = await async_w3.eth.chain_id
+    return _chain_id
+
+async def _async_fetch_token_addresses(wallet_address: str) -> list:
+    """Async version of app._fetch_token_addresses"""
+    return await async_fetch_token_addresses(
+        async_http_client, wallet_address, flask_app.ETHERSCAN_API_KEY, flask_app.wallet_discovery_index
+    )
+
+async def _async_read_wallet_tokens(wallet_address: str, token_addresses: list, block_number: int) -> dict:
+    """Async version of app._read_wallet_tokens"""
+    chain_id = await _async_get_chain_id()
+    known_metadata = flask_app.token_metadata_cache.get_many(chain_id, token_addresses)
+    record_cache("token_metadata", len(known_metadata), len(token_addresses) - len(known_metadata))
+
+    token_reads = await async_read_erc20_tokens(
+        async_w3, wallet_address, token_addresses, block_number, known_metadata=known_metadata
+    )
+
+    # Persist metadata for tokens we just read for the first time
+    flask_app.token_metadata_cache.put_many(chain_id, {
+        address: info for address, info in token_reads.items() if address not in known_metadata
+    })
+    return token_reads
+
+async def _async_scan_wallet(wallet_address: str, block_number: int, extra_addresses: list) -> dict:
+    """Async version of app._scan_wallet"""
+    # ETH balance and token discovery are independent, so run them together
+    eth_balance, token_addresses = await asyncio.gather(
+        async_w3.eth.get_balance(wallet_address, block_identifier=block_number),
+        _async_fetch_token_addresses(wallet_address)
+    )
+    token_addresses = flask_app._merge_token_addresses(token_addresses, extra_addresses)
+
+    # Read symbol/decimals/balance of every token in one batched multicall
+    logger.debug("Checking balances for %s tokens...", len(token_addresses))
+    token_reads = await _async_read_wallet_tokens(wallet_address, token_addresses, block_number)
+
+    return {
+        "block_number": block_number,
+        "eth_balance": eth_balance,
+        **WalletSnapshotCache.address_fields(token_addresses, token_reads),
+        "token_reads": token_reads,
+        "transfer_block": flask_app._snapshot_transfer_block(wallet_address, block_number)
+    }
+
+async def _async_wallet_unchanged(wallet_address: str, snapshot: dict, block_number: int) -> bool:
+    """Async version of app._wallet_unchanged"""
+    if flask_app._transfer_check_due(wallet_address):
+        eth_balance, _ = await asyncio.gather(
+            async_w3.eth.get_balance(wallet_address, block_identifier=block_number),
+            _async_fetch_token_addresses(wallet_address)
+        )
+    else:
+        eth_balance = await async_w3.eth.get_balance(wallet_address, block_identifier=block_number)
+    if eth_balance != snapshot["eth_balance"]:
+        return False
+    return flask_app._last_transfer_block(wallet_address) <= snapshot["transfer_block"]
+
+async def _async_get_wallet_snapshot(wallet_address: str, extra_addresses=None) -> dict:
+    """Async version of app._get_wallet_snapshot, sharing its snapshot cache"""
+    return await flask_app.wallet_snapshot_cache.aget(
+        wallet_address,
+        await async_w3.eth.block_number,
+        flask_app._merge_token_addresses([], extra_addresses),
+        _async_scan_wallet,
+        _async_read_wallet_tokens,
+        _async_wallet_unchanged
+    )
+
+async def _async_get_gas_price():
+    """Async version of app._get_gas_price"""
+    try:
+        return await async_w3.eth.gas_price
+    except Exception as e:
+        logger.error("Error getting gas price: %s", e)
+        return None
+
+async def _async_openai_chat(**kwargs):
+    """Async version of app._openai_chat"""
+    with span("chat.completions", "openai", model=kwargs["model"]) as call:
+        response = await async_openai_client.chat.completions.create(**kwargs)
+        if response.usage:
+            call.set(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+    return response
+
+async def _async_openai_chat_stream(**kwargs):
+    """Async version of app._openai_chat_stream"""
+    with span("chat.completions", "openai", model=kwargs["model"], stream=True) as call:
+        chunks = 0
+        async for chunk in await async_openai_client.chat.completions.create(
+            stream=True, extra_body={"stream_options": {"include_usage": True}}, **kwargs
+        ):
+            chunks += 1
+            if getattr(chunk, "usage", None):
+                call.set(total_tokens=flask_app._usage_tokens(chunk.usage))
+            yield chunk
+        call.set(chunks=chunks)
+
+async def async_get_live_prices(symbols: List[str], contract_addresses: Dict[str, str] = None) -> Dict[str, float]:
+    """Async version of app.get_live_prices.
+
+    Prices are served from the shared, coalescing price cache; the rare upstream fetch
+    runs in a worker thread so it does not block the event loop.
+    """
+    return await asyncio.to_thread(flask_app.get_live_prices, symbols, contract_addresses)
+
+# Tool: Get wallet tokens
+async def async_get_wallet_tokens(wallet_address: str = None) -> List[Dict[str, Any]]:
+    """Async version of app.get_wallet_tokens"""
+    if not wallet_address:
+        return []
+
+    # Make sure the address is in checksum format
+    try:
+        wallet_address = Web3.to_checksum_address(wallet_address)
+    except:
+        logger.warning("Invalid wallet address: %s", wallet_address)
+        return []
+
+    try:
+        # Usually already scanned by detect_tokens or an earlier tool call
+        snapshot = await _async_get_wallet_snapshot(wallet_address)
+    except Exception as e:
+        logger.error("Error in get_wallet_tokens: %s", e)
+        return []
+
+    return flask_app._build_wallet_tokens(snapshot["eth_balance"], snapshot["token_reads"])
+
+async def _async_run_agent_tool(function_name: str, function_args: dict, wallet_address: str):
+    """Async version of app._run_agent_tool"""
+    if function_name == "get_portfolio_analysis":
+        wallet_tokens = await async_get_wallet_tokens(wallet_address)
+        return flask_app._portfolio_analysis_result(wallet_tokens, await async_get_live_prices(
+            [token["symbol"] for token in wallet_tokens], flask_app._wallet_token_contracts(wallet_tokens)
+        ))
+    elif function_name == "get_wallet_tokens":
+        return await async_get_wallet_tokens(wallet_address)
+    elif function_name == "get_live_prices":
+        return await async_get_live_prices(function_args.get("symbols", []))
+    elif function_name == "get_trending_tokens":
+        # The snapshot is read from memory; the background thread does all fetching
+        return flask_app.get_trending_tokens()
+    return None
+
+async def _async_timed_agent_tool(function_name: str, function_args: dict, wallet_address: str) -> tuple:
+    """Runs an agent tool with the per-tool timeout; returns (response, seconds, timed_out)"""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    try:
+        with span(f"tool:{function_name}"):
+            function_response = await asyncio.wait_for(
+                _async_run_agent_tool(function_name, function_args, wallet_address), flask_app.AGENT_TOOL_TIMEOUT
+            )
+        return function_response, loop.time() - started, False
+    except asyncio.TimeoutError:
+        logger.warning("Tool %s timed out after %ss", function_name, flask_app.AGENT_TOOL_TIMEOUT)
+        function_response = {"error": f"{function_name} timed out after {flask_app.AGENT_TOOL_TIMEOUT} seconds"}
+        return function_response, loop.time() - started, True
+
+
+def _start_agent_tools(tool_calls: list, wallet_address: str, tool_memo: dict) -> list:
+    """Starts a task for each tool call whose result is not in tool_memo; repeats within the turn share one.
+
+    Returns (memo key, task) per tool call, in call order.
+    """
+    tasks = {}
+    started = []
+    for tool_call in tool_calls:
+        function_args = json.loads(tool_call.function.arguments)
+        key = agent_tool_key(tool_call.function.name, function_args)
+        if key not in tool_memo and key not in tasks:
+            tasks[key] = asyncio.create_task(
+                _async_timed_agent_tool(tool_call.function.name, function_args, wallet_address)
+            )
+        started.append((key, tasks.get(key)))
+    return started
+
+async def _agent_tool_result(key: tuple, task, tool_memo: dict) -> tuple:
+    """Returns (response, seconds, timed_out, cached) for a call started by _start_agent_tools"""
+    if key in tool_memo:
+        return tool_memo[key], 0.0, False, True
+    function_response, elapsed, timed_out = await task
+    if not timed_out:
+        tool_memo[key] = function_response
+    return function_response, elapsed, timed_out, False
+
+async def _async_prepare_agent(user_message: str, wallet_address: str) -> tuple:
+    """Async version of app._prepare_agent"""
+    wallet_tokens = await async_get_wallet_tokens(wallet_address)
+    cache_key, tool_memo = flask_app._agent_context(
+        user_message, wallet_tokens, await async_get_live_prices(
+            [token["symbol"] for token in wallet_tokens], flask_app._wallet_token_contracts(wallet_tokens)
+        )
+    )
+    return cache_key, tool_memo, flask_app.agent_response_cache.get(cache_key) if cache_key else None
+
+
+def _record_tool_timing(response_data: dict, function_name: str, elapsed: float, timed_out: bool,
+                        cached: bool = False) -> dict:
+    """Records a tool's wall time in response_data["tool_timings"] and returns the entry"""
+    timing = {"tool": function_name, "seconds": round(elapsed, 4), "timed_out": timed_out, "cached": cached}
+    response_data.setdefault("tool_timings", []).append(timing)
+    return timing
+
+async def _async_stream_portfolio_agent(user_message: str, wallet_address: str):
+    """Async version of app._stream_portfolio_agent"""
+    try:
+        cache_key, tool_memo, cached = await _async_prepare_agent(user_message, wallet_address)
+        if cached:
+            yield flask_app._sse_event("token", {"content": cached['response']})
+            yield flask_app._sse_event("done", {**cached, 'cached': True})
+            return
+
+        messages, response_data = flask_app._start_agent_conversation(user_message, tool_memo)
+        full_response = ""
+        tokens_used = 0
+
+        for turn in range(AGENT_MAX_TURNS):
+            turn_options = flask_app._agent_turn_options(turn, tokens_used)
+            stream = _async_openai_chat_stream(
+                model="gpt-4-0125-preview",
+                messages=messages,
+                tools=flask_app.AGENT_TOOLS,
+                **turn_options
+            )
+
+            content = ""
+            tool_call_parts = {}
+            async for chunk in stream:
+                if not chunk.choices:
+                    # The usage chunk at the end of the stream
+                    tokens_used += flask_app._usage_tokens(getattr(chunk, "usage", None))
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content += delta.content
+                    yield flask_app._sse_event("token", {"content": delta.content})
+                flask_app._accumulate_tool_call_deltas(tool_call_parts, delta.tool_calls)
+
+            assistant_message, tool_calls = flask_app._streamed_assistant_message(content, tool_call_parts)
+            messages.append(assistant_message)
+            full_response += content
+
+            if not tool_calls or turn_options["tool_choice"] == "none":
+                # No more tool calls needed
+                break
+
+            # Start every tool now, then report each one in call order as it finishes
+            started = _start_agent_tools(tool_calls, wallet_address, tool_memo)
+            for tool_call in tool_calls:
+                yield flask_app._sse_event("tool_start", {"id": tool_call.id, "tool": tool_call.function.name})
+
+            for tool_call, (key, task) in zip(tool_calls, started):
+                function_response, elapsed, timed_out, cached = await _agent_tool_result(key, task, tool_memo)
+                timing = _record_tool_timing(response_data, tool_call.function.name, elapsed, timed_out, cached)
+                flask_app._record_agent_tool_result(messages, response_data, tool_call, function_response, timed_out)
+                yield flask_app._sse_event("tool_end", {"id": tool_call.id, **timing})
+
+        # When calculating portfolio, perform additional analysis
+        flask_app._add_portfolio_analysis(response_data)
+        flask_app._cache_agent_response(cache_key, full_response, response_data)
+
+        yield flask_app._sse_event("done", {'response': full_response, 'data': response_data})
+
+    except Exception as e:
+        logger.exception("Error in portfolio_agent stream: %s", e)
+        yield flask_app._sse_event("error", {'response': f"An error occurred: {str(e)}. Please try again."})
+
+
+# Routes
+async def detect_tokens(request: Request):
+    data = await request.json()
+    wallet_address = data.get('wallet_address')
+
+    if not wallet_address:
+        return JSONResponse({'error': 'No wallet address provided'}, status_code=400)
+
+    # Normalize the address
+    try:
+        wallet_address = Web3.to_checksum_address(wallet_address)
+    except:
+        return JSONResponse({'error': 'Invalid wallet address'}, status_code=400)
+
+    # ETH balance and token balances, served from the shared wallet snapshot cache
+    logger.debug("Fetching tokens for wallet %s", wallet_address)
+    try:
+        snapshot = await _async_get_wallet_snapshot(wallet_address, data.get('token_addresses'))
+    except Exception as e:
+        logger.error("Error reading wallet %s: %s", wallet_address, e)
+        return JSONResponse({'error': f'Could not read wallet balances: {str(e)}'}, status_code=502)
+    detected_tokens = flask_app._build_detected_tokens(snapshot["eth_balance"], snapshot["token_reads"])
+
+    token_symbols = list(detected_tokens.keys())
+    logger.debug("Getting live prices for %s tokens: %s", len(token_symbols), token_symbols)
+
+    try:
+        token_prices = await async_get_live_prices(token_symbols, flask_app._token_contracts(detected_tokens))
+        logger.debug("Got prices: %s", token_prices)
+
+        # Keep this wallet's prices warm in the background
+        flask_app.background_refresher.touch(
+            wallet_address, flask_app._price_keys(token_symbols, flask_app._token_contracts(detected_tokens))
+        )
+
+        # Return both tokens and their live prices
+        return JSONResponse({
+            'wallet': wallet_address,
+            'block_number': snapshot["block_number"],
+            'tokens': detected_tokens,
+            'prices': token_prices
+        })
+    except Exception as e:
+        logger.error("Failed to get live prices: %s", e)
+        # Fall back to just tokens if price fetch fails
+        return JSONResponse({
+            'wallet': wallet_address,
+            'block_number': snapshot["block_number"],
+            'tokens': detected_tokens
+        })
+
+async def calculate_rebalance(request: Request):
+    try:
+        data = await request.json()
+
+        # Validate required fields with a single check
+        required_fields = ['tokens', 'target_allocation']
+        missing = [field for field in required_fields if field not in data] if data else []
+
+        if not data or missing:
+            return JSONResponse({'error': f'Missing required data: {", ".join(missing) if missing else "request body"}'}, status_code=400)
+
+        tokens = data['tokens']
+        target_allocation = data['target_allocation']
+
+        token_prices = await async_get_live_prices(
+            flask_app._rebalance_symbols(tokens), flask_app._token_contracts(tokens)
+        )
+
+        try:
+            response_data = flask_app._compute_rebalance(
+                tokens, target_allocation, token_prices, await _async_get_gas_price(),
+                **flask_app._rebalance_options(data)
+            )
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+
+        return JSONResponse(response_data)
+
+    except Exception as e:
+        logger.exception("Unhandled exception in calculate_rebalance: %s", e)
+        return JSONResponse({'error': f'An unexpected error occurred: {str(e)}'}, status_code=500)
+
+async def portfolio_agent(request: Request):
+    """Async version of app.portfolio_agent; tool calls of one turn run concurrently"""
+    try:
+        data = await request.json()
+        user_message = data.get('user_message', '')
+        wallet_address = data.get('wallet_address', '')
+
+        if not wallet_address:
+            return JSONResponse({
+                'response': "Please connect your wallet first. I need to access your token balances to analyze your portfolio."
+            })
+
+        # Streaming mode sends tokens and tool progress as Server-Sent Events
+        if data.get('stream'):
+            return StreamingResponse(
+                _async_stream_portfolio_agent(user_message, wallet_address),
+                media_type='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+
+        # Same question about the same holdings at about the same prices
+        cache_key, tool_memo, cached = await _async_prepare_agent(user_message, wallet_address)
+        if cached:
+            return JSONResponse({**cached, 'cached': True})
+
+        # Begin the conversation with the AI
+        messages, response_data = flask_app._start_agent_conversation(user_message, tool_memo)
+
+        # Process user message and manage tool calling flow
+        full_response = ""
+        tokens_used = 0
+
+        for turn in range(AGENT_MAX_TURNS):
+            turn_options = flask_app._agent_turn_options(turn, tokens_used)
+            response = await _async_openai_chat(
+                model="gpt-4-0125-preview",
+                messages=messages,
+                tools=flask_app.AGENT_TOOLS,
+                **turn_options
+            )
+            tokens_used += flask_app._usage_tokens(response.usage)
+
+            assistant_message = response.choices[0].message
+            messages.append(assistant_message)
+            full_response += assistant_message.content if assistant_message.content else ""
+
+            if not assistant_message.tool_calls or turn_options["tool_choice"] == "none":
+                # No more tool calls needed
+                break
+
+            tool_calls = assistant_message.tool_calls
+            started = _start_agent_tools(tool_calls, wallet_address, tool_memo)
+            for tool_call, (key, task) in zip(tool_calls, started):
+                function_response, elapsed, timed_out, cached = await _agent_tool_result(key, task, tool_memo)
+                _record_tool_timing(response_data, tool_call.function.name, elapsed, timed_out, cached)
+                flask_app._record_agent_tool_result(messages, response_data, tool_call, function_response, timed_out)
+
+        # When calculating portfolio, perform additional analysis
+        flask_app._add_portfolio_analysis(response_data)
+        flask_app._cache_agent_response(cache_key, full_response, response_data)
+
+        return JSONResponse({
+            'response': full_response,
+            'data': response_data
+        })
+
+    except Exception as e:
+        logger.exception("Error in portfolio_agent: %s", e)
+        return JSONResponse({
+            'response': f"An error occurred: {str(e)}. Please try again."
+        }, status_code=500)
+
+
+async def subscribe(request: Request):
+    """Async version of app.subscribe; waits on an asyncio queue instead of holding a thread"""
+    wallet_address = request.query_params.get('wallet_address')
+
+    if not wallet_address:
+        return JSONResponse({'error': 'No wallet address provided'}, status_code=400)
+
+    try:
+        wallet_address = Web3.to_checksum_address(wallet_address)
+    except:
+        return JSONResponse({'error': 'Invalid wallet address'}, status_code=400)
+
+    # The refresher publishes from its own thread
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def publish(event, data):
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    async def generate():
+        flask_app.background_refresher.subscribe(wallet_address, publish)
+        try:
+            # Sends the response headers now rather than with the first update
+            yield ": subscribed\n\n"
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(events.get(), SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                yield flask_app._sse_event(event, data)
+        finally:
+            flask_app.background_refresher.unsubscribe(wallet_address, publish)
+
+    return StreamingResponse(
+        generate(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+async_app = Starlette(
+    routes=[
+        Route('/api/detect_tokens', detect_tokens, methods=['POST']),
+        Route('/api/calculate_rebalance', calculate_rebalance, methods=['POST']),
+        Route('/api/portfolio-agent', portfolio_agent, methods=['POST']),
+        Route('/api/subscribe', subscribe, methods=['GET']),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origin_regex=".*", allow_credentials=True,
+                   allow_methods=["*"], allow_headers=["*"])
+    ],
+    on_startup=[startup],
+    on_shutdown=[shutdown]
+)
+
+# Remaining routes (index page, parse_query, cache stats) are served by the Flask app. Each
+# request runs in a worker thread; asgiref's WsgiToAsgi funnels them all through one thread
+# and fails concurrent requests with "Single thread executor already being used".
+wsgi_app = WSGIMiddleware(flask_app.app)
+
+
+async def app(scope, receive, send):
+    """ASGI entry point: `uvicorn asgi:app --port 5001`"""
+    if scope["type"] == "lifespan":
+        await async_app(scope, receive, send)
+    elif scope.get("path") in ASYNC_PATHS:
+        await _traced_async_app(scope, receive, send)
+    else:
+        # The Flask app traces its own requests
+        await wsgi_app(scope, receive, send)
+
+
+async def _traced_async_app(scope, receive, send):
+    """Runs an async route inside a request trace, adding Server-Timing to its response headers"""
+    request_trace = start_request(scope.get("method", "GET"), scope["path"])
+
+    async def send_with_timing(message):
+        if message["type"] == "http.response.start":
+            root = finish_request(request_trace[0], message["status"])
+            if SERVER_TIMING_ENABLED:
+                headers = list(message.get("headers", [])) + [(b"server-timing", server_timing(root).encode())]
+                message = {**message, "headers": headers}
+        await send(message)
+
+    try:
+        await async_app(scope, receive, send_with_timing)
+    finally:
+        end_request(request_trace)
@@ -0,0 +1,404 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+from eth_abi import decode, encode
+from web3 import Web3
+
+# Synthetic wallets encode their token count in the address: 0xb0b0 + count (8 hex) + variant (28 hex).
+# They hold tokens 0..count-1, whose contracts are 0x70ce + index (36 hex) and are shared by all wallets.
+WALLET_PREFIX = "0xb0b0"
+TOKEN_PREFIX = "0x70ce"
+
+# Block at which the fake chain starts; token i was first received by every wallet at block TRANSFER_BLOCK_BASE + i
+START_BLOCK = 5_000_000
+TRANSFER_BLOCK_BASE = 4_000_000
+
+# Largest token index the fake CoinGecko lists
+MAX_TOKENS = 1000
+
+MULTICALL3_ADDRESS = "0xca11bde05977b3631167028862be2a173976ca11"
+AGGREGATE3_SELECTOR = Web3.keccak(text="aggregate3((address,bool,bytes)[])")[:4]
+SYMBOL_SELECTOR = Web3.keccak(text="symbol()")[:4]
+NAME_SELECTOR = Web3.keccak(text="name()")[:4]
+DECIMALS_SELECTOR = Web3.keccak(text="decimals()")[:4]
+BALANCE_OF_SELECTOR = Web3.keccak(text="balanceOf(address)")[:4]
+GET_AMOUNTS_OUT_SELECTOR = Web3.keccak(text="getAmountsOut(uint256,address[])")[:4]
+GET_ETH_BALANCE_SELECTOR = Web3.keccak(text="getEthBalance(address)")[:4]
+
+
+def synthetic_wallet(token_count: int, variant: int = 0) -> str:
+    """Returns the checksum address of a synthetic wallet holding token_count tokens"""
+    return Web3.to_checksum_address(f"{WALLET_PREFIX}{token_count:08x}{variant:028x}")
+
+
+def token_address(index: int) -> str:
+    return Web3.to_checksum_address(f"{TOKEN_PREFIX}{index:036x}")
+
+
+def token_symbol(index: int) -> str:
+    return f"TK{index}"
+
+
+def token_decimals(index: int) -> int:
+    # A mix of 18- and 6-decimal tokens, like real wallets
+    return 6 if index % 4 == 3 else 18
+
+
+def token_price(index: int) -> float:
+    return round(0.5 + (index * 7919 % 1000) / 10, 2)
+
+
+def wallet_token_count(address: str) -> int:
+    """Returns how many tokens a synthetic wallet holds (0 for any other address)"""
+    address = address.lower()
+    return int(address[6:14], 16) if address.startswith(WALLET_PREFIX) else 0
+
+
+def _eth_balance(address: str) -> int:
+    return 10 ** 18 + wallet_token_count(address) * 10 ** 15
+
+
+def _token_index(address: str) -> Optional[int]:
+    address = address.lower()
+    return int(address[6:], 16) if address.startswith(TOKEN_PREFIX) else None
+
+
+class FakeService:
+    """Local HTTP stand-in for an upstream API, with injected latency and errors.
+
+    Every request sleeps latency plus up to jitter seconds; a fraction error_rate of requests
+    then fails with HTTP 503. Calls are counted per endpoint. Subclasses implement handle().
+    """
+
+    name = "service"
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._calls = Counter()
+        self._errors = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"fake-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            self._errors.clear()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Returns calls and injected errors per endpoint since the last reset()"""
+        with self._lock:
+            return {"calls": dict(self._calls), "errors": dict(self._errors)}
+
+    def handle(self, method: str, path: str, query: Dict[str, str], body: Any) -> Tuple[str, Any]:
+        """Returns (endpoint name for the call counters, JSON-serializable response or raw bytes)"""
+        raise NotImplementedError
+
+    def _respond(self, handler: BaseHTTPRequestHandler, method: str):
+        split = urlsplit(handler.path)
+        query = {key: values[-1] for key, values in parse_qs(split.query).items()}
+        length = int(handler.headers.get("Content-Length") or 0)
+        raw_body = handler.rfile.read(length) if length else b""
+        body = json.loads(raw_body) if raw_body else None
+
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+        endpoint, response = self.handle(method, split.path, query, body)
+        with self._lock:
+            self._calls[endpoint] += 1
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self._errors[endpoint] += 1
+
+        if failed:
+            status, content_type, payload = 503, "application/json", b'{"error": "injected failure"}'
+        elif isinstance(response, bytes):
+            status, content_type, payload = 200, "text/event-stream", response
+        else:
+            status, content_type, payload = 200, "application/json", json.dumps(response).encode()
+
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def _handler_class(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately; without this, delayed ACKs add ~40 ms per call
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                service._respond(self, "GET")
+
+            def do_POST(self):
+                service._respond(self, "POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class FakeJsonRpc(FakeService):
+    """Ethereum JSON-RPC node (Infura) serving synthetic wallets, their tokens and Multicall3.
+
+    A new block is mined every block_time seconds.
+    """
+
+    name = "json_rpc"
+
+    def __init__(self, block_time: float = 12.0, **kwargs):
+        super().__init__(**kwargs)
+        self.block_time = block_time
+        self._started_at = time.time()
+        self._filters = {}  # filter id -> last block reported
+
+    def block_number(self) -> int:
+        return START_BLOCK + int((time.time() - self._started_at) / self.block_time)
+
+    def handle(self, method, path, query, body):
+        if isinstance(body, list):
+            return "batch", [self._call(request) for request in body]
+        response = self._call(body)
+        name = body.get("method", "")
+        if name == "eth_call":
+            data = body["params"][0].get("data") or body["params"][0].get("input") or "0x"
+            name += ":aggregate3" if bytes.fromhex(data[2:10]) == AGGREGATE3_SELECTOR else ":single"
+        return name, response
+
+    def _call(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        method = request.get("method")
+        params = request.get("params") or []
+        try:
+            result = self._result(method, params)
+        except NotImplementedError:
+            return {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": -32601, "message": f"{method} not supported"}}
+        return {"jsonrpc": "2.0", "id": request.get("id"), "result": result}
+
+    def _result(self, method: str, params: list):
+        if method == "eth_chainId":
+            return hex(11155111)
+        if method == "eth_blockNumber":
+            return hex(self.block_number())
+        if method == "eth_gasPrice":
+            return hex(20 * 10 ** 9)
+        if method == "eth_getBalance":
+            return hex(_eth_balance(params[0]))
+        if method == "eth_getCode":
+            return "0x6080" if params[0].lower() == MULTICALL3_ADDRESS else "0x"
+        if method == "eth_newBlockFilter":
+            with self._lock:
+                filter_id = hex(len(self._filters) + 1)
+                self._filters[filter_id] = self.block_number()
+            return filter_id
+        if method == "eth_getFilterChanges":
+            with self._lock:
+                last = self._filters.get(params[0], self.block_number())
+                current = self._filters[params[0]] = self.block_number()
+            return ["0x" + f"{block:064x}" for block in range(last + 1, current + 1)]
+        if method == "eth_call":
+            to = params[0]["to"].lower()
+            data = bytes.fromhex((params[0].get("data") or params[0].get("input") or "0x")[2:])
+            if to == MULTICALL3_ADDRESS and data[:4] == AGGREGATE3_SELECTOR:
+                calls = decode(["(address,bool,bytes)[]"], data[4:])[0]
+                results = [self._contract_call(target, call_data) for target, _, call_data in calls]
+                return "0x" + encode(["(bool,bytes)[]"], [results]).hex()
+            success, return_data = self._contract_call(to, data)
+            if not success:
+                raise NotImplementedError
+            return "0x" + return_data.hex()
+        raise NotImplementedError
+
+    @staticmethod
+    def _contract_call(target: str, data: bytes) -> Tuple[bool, bytes]:
+        """Answers an ERC-20 read on a synthetic token, a router getAmountsOut or Multicall3 getEthBalance"""
+        selector = data[:4]
+        if selector == GET_ETH_BALANCE_SELECTOR and target.lower() == MULTICALL3_ADDRESS:
+            return True, encode(["uint256"], [_eth_balance("0x" + data[16:36].hex())])
+        if selector == GET_AMOUNTS_OUT_SELECTOR:
+            amount_in, path = decode(["uint256", "address[]"], data[4:])
+            amounts = [amount_in]
+            for _ in path[1:]:
+                amounts.append(amounts[-1] * 997 // 1000)
+            return True, encode(["uint256[]"], [amounts])
+
+        index = _token_index(target)
+        if index is None:
+            return False, b""
+        if selector == SYMBOL_SELECTOR:
+            return True, encode(["string"], [token_symbol(index)])
+        if selector == NAME_SELECTOR:
+            return True, encode(["string"], [f"Token {index}"])
+        if selector == DECIMALS_SELECTOR:
+            return True, encode(["uint8"], [token_decimals(index)])
+        if selector == BALANCE_OF_SELECTOR:
+            holder = "0x" + data[16:36].hex()
+            held = index < wallet_token_count(holder)
+            return True, encode(["uint256"], [(index + 1) * 10 ** token_decimals(index) if held else 0])
+        return False, b""
+
+
+class FakeEtherscan(FakeService):
+    """Etherscan account API (tokentx and tokenlist) for synthetic wallets"""
+
+    name = "etherscan"
+
+    def handle(self, method, path, query, body):
+        action = query.get("action", "")
+        count = wallet_token_count(query.get("address", ""))
+
+        if action == "tokenlist":
+            return action, {"status": "1", "message": "OK", "result": [
+                {"contractAddress": token_address(i).lower(), "symbol": token_symbol(i)} for i in range(count)
+            ]}
+
+        if action == "tokentx":
+            start_block = int(query.get("startblock", 0))
+            page = int(query.get("page", 1))
+            offset = int(query.get("offset", 1000))
+            transfers = [
+                {"blockNumber": str(TRANSFER_BLOCK_BASE + i), "contractAddress": token_address(i).lower(),
+                 "tokenSymbol": token_symbol(i), "to": query.get("address", "").lower()}
+                for i in range(count) if TRANSFER_BLOCK_BASE + i >= start_block
+            ][(page - 1) * offset:page * offset]
+            if not transfers:
+                return action, {"status": "0", "message": "No transactions found", "result": []}
+            return action, {"status": "1", "message": "OK", "result": transfers}
+
+        return action or "unknown", {"status": "0", "message": "NOTOK", "result": f"Unsupported action {action}"}
+
+
+class FakeCoinGecko(FakeService):
+    """CoinGecko API: coins/list, simple/price, search and search/trending"""
+
+    name = "coingecko"
+
+    def handle(self, method, path, query, body):
+        endpoint = path.split("/api/v3/", 1)[-1]
+
+        if endpoint == "coins/list":
+            coins = [{"id": "ethereum", "symbol": "eth", "name": "Ethereum", "platforms": {}}]
+            coins += [
+                {"id": f"fake-token-{i}", "symbol": token_symbol(i).lower(), "name": f"Token {i}",
+                 "platforms": {"ethereum": token_address(i).lower()}}
+                for i in range(MAX_TOKENS)
+            ]
+            return endpoint, coins
+
+        if endpoint == "simple/price":
+            prices = {}
+            for coin_id in filter(None, query.get("ids", "").split(",")):
+                if coin_id.startswith("fake-token-"):
+                    prices[coin_id] = {"usd": token_price(int(coin_id.rsplit("-", 1)[1]))}
+                else:
+                    prices[coin_id] = {"usd": 3500.0}
+            return endpoint, prices
+
+        if endpoint == "search":
+            symbol = query.get("query", "").upper()
+            if symbol.startswith("TK") and symbol[2:].isdigit():
+                return endpoint, {"coins": [{"id": f"fake-token-{int(symbol[2:])}"}]}
+            return endpoint, {"coins": []}
+
+        if endpoint == "search/trending":
+            return endpoint, {"coins": [
+                {"item": {"id": f"fake-token-{i}", "symbol": token_symbol(i), "name": f"Token {i}",
+                          "market_cap_rank": i + 1, "price_btc": 0.0001}}
+                for i in range(10)
+            ]}
+
+        return endpoint, {"error": "not found"}
+
+
+class FakeOpenAI(FakeService):
+    """OpenAI chat completions: allocation parsing, and an agent that calls tools once then answers"""
+
+    name = "openai"
+
+    def handle(self, method, path, query, body):
+        messages = body.get("messages", [])
+        if body.get("tools") and not any(message.get("role") == "tool" for message in messages):
+            message = {"role": "assistant", "content": None, "tool_calls": [
+                {"id": "call_0", "type": "function", "function": {"name": "get_wallet_tokens", "arguments": "{}"}},
+                {"id": "call_1", "type": "function",
+                 "function": {"name": "get_live_prices", "arguments": json.dumps({"symbols": ["ETH", "TK0"]})}}
+            ]}
+        elif body.get("tools"):
+            message = {"role": "assistant", "content": "Your portfolio is concentrated in ETH; consider diversifying."}
+        else:
+            message = {"role": "assistant", "content": json.dumps({"ETH": 60, "TK0": 40})}
+
+        endpoint = "chat/completions" + (":stream" if body.get("stream") else "")
+        if body.get("stream"):
+            return endpoint, self._stream(body, message)
+        return endpoint, {
+            "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+            "choices": [{"index": 0, "message": message,
+                         "finish_reason": "tool_calls" if message.get("tool_calls") else "stop"}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}
+        }
+
+    @staticmethod
+    def _stream(body: Dict[str, Any], message: Dict[str, Any]) -> bytes:
+        """Encodes the message as chat.completion.chunk Server-Sent Events"""
+        deltas: List[Dict[str, Any]] = [{"role": "assistant"}]
+        if message.get("tool_calls"):
+            deltas += [{"tool_calls": [{"index": i, **tool_call}]} for i, tool_call in enumerate(message["tool_calls"])]
+        else:
+            deltas += [{"content": word + " "} for word in message["content"].split(" ")]
+
+        events = []
+        for i, delta in enumerate(deltas + [{}]):
+            finish_reason = None if i < len(deltas) else ("tool_calls" if message.get("tool_calls") else "stop")
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body.get("model"), "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            events.append(f"data: {json.dumps(chunk)}\n\n")
+        if (body.get("stream_options") or {}).get("include_usage"):
+            usage = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body.get("model"), "choices": [],
+                     "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}}
+            events.append(f"data: {json.dumps(usage)}\n\n")
+        events.append("data: [DONE]\n\n")
+        return "".join(events).encode()
+
+
+def start_fake_services(latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                        block_time: float = 12.0) -> Dict[str, FakeService]:
+    """Starts one of each fake upstream with the same latency and error settings"""
+    settings = {"latency": latency, "jitter": jitter, "error_rate": error_rate}
+    services = {
+        "json_rpc": FakeJsonRpc(block_time=block_time, **settings),
+        "etherscan": FakeEtherscan(**settings),
+        "coingecko": FakeCoinGecko(**settings),
+        "openai": FakeOpenAI(**settings),
+    }
+    for service in services.values():
+        service.start()
+    return services
@@ -0,0 +1,311 @@
+"""Benchmarks the API endpoints against local stand-ins for Infura, Etherscan, CoinGecko and OpenAI.
+
+    python benchmarks/run.py --tokens 1,10,100,1000 --latency-ms 50 --baseline benchmarks/results/<earlier>.json
+
+Starts the fake upstreams, runs the app (Flask or ASGI) in a subprocess pointed at them, drives
+each scenario and reports p50/p95/p99 latency, requests per second and upstream calls. Results are
+written as JSON to benchmarks/results; with --baseline, scenarios are compared against an earlier
+run and the exit code is 1 if any p95 regressed by more than --threshold.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+import requests
+from fake_services import synthetic_wallet, start_fake_services, token_decimals, token_symbol
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+
+# Allocation queries for /api/parse_query: the rule-based parser handles the first two,
+# the others go to (fake) OpenAI
+PARSE_QUERIES = [
+    "50% ETH 50% TK0",
+    "60/40 ETH/TK0",
+    "I'm bullish on ETH, make it most of the portfolio and keep a little TK0",
+    "Something conservative, mostly TK0 with some ETH exposure",
+]
+
+
+# Wallet variants not used by any earlier request, so "cold" requests never hit the app's caches
+_fresh_variants = itertools.count(1)
+
+
+class Scenario:
+    """One endpoint driven with requests built by body(i) for i in range(requests)"""
+
+    def __init__(self, name: str, path: str, body: Callable[[int], Dict[str, Any]], tokens: Optional[int] = None,
+                 warmup: int = 0):
+        self.name = name
+        self.path = path
+        self.body = body
+        self.tokens = tokens
+        self.warmup = warmup
+
+
+def _synthetic_tokens(token_count: int) -> Dict[str, Dict[str, Any]]:
+    """A calculate_rebalance tokens payload matching a synthetic wallet"""
+    tokens = {"ETH": {"balance": 1.0, "raw_balance": str(10 ** 18), "decimals": 18, "coingecko_id": None}}
+    for i in range(token_count):
+        decimals = token_decimals(i)
+        tokens[token_symbol(i)] = {
+            "balance": float(i + 1), "raw_balance": str((i + 1) * 10 ** decimals), "decimals": decimals, "coingecko_id": None
+        }
+    return tokens
+
+
+def build_scenarios(token_counts: List[int], endpoints: List[str]) -> List[Scenario]:
+    scenarios = []
+    for count in token_counts:
+        if "detect_tokens" in endpoints:
+            # Cold: a new wallet every request; warm: the same wallet, served from the snapshot cache
+            scenarios.append(Scenario(
+                f"detect_tokens cold {count} tokens", "/api/detect_tokens",
+                lambda i, count=count: {"wallet_address": synthetic_wallet(count, next(_fresh_variants))}, count
+            ))
+            scenarios.append(Scenario(
+                f"detect_tokens warm {count} tokens", "/api/detect_tokens",
+                lambda i, count=count: {"wallet_address": synthetic_wallet(count, 0)}, count, warmup=1
+            ))
+        if "calculate_rebalance" in endpoints:
+            tokens = _synthetic_tokens(count)
+            target_allocation = {symbol: 100 / len(tokens) for symbol in tokens}
+            scenarios.append(Scenario(
+                f"calculate_rebalance {count} tokens", "/api/calculate_rebalance",
+                lambda i, tokens=tokens, target_allocation=target_allocation: {
+                    "tokens": tokens, "target_allocation": target_allocation
+                }, count
+            ))
+        if "portfolio_agent" in endpoints:
+            scenarios.append(Scenario(
+                f"portfolio_agent {count} tokens", "/api/portfolio-agent",
+                lambda i, count=count: {
+                    "user_message": "How is my portfolio doing?",
+                    "wallet_address": synthetic_wallet(count, next(_fresh_variants))
+                }, count
+            ))
+    if "parse_query" in endpoints:
+        scenarios.append(Scenario(
+            "parse_query", "/api/parse_query",
+            lambda i: {"query": PARSE_QUERIES[i % len(PARSE_QUERIES)], "symbols": ["ETH", "TK0"]}
+        ))
+    return scenarios
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_app(server: str, services: Dict[str, Any], workdir: str, workers: int) -> tuple:
+    """Runs the app in a subprocess configured to use the fake upstreams; returns (process, url, log path)"""
+    port = _free_port()
+    env = dict(
+        os.environ,
+        INFURA_URL=services["json_rpc"].url,
+        ETHERSCAN_API_URL=f"{services['etherscan'].url}/api",
+        ETHERSCAN_API_KEY="benchmark",
+        COINGECKO_API_URL=f"{services['coingecko'].url}/api/v3",
+        OPENAI_BASE_URL=f"{services['openai'].url}/v1",
+        OPENAI_API_KEY="benchmark",
+        TOKEN_CACHE_PATH=os.path.join(workdir, "token_metadata.db"),
+        COINGECKO_INDEX_PATH=os.path.join(workdir, "coingecko_index.json"),
+        WALLET_INDEX_PATH=os.path.join(workdir, "wallet_index.db"),
+    )
+    if server == "asgi":
+        command = [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port),
+                   "--workers", str(workers), "--log-level", "warning"]
+    else:
+        command = [sys.executable, "-m", "flask", "--app", "app", "run", "--host", "127.0.0.1", "--port", str(port),
+                   "--with-threads"]
+
+    log_path = os.path.join(workdir, "app.log")
+    log = open(log_path, "w")
+    process = subprocess.Popen(command, cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited with code {process.returncode}, see {log_path}")
+        try:
+            if requests.get(url + "/", timeout=1).status_code == 200:
+                return process, url, log_path
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"App did not start within 60 seconds, see {log_path}")
+
+
+def run_scenario(url: str, scenario: Scenario, requests_count: int, concurrency: int,
+                 services: Dict[str, Any]) -> Dict[str, Any]:
+    """Sends the scenario's requests with concurrency workers and summarizes latency and upstream calls"""
+    local = threading.local()
+
+    def send(i: int) -> tuple:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            response = local.session.post(url + scenario.path, json=scenario.body(i), timeout=120)
+            ok = response.status_code == 200 and "error" not in response.json()
+        except (requests.RequestException, ValueError):
+            ok = False
+        return time.perf_counter() - started, ok
+
+    for i in range(scenario.warmup):
+        send(i)
+    for service in services.values():
+        service.reset()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(requests_count)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency * 1000 for latency, _ in results)
+    upstream = {name: service.stats() for name, service in services.items()}
+    upstream_calls = sum(sum(stats["calls"].values()) for stats in upstream.values())
+    return {
+        "name": scenario.name,
+        "path": scenario.path,
+        "tokens": scenario.tokens,
+        "requests": requests_count,
+        "concurrency": concurrency,
+        "errors": sum(1 for _, ok in results if not ok),
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "mean": sum(latencies) / len(latencies),
+            "max": latencies[-1],
+        },
+        "requests_per_second": requests_count / elapsed,
+        "upstream_calls": upstream_calls,
+        "upstream_calls_per_request": upstream_calls / requests_count,
+        "upstream": upstream,
+    }
+
+
+def print_results(results: List[Dict[str, Any]]):
+    print(f"\n{'scenario':<36} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'errors':>7} {'upstream/req':>13}")
+    for result in results:
+        latency = result["latency_ms"]
+        print(f"{result['name']:<36} {latency['p50']:>9.1f} {latency['p95']:>9.1f} {latency['p99']:>9.1f} "
+              f"{result['requests_per_second']:>8.1f} {result['errors']:>7} {result['upstream_calls_per_request']:>13.1f}")
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str, threshold: float) -> bool:
+    """Prints changes against a baseline run; returns True if any scenario's p95 regressed beyond threshold"""
+    with open(baseline_path) as f:
+        baseline = {result["name"]: result for result in json.load(f)["scenarios"]}
+
+    regressed = False
+    print(f"\nCompared with {baseline_path}:")
+    print(f"{'scenario':<36} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>8}")
+    for result in results:
+        before = baseline.get(result["name"])
+        if before is None:
+            print(f"{result['name']:<36} (not in baseline)")
+            continue
+
+        def change(after: float, previous: float) -> float:
+            return (after - previous) / previous if previous else 0.0
+
+        p95_change = change(result["latency_ms"]["p95"], before["latency_ms"]["p95"])
+        flag = "  REGRESSION" if p95_change > threshold else ""
+        regressed = regressed or bool(flag)
+        print(f"{result['name']:<36} "
+              f"{change(result['latency_ms']['p50'], before['latency_ms']['p50']):>+8.0%} {p95_change:>+8.0%} "
+              f"{change(result['latency_ms']['p99'], before['latency_ms']['p99']):>+8.0%} "
+              f"{change(result['requests_per_second'], before['requests_per_second']):>+8.0%}{flag}")
+    return regressed
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--server", choices=["flask", "asgi"], default="flask")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers (asgi only)")
+    parser.add_argument("--tokens", default="1,10,100,1000", help="comma-separated synthetic wallet sizes")
+    parser.add_argument("--endpoints", default="detect_tokens,calculate_rebalance,parse_query,portfolio_agent")
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=20, help="base latency of every fake upstream")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="extra random latency up to this much")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream calls failing with 503")
+    parser.add_argument("--block-time", type=float, default=12.0, help="seconds between fake blocks")
+    parser.add_argument("--output", help=f"results file (default: {RESULTS_DIR}/<timestamp>-<server>.json)")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="p95 increase counted as a regression")
+    args = parser.parse_args()
+
+    token_counts = [int(count) for count in args.tokens.split(",") if count]
+    scenarios = build_scenarios(token_counts, args.endpoints.split(","))
+
+    services = start_fake_services(args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate, args.block_time)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        process, url, log_path = start_app(args.server, services, workdir, args.workers)
+        try:
+            for scenario in scenarios:
+                print(f"Running {scenario.name}...")
+                results.append(run_scenario(url, scenario, args.requests, args.concurrency, services))
+        finally:
+            process.terminate()
+            process.wait()
+            for service in services.values():
+                service.stop()
+
+    print_results(results)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{args.server}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "meta": {
+                "timestamp": time.time(),
+                "commit": _git_commit(),
+                "server": args.server,
+                "workers": args.workers,
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "latency_ms": args.latency_ms,
+                "jitter_ms": args.jitter_ms,
+                "error_rate": args.error_rate,
+            },
+            "scenarios": results
+        }, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.baseline and compare(results, args.baseline, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
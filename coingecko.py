@@ -0,0 +1,270 @@
+import os
+import json
+import logging
+import threading
+import time
+from typing import List, Dict, Optional
+from http_client import http_session
+from tracing import register_service
+
+logger = logging.getLogger(__name__)
+
+COINGECKO_API_URL = os.getenv("COINGECKO_API_URL", "https://api.coingecko.com/api/v3")
+register_service("coingecko", COINGECKO_API_URL)
+
+# Local symbol/contract -> CoinGecko id index built from /coins/list
+COINGECKO_INDEX_PATH = os.getenv("COINGECKO_INDEX_PATH", "coingecko_index.json")
+COINGECKO_INDEX_MAX_AGE = float(os.getenv("COINGECKO_INDEX_MAX_AGE", str(24 * 60 * 60)))
+COINGECKO_PLATFORM = os.getenv("COINGECKO_PLATFORM", "ethereum")
+# Seconds before retrying a failed index build, doubling on each failure up to the max age
+COINGECKO_INDEX_RETRY_INTERVAL = float(os.getenv("COINGECKO_INDEX_RETRY_INTERVAL", "60"))
+
+# Seconds between background refreshes of the trending coins snapshot, and how many coins it keeps
+TRENDING_REFRESH_INTERVAL = float(os.getenv("TRENDING_REFRESH_INTERVAL", "300"))
+TRENDING_LIMIT = 10
+
+# Keep request URLs comfortably below common proxy/server limits
+MAX_URL_LENGTH = 2000
+
+
+def chunk_ids_by_url_length(coingecko_ids: List[str], base_url: str, max_length: int = MAX_URL_LENGTH) -> List[List[str]]:
+    """Splits ids into groups whose comma-separated ids= URL stays under max_length"""
+    chunks = []
+    current = []
+    current_length = len(base_url)
+
+    for coingecko_id in coingecko_ids:
+        # +1 for the comma separating it from the previous id
+        added_length = len(coingecko_id) + (1 if current else 0)
+        if current and current_length + added_length > max_length:
+            chunks.append(current)
+            current = []
+            current_length = len(base_url)
+            added_length = len(coingecko_id)
+        current.append(coingecko_id)
+        current_length += added_length
+
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def fetch_simple_prices(coingecko_ids: List[str]) -> Dict[str, float]:
+    """Fetches USD prices for many CoinGecko ids using bulk simple/price requests.
+
+    Returns a dict of id -> USD price; ids CoinGecko has no price for are left out.
+    """
+    prices = {}
+    unique_ids = list(dict.fromkeys(coingecko_ids))
+    base_url = f"{COINGECKO_API_URL}/simple/price?vs_currencies=usd&ids="
+
+    for chunk in chunk_ids_by_url_length(unique_ids, base_url):
+        try:
+            response = http_session.get(base_url + ",".join(chunk)).json()
+            for coingecko_id in chunk:
+                if coingecko_id in response and "usd" in response[coingecko_id]:
+                    prices[coingecko_id] = response[coingecko_id]["usd"]
+        except Exception as e:
+            logger.error("Error fetching bulk prices from CoinGecko: %s", e)
+
+    return prices
+
+
+def search_coin_id(symbol: str) -> Optional[str]:
+    """Looks up a CoinGecko id for a symbol via the search endpoint (first hit)"""
+    try:
+        search_results = http_session.get(f"{COINGECKO_API_URL}/search?query={symbol}").json()
+        if search_results.get("coins"):
+            return search_results["coins"][0]["id"]
+    except Exception as e:
+        logger.error("Error searching CoinGecko for %s: %s", symbol, e)
+    return None
+
+
+class CoinGeckoIndex:
+    """Local index of CoinGecko ids by symbol and by contract address per platform.
+
+    Built from /coins/list?include_platform=true and persisted as JSON. The file is loaded
+    lazily in a background thread and refreshed when older than max_age, so lookups never
+    wait on the network. A failed build is retried after retry_interval seconds, backing off.
+    """
+
+    def __init__(self, path: str = COINGECKO_INDEX_PATH, max_age: float = COINGECKO_INDEX_MAX_AGE,
+                 platform: str = COINGECKO_PLATFORM, retry_interval: float = COINGECKO_INDEX_RETRY_INTERVAL):
+        self.path = path
+        self.max_age = max_age
+        self.platform = platform
+        self.retry_interval = retry_interval
+        self.fetched_at = 0.0
+        self._symbol_ids = {}  # lowercase symbol -> id
+        self._platform_ids = {}  # platform -> {lowercase contract address -> id}
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self._symbol_ids)
+
+    def load(self) -> bool:
+        """Loads the index from disk, returning False if there is no usable file"""
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        with self._lock:
+            self.fetched_at = stored.get("fetched_at", 0.0)
+            self._symbol_ids = stored.get("symbols", {})
+            self._platform_ids = stored.get("platforms", {})
+        logger.info("Loaded CoinGecko index with %s symbols", len(self._symbol_ids))
+        return True
+
+    def refresh(self) -> bool:
+        """Rebuilds the index from /coins/list and persists it; concurrent calls are skipped.
+
+        Returns whether this call rebuilt the index.
+        """
+        with self._lock:
+            if self._refreshing:
+                return False
+            self._refreshing = True
+
+        try:
+            coins = http_session.get(f"{COINGECKO_API_URL}/coins/list?include_platform=true").json()
+            if not isinstance(coins, list):
+                logger.error("Error refreshing CoinGecko index: unexpected response %s", str(coins)[:200])
+                return False
+
+            symbol_ids = {}
+            symbol_ranks = {}
+            platform_ids = {}
+            for coin in coins:
+                coin_id = coin.get("id")
+                symbol = (coin.get("symbol") or "").lower()
+                platforms = coin.get("platforms") or {}
+                if not coin_id:
+                    continue
+
+                for platform, address in platforms.items():
+                    if platform and address:
+                        platform_ids.setdefault(platform, {})[address.lower()] = coin_id
+
+                # Many coins share a symbol. Prefer an id equal to the symbol (e.g. "weth"),
+                # then a coin deployed on our platform, then the first one listed.
+                if symbol:
+                    rank = 2 if coin_id == symbol else 1 if platforms.get(self.platform) else 0
+                    if symbol not in symbol_ids or rank > symbol_ranks[symbol]:
+                        symbol_ids[symbol] = coin_id
+                        symbol_ranks[symbol] = rank
+
+            fetched_at = time.time()
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"fetched_at": fetched_at, "symbols": symbol_ids, "platforms": platform_ids}, f)
+            os.replace(tmp_path, self.path)
+
+            with self._lock:
+                self.fetched_at = fetched_at
+                self._symbol_ids = symbol_ids
+                self._platform_ids = platform_ids
+            logger.info("Refreshed CoinGecko index with %s symbols", len(symbol_ids))
+            return True
+        except Exception as e:
+            logger.error("Error refreshing CoinGecko index: %s", e)
+            return False
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def start_background_refresh(self):
+        """Loads the index in a background thread and rebuilds it whenever it is older than max_age"""
+        def run():
+            self.load()
+            retry_interval = self.retry_interval
+            while True:
+                age = time.time() - self.fetched_at
+                if age < self.max_age:
+                    time.sleep(self.max_age - age)
+                if self.refresh():
+                    retry_interval = self.retry_interval
+                else:
+                    time.sleep(retry_interval)
+                    retry_interval = min(retry_interval * 2, self.max_age)
+        threading.Thread(target=run, daemon=True).start()
+
+    def resolve_contract(self, address: str, platform: Optional[str] = None) -> Optional[str]:
+        """Returns the CoinGecko id for a contract address on a platform"""
+        return self._platform_ids.get(platform or self.platform, {}).get(address.lower())
+
+    def resolve(self, symbol: str, address: Optional[str] = None) -> Optional[str]:
+        """Returns the CoinGecko id for a symbol, preferring the contract address it was read from"""
+        if address:
+            coin_id = self.resolve_contract(address)
+            if coin_id:
+                return coin_id
+        return self._symbol_ids.get(symbol.lower())
+
+
+def fetch_trending(limit: int = TRENDING_LIMIT) -> List[Dict]:
+    """Fetches the top trending coins from search/trending, priced with one bulk simple/price call"""
+    response = http_session.get(f"{COINGECKO_API_URL}/search/trending").json()
+    coins = [item["item"] for item in response.get("coins", [])[:limit]]
+    prices = fetch_simple_prices([coin["id"] for coin in coins if coin.get("id")])
+
+    return [{
+        "symbol": coin["symbol"],
+        "name": coin["name"],
+        "market_cap_rank": coin.get("market_cap_rank"),
+        "price_btc": coin.get("price_btc", 0),
+        "price_usd": prices.get(coin.get("id"), 0)
+    } for coin in coins]
+
+
+class TrendingFeed:
+    """In-memory snapshot of trending coins with USD prices, refreshed by a background thread.
+
+    start_background_refresh() fetches the first snapshot in its thread, so get() only ever reads
+    memory; until that fetch succeeds it returns no tokens. Each snapshot reports its age, since
+    it can be up to interval seconds old.
+    """
+
+    def __init__(self, interval: float = TRENDING_REFRESH_INTERVAL, limit: int = TRENDING_LIMIT):
+        self.interval = interval
+        self.limit = limit
+        self.fetched_at = 0.0
+        self._tokens = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def refresh(self):
+        """Replaces the snapshot with freshly fetched trending coins, keeping the old one on errors"""
+        try:
+            tokens = fetch_trending(self.limit)
+        except Exception as e:
+            logger.error("Error refreshing trending tokens: %s", e)
+            return
+        with self._lock:
+            self._tokens = tokens
+            self.fetched_at = time.time()
+
+    def start_background_refresh(self):
+        """Starts the thread fetching the snapshot now and then every interval seconds, once"""
+        def run():
+            while True:
+                self.refresh()
+                time.sleep(self.interval)
+
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=run, name="trending-refresh", daemon=True)
+            self._thread.start()
+
+    def get(self) -> Dict:
+        """Returns {"tokens": [...], "age_seconds": seconds since the snapshot was fetched, or None}"""
+        with self._lock:
+            return {
+                "tokens": self._tokens,
+                "age_seconds": round(time.time() - self.fetched_at, 1) if self.fetched_at else None
+            }
@@ -0,0 +1,315 @@
+import os
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Dict, Any, AsyncIterator, Iterator, Optional, Tuple
+from web3 import Web3
+from http_client import http_session
+from tracing import register_service, submit
+
+logger = logging.getLogger(__name__)
+
+ETHERSCAN_API_URL = os.getenv("ETHERSCAN_API_URL", "https://api-sepolia.etherscan.io/api")  # Sepolia endpoint
+register_service("etherscan", ETHERSCAN_API_URL)
+
+# tokentx is read in pages of ETHERSCAN_PAGE_SIZE rows; Etherscan caps page * offset at 10,000
+ETHERSCAN_PAGE_SIZE = int(os.getenv("ETHERSCAN_PAGE_SIZE", "1000"))
+ETHERSCAN_MAX_RESULTS = 10000
+
+# SQLite file recording each wallet's known token contracts and last scanned block
+WALLET_INDEX_PATH = os.getenv("WALLET_INDEX_PATH", "wallet_index.db")
+
+# Shared pool for fanning out independent Etherscan queries
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("ETHERSCAN_MAX_WORKERS", "8")),
+                               thread_name_prefix="etherscan")
+
+
+def _tokentx_params(wallet_address: str, api_key: str, start_block: int, page: int) -> Dict[str, Any]:
+    return {
+        "module": "account",
+        "action": "tokentx",
+        "address": wallet_address,
+        "startblock": start_block,
+        "page": page,
+        "offset": ETHERSCAN_PAGE_SIZE,
+        "sort": "asc",
+        "apikey": api_key
+    }
+
+
+def _tokenlist_params(wallet_address: str, api_key: str) -> Dict[str, Any]:
+    return {
+        "module": "account",
+        "action": "tokenlist",
+        "address": wallet_address,
+        "apikey": api_key
+    }
+
+
+def _parse_tokentx_page(response: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Returns the transfers in a tokentx page; an empty list means there are no more"""
+    if response.get('status') == '1' and isinstance(response.get('result'), list):
+        return response['result']
+
+    # status "0" with an empty result means there are no (more) transactions
+    if response.get('result') == [] or response.get('message') == "No transactions found":
+        return []
+    raise Exception(f"Etherscan tokentx error: {response.get('message')} {response.get('result')}")
+
+
+def _parse_tokenlist(response: Dict[str, Any]) -> List[str]:
+    """Returns the checksum token contracts in a tokenlist response"""
+    token_addresses = []
+    if response.get('status') == '1' and isinstance(response.get('result'), list):
+        for token_data in response['result']:
+            try:
+                if token_data.get('contractAddress'):
+                    token_addresses.append(Web3.to_checksum_address(token_data['contractAddress']))
+            except Exception as e:
+                logger.error("Error processing tokenlist data: %s", e)
+    return token_addresses
+
+
+def iter_token_transfers(wallet_address: str, api_key: str, start_block: int = 0) -> Iterator[Dict[str, Any]]:
+    """Streams the wallet's ERC-20 transfers from start_block onwards, oldest first.
+
+    Rows are read one tokentx page at a time. When Etherscan's 10,000 row window is
+    exhausted the scan restarts from the last block seen, so rows of that block may repeat.
+    """
+    while True:
+        page = 1
+        last_block = None
+        while page * ETHERSCAN_PAGE_SIZE <= ETHERSCAN_MAX_RESULTS:
+            response = http_session.get(
+                ETHERSCAN_API_URL, params=_tokentx_params(wallet_address, api_key, start_block, page)
+            ).json()
+            transfers = _parse_tokentx_page(response)
+            yield from transfers
+
+            if len(transfers) < ETHERSCAN_PAGE_SIZE:
+                return
+            last_block = int(transfers[-1]['blockNumber'])
+            page += 1
+
+        # Stop if a single block fills the whole window, as we could not make progress
+        if last_block is None or last_block <= start_block:
+            return
+        start_block = last_block
+
+
+async def aiter_token_transfers(client, wallet_address: str, api_key: str,
+                                start_block: int = 0) -> AsyncIterator[Dict[str, Any]]:
+    """Async version of iter_token_transfers() using an httpx.AsyncClient"""
+    while True:
+        page = 1
+        last_block = None
+        while page * ETHERSCAN_PAGE_SIZE <= ETHERSCAN_MAX_RESULTS:
+            response = (await client.get(
+                ETHERSCAN_API_URL, params=_tokentx_params(wallet_address, api_key, start_block, page)
+            )).json()
+            transfers = _parse_tokentx_page(response)
+            for tx in transfers:
+                yield tx
+
+            if len(transfers) < ETHERSCAN_PAGE_SIZE:
+                return
+            last_block = int(transfers[-1]['blockNumber'])
+            page += 1
+
+        if last_block is None or last_block <= start_block:
+            return
+        start_block = last_block
+
+
+def _add_transfer(tx: Dict[str, Any], token_addresses: Dict[str, None], highest_block: int) -> int:
+    """Records a transfer's token contract and returns the new highest block seen"""
+    if tx.get('contractAddress'):
+        token_addresses.setdefault(Web3.to_checksum_address(tx['contractAddress']), None)
+    return max(highest_block, int(tx.get('blockNumber', 0)))
+
+
+def _collect_tokentx_addresses(wallet_address: str, api_key: str, start_block: int = 0) -> Tuple[List[str], int]:
+    """Returns unique token contracts seen in transfers from start_block and the highest block seen"""
+    token_addresses = {}
+    transfer_count = 0
+    highest_block = start_block - 1
+    for tx in iter_token_transfers(wallet_address, api_key, start_block):
+        transfer_count += 1
+        highest_block = _add_transfer(tx, token_addresses, highest_block)
+    logger.debug("Found %s token transactions since block %s", transfer_count, start_block)
+    return list(token_addresses), highest_block
+
+
+async def _async_collect_tokentx_addresses(client, wallet_address: str, api_key: str,
+                                           start_block: int = 0) -> Tuple[List[str], int]:
+    """Async version of _collect_tokentx_addresses()"""
+    token_addresses = {}
+    transfer_count = 0
+    highest_block = start_block - 1
+    async for tx in aiter_token_transfers(client, wallet_address, api_key, start_block):
+        transfer_count += 1
+        highest_block = _add_transfer(tx, token_addresses, highest_block)
+    logger.debug("Found %s token transactions since block %s", transfer_count, start_block)
+    return list(token_addresses), highest_block
+
+
+def _collect_tokenlist_addresses(wallet_address: str, api_key: str) -> List[str]:
+    """Returns the token contracts reported by the tokenlist endpoint"""
+    return _parse_tokenlist(http_session.get(ETHERSCAN_API_URL, params=_tokenlist_params(wallet_address, api_key)).json())
+
+
+async def _async_collect_tokenlist_addresses(client, wallet_address: str, api_key: str) -> List[str]:
+    """Async version of _collect_tokenlist_addresses()"""
+    return _parse_tokenlist((await client.get(ETHERSCAN_API_URL, params=_tokenlist_params(wallet_address, api_key))).json())
+
+
+class WalletDiscoveryIndex:
+    """Per-wallet record of known token contracts and the highest block already scanned.
+
+    Kept in memory and persisted to SQLite so later scans only ask Etherscan for
+    transfers after last_block.
+    """
+
+    def __init__(self, path: str = WALLET_INDEX_PATH):
+        self.path = path
+        self._wallets = {}  # wallet -> (last_block, [token addresses])
+        self._lock = threading.Lock()
+
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS wallet_discovery ("
+                "wallet TEXT PRIMARY KEY, "
+                "last_block INTEGER NOT NULL, "
+                "token_addresses TEXT NOT NULL)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        """Opens a short-lived connection that commits on success and is always closed"""
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, wallet_address: str) -> Optional[Tuple[int, List[str]]]:
+        """Returns (last scanned block, known token addresses) or None if never scanned"""
+        with self._lock:
+            if wallet_address in self._wallets:
+                last_block, token_addresses = self._wallets[wallet_address]
+                return last_block, list(token_addresses)
+
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT last_block, token_addresses FROM wallet_discovery WHERE wallet = ?",
+                    (wallet_address,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.error("Error reading wallet discovery index: %s", e)
+            return None
+
+        if row is None:
+            return None
+        entry = (row[0], json.loads(row[1]))
+        with self._lock:
+            self._wallets.setdefault(wallet_address, entry)
+        return entry[0], list(entry[1])
+
+    def update(self, wallet_address: str, last_block: int, new_token_addresses: List[str]):
+        """Merges newly discovered tokens and advances the scanned block (never backwards)"""
+        with self._lock:
+            previous_block, token_addresses = self._wallets.get(wallet_address, (-1, []))
+            merged = list(dict.fromkeys(token_addresses + new_token_addresses))
+            entry = (max(previous_block, last_block), merged)
+            self._wallets[wallet_address] = entry
+
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO wallet_discovery (wallet, last_block, token_addresses) "
+                    "VALUES (?, ?, ?)",
+                    (wallet_address, entry[0], json.dumps(entry[1]))
+                )
+        except sqlite3.Error as e:
+            logger.error("Error writing wallet discovery index: %s", e)
+
+
+def _merge_discovery(wallet_address: str, discovery_index, known, tokentx_result, tokenlist_result) -> List[str]:
+    """Merges scan results into the known token list and advances the discovery index.
+
+    tokentx_result is (addresses, highest_block) or the exception the scan raised;
+    tokenlist_result is a list of addresses, an exception, or None when not queried.
+    """
+    # dict keys give O(1) dedup while keeping earlier sources ahead of later ones
+    token_addresses = dict.fromkeys(known[1] if known else [])
+    new_token_addresses = {}
+
+    scan_complete = not isinstance(tokentx_result, BaseException)
+    if scan_complete:
+        tokentx_addresses, highest_block = tokentx_result
+        for token_address in tokentx_addresses:
+            new_token_addresses.setdefault(token_address, None)
+    else:
+        logger.error("Error fetching tokentx data from Etherscan: %s", tokentx_result)
+
+    if isinstance(tokenlist_result, BaseException):
+        logger.error("Error fetching tokenlist data from Etherscan: %s", tokenlist_result)
+    elif tokenlist_result:
+        for token_address in tokenlist_result:
+            new_token_addresses.setdefault(token_address, None)
+
+    for token_address in new_token_addresses:
+        token_addresses.setdefault(token_address, None)
+
+    # Only advance the index when the transfer scan finished, so nothing is skipped next time
+    if discovery_index and scan_complete:
+        discovery_index.update(wallet_address, highest_block, list(new_token_addresses))
+
+    return list(token_addresses)
+
+
+def fetch_token_addresses(wallet_address: str, api_key: str,
+                          discovery_index: Optional[WalletDiscoveryIndex] = None) -> List[str]:
+    """Returns the wallet's token contracts, scanning Etherscan only past the last indexed block.
+
+    The first scan of a wallet queries tokentx and tokenlist concurrently. Later scans
+    only fetch transfers after the indexed block and merge the new contracts in.
+    """
+    known = discovery_index.get(wallet_address) if discovery_index else None
+    start_block = known[0] + 1 if known else 0
+
+    tokentx_future = submit(_executor, _collect_tokentx_addresses, wallet_address, api_key, start_block)
+    # tokenlist reports current holdings, so it only adds anything on a wallet's first scan
+    tokenlist_future = submit(_executor, _collect_tokenlist_addresses, wallet_address, api_key) if not known else None
+
+    def result_or_exception(future):
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            return e
+
+    return _merge_discovery(wallet_address, discovery_index, known,
+                            result_or_exception(tokentx_future), result_or_exception(tokenlist_future))
+
+
+async def async_fetch_token_addresses(client, wallet_address: str, api_key: str,
+                                      discovery_index: Optional[WalletDiscoveryIndex] = None) -> List[str]:
+    """Async version of fetch_token_addresses() using an httpx.AsyncClient"""
+    known = discovery_index.get(wallet_address) if discovery_index else None
+    start_block = known[0] + 1 if known else 0
+
+    scans = [_async_collect_tokentx_addresses(client, wallet_address, api_key, start_block)]
+    if not known:
+        scans.append(_async_collect_tokenlist_addresses(client, wallet_address, api_key))
+    results = await asyncio.gather(*scans, return_exceptions=True)
+
+    return _merge_discovery(wallet_address, discovery_index, known,
+                            results[0], results[1] if len(results) > 1 else None)
@@ -0,0 +1,71 @@
+from decimal import Decimal, ROUND_DOWN
+from typing import Any, Dict, Optional
+
+# USD prices, percentages and rates are held as integers scaled by 10**FIXED_DECIMALS
+FIXED_DECIMALS = 18
+FIXED_ONE = 10 ** FIXED_DECIMALS
+
+# Decimals assumed for tokens sent without them (ETH and most ERC-20s)
+DEFAULT_DECIMALS = 18
+
+
+def to_fixed(value) -> int:
+    """Converts a float/str/int to a FIXED_DECIMALS fixed-point integer, exact for its shortest decimal form"""
+    return int((Decimal(str(value)) * FIXED_ONE).to_integral_value(ROUND_DOWN))
+
+
+def to_raw(amount, decimals: int) -> int:
+    """Converts a token amount in whole units to raw units, rounding down"""
+    return int((Decimal(str(amount)).scaleb(decimals)).to_integral_value(ROUND_DOWN))
+
+
+def from_raw(raw_amount: int, decimals: int) -> float:
+    """Converts raw units to the nearest float amount in whole units, for display"""
+    return raw_amount / 10 ** decimals
+
+
+class Holding:
+    """One token position as an exact raw uint256 balance plus its decimals.
+
+    Balances stay integers from the chain read to the trade amounts; the float balance is
+    only derived for allocation percentages and display.
+    """
+
+    __slots__ = ("symbol", "decimals", "raw_balance", "address")
+
+    def __init__(self, symbol: str, decimals: int, raw_balance: int, address: Optional[str] = None):
+        self.symbol = symbol
+        self.decimals = decimals
+        self.raw_balance = raw_balance
+        self.address = address
+
+    @classmethod
+    def from_token(cls, symbol: str, token: Dict[str, Any]) -> "Holding":
+        """Builds a holding from a detect_tokens entry.
+
+        Uses raw_balance (an int or decimal string) when present, otherwise converts the float
+        balance exactly as written; decimals default to DEFAULT_DECIMALS.
+        """
+        decimals = int(token.get('decimals') if token.get('decimals') is not None else DEFAULT_DECIMALS)
+        if token.get('raw_balance') is not None:
+            raw_balance = int(token['raw_balance'])
+        else:
+            raw_balance = to_raw(token.get('balance') or 0, decimals)
+        return cls(symbol, decimals, raw_balance, token.get('address'))
+
+    @property
+    def balance(self) -> float:
+        return from_raw(self.raw_balance, self.decimals)
+
+    def value(self, price_fixed: int) -> int:
+        """USD value of the whole balance at a fixed-point price, as a fixed-point integer"""
+        return self.raw_balance * price_fixed // 10 ** self.decimals
+
+    def raw_for_value(self, value_fixed: int, price_fixed: int) -> int:
+        """Raw units worth value_fixed USD at a fixed-point price, rounded down"""
+        if price_fixed <= 0:
+            return 0
+        return value_fixed * 10 ** self.decimals // price_fixed
+
+    def __repr__(self) -> str:
+        return f"Holding({self.symbol!r}, {self.decimals}, {self.raw_balance})"
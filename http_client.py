@@ -0,0 +1,124 @@
+import os
+import asyncio
+import logging
+import random
+import threading
+import time
+import httpx
+import requests
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from tracing import upstream_call
+
+logger = logging.getLogger(__name__)
+
+# Outbound HTTP settings shared by Etherscan, CoinGecko and Infura calls
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "15"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "8"))
+HTTP_MAX_CONCURRENCY_PER_HOST = int(os.getenv("HTTP_MAX_CONCURRENCY_PER_HOST", "10"))
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class PooledSession(requests.Session):
+    """requests.Session with keep-alive pools per host, default timeouts, jittered retries
+    on 429/5xx and connection errors, and a cap on concurrent requests per host.
+    """
+
+    def __init__(self, max_concurrency_per_host: int = HTTP_MAX_CONCURRENCY_PER_HOST):
+        super().__init__()
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self._host_limits = {}
+        self._host_limits_lock = threading.Lock()
+
+        # One pool per host, sized so every permitted concurrent request can keep its connection
+        adapter = HTTPAdapter(pool_connections=20, pool_maxsize=max_concurrency_per_host)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def _host_limit(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._host_limits_lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.max_concurrency_per_host)
+            return self._host_limits[host]
+
+    @staticmethod
+    def _backoff(attempt: int, response=None) -> float:
+        """Full-jitter exponential backoff, honouring a short Retry-After header if present"""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit() and int(retry_after) <= HTTP_BACKOFF_MAX:
+                return float(retry_after)
+        return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        host_limit = self._host_limit(url)
+
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            response = None
+            try:
+                with host_limit, upstream_call(method, url, kwargs.get("params"), kwargs.get("data")) as call:
+                    response = super().request(method, url, *args, **kwargs)
+                    call.set(status=response.status_code, attempt=attempt,
+                             bytes=0 if kwargs.get("stream") else len(response.content))
+                if response.status_code not in RETRY_STATUS_CODES or attempt == HTTP_MAX_RETRIES:
+                    return response
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == HTTP_MAX_RETRIES:
+                    raise
+
+            delay = self._backoff(attempt, response)
+            if response is not None:
+                response.close()  # Return the connection to the pool before sleeping
+            logger.info("Retrying %s %s in %.2fs (attempt %d, status %s)", method, urlsplit(url).netloc, delay,
+                        attempt + 1, response.status_code if response is not None else "error")
+            time.sleep(delay)
+
+
+# Shared session for all outbound calls
+http_session = PooledSession()
+
+
+class AsyncPooledClient(httpx.AsyncClient):
+    """Async counterpart of PooledSession for the ASGI app: pooled keep-alive connections,
+    default timeouts, jittered retries on 429/5xx and a per-host concurrency cap.
+    """
+
+    def __init__(self, max_concurrency_per_host: int = HTTP_MAX_CONCURRENCY_PER_HOST, **kwargs):
+        kwargs.setdefault("timeout", httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT))
+        kwargs.setdefault("limits", httpx.Limits(max_keepalive_connections=max_concurrency_per_host * 4))
+        super().__init__(**kwargs)
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self._host_limits = {}
+
+    def _host_limit(self, url) -> asyncio.Semaphore:
+        host = httpx.URL(url).host
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.max_concurrency_per_host)
+        return self._host_limits[host]
+
+    async def request(self, method, url, *args, **kwargs):
+        host_limit = self._host_limit(url)
+
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            response = None
+            try:
+                async with host_limit:
+                    with upstream_call(method, url, kwargs.get("params"), kwargs.get("content")) as call:
+                        response = await super().request(method, url, *args, **kwargs)
+                        call.set(status=response.status_code, attempt=attempt, bytes=len(response.content))
+                if response.status_code not in RETRY_STATUS_CODES or attempt == HTTP_MAX_RETRIES:
+                    return response
+            except httpx.TransportError:
+                if attempt == HTTP_MAX_RETRIES:
+                    raise
+
+            delay = PooledSession._backoff(attempt, response)
+            logger.info("Retrying %s %s in %.2fs (attempt %d, status %s)", method, httpx.URL(url).host, delay,
+                        attempt + 1, response.status_code if response is not None else "error")
+            await asyncio.sleep(delay)
@@ -0,0 +1,282 @@
+import asyncio
+import logging
+import weakref
+from typing import List, Dict, Any, Tuple, Optional
+from web3 import Web3, AsyncWeb3
+from web3.exceptions import ContractLogicError
+
+logger = logging.getLogger(__name__)
+
+# Multicall3 is deployed at the same address on mainnet, Sepolia and most EVM chains
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+
+# Maximum number of sub-calls packed into a single aggregate3 eth_call
+MULTICALL_BATCH_SIZE = 500
+
+# ABI for Multicall3 (aggregate3 only; getEthBalance is only called through aggregate3)
+MULTICALL3_ABI = [
+    {
+        "inputs": [
+            {
+                "components": [
+                    {"name": "target", "type": "address"},
+                    {"name": "allowFailure", "type": "bool"},
+                    {"name": "callData", "type": "bytes"}
+                ],
+                "name": "calls",
+                "type": "tuple[]"
+            }
+        ],
+        "name": "aggregate3",
+        "outputs": [
+            {
+                "components": [
+                    {"name": "success", "type": "bool"},
+                    {"name": "returnData", "type": "bytes"}
+                ],
+                "name": "returnData",
+                "type": "tuple[]"
+            }
+        ],
+        "stateMutability": "payable",
+        "type": "function"
+    }
+]
+
+# Function selectors for the ERC-20 reads we batch
+SYMBOL_SELECTOR = Web3.keccak(text="symbol()")[:4]
+NAME_SELECTOR = Web3.keccak(text="name()")[:4]
+DECIMALS_SELECTOR = Web3.keccak(text="decimals()")[:4]
+BALANCE_OF_SELECTOR = Web3.keccak(text="balanceOf(address)")[:4]
+
+# Multicall3's own getEthBalance(address), so native balances can be batched with token reads
+GET_ETH_BALANCE_SELECTOR = Web3.keccak(text="getEthBalance(address)")[:4]
+
+
+# Whether Multicall3 has code on each client's chain, checked once after the first aggregate3 failure
+_multicall_deployed = weakref.WeakKeyDictionary()
+
+
+def _multicall_missing(w3: Web3) -> bool:
+    """True if Multicall3 has no code at its address on this chain (cached per client)"""
+    if w3 not in _multicall_deployed:
+        _multicall_deployed[w3] = len(w3.eth.get_code(MULTICALL3_ADDRESS)) > 0
+    return not _multicall_deployed[w3]
+
+
+async def _async_multicall_missing(async_w3: AsyncWeb3) -> bool:
+    """Async version of _multicall_missing()"""
+    if async_w3 not in _multicall_deployed:
+        _multicall_deployed[async_w3] = len(await async_w3.eth.get_code(MULTICALL3_ADDRESS)) > 0
+    return not _multicall_deployed[async_w3]
+
+
+def aggregate(w3: Web3, calls: List[Tuple[str, bytes]], block_identifier="latest") -> List[Tuple[bool, bytes]]:
+    """Runs (target, callData) pairs through Multicall3 and returns (success, returnData) per call.
+
+    Calls are chunked into MULTICALL_BATCH_SIZE sub-calls per eth_call. Each sub-call is
+    sent with allowFailure=True, so a reverting token only fails its own slot. Only when
+    Multicall3 is not deployed on this chain are the calls sent one by one; any other error
+    (timeouts, node errors) is raised, so no slot is reported failed because the node was.
+    """
+    results = []
+    multicall_contract = w3.eth.contract(address=MULTICALL3_ADDRESS, abi=MULTICALL3_ABI)
+
+    for start in range(0, len(calls), MULTICALL_BATCH_SIZE):
+        chunk = calls[start:start + MULTICALL_BATCH_SIZE]
+        try:
+            chunk_results = multicall_contract.functions.aggregate3(
+                [(target, True, call_data) for target, call_data in chunk]
+            ).call(block_identifier=block_identifier)
+            results.extend((success, bytes(return_data)) for success, return_data in chunk_results)
+        except Exception as e:
+            if not _multicall_missing(w3):
+                raise
+            logger.warning("Multicall3 is not deployed, falling back to single calls: %s", e)
+            for target, call_data in chunk:
+                try:
+                    return_data = w3.eth.call({"to": target, "data": call_data}, block_identifier)
+                    results.append((True, bytes(return_data)))
+                except ContractLogicError:
+                    results.append((False, b""))
+
+    return results
+
+
+def _decode_string(w3, success: bool, data: bytes) -> Optional[str]:
+    """Decodes a string return value, accepting legacy bytes32 symbols/names (e.g. MKR)"""
+    if not success or not data:
+        return None
+    try:
+        return w3.codec.decode(["string"], data)[0]
+    except Exception:
+        pass
+    try:
+        return w3.codec.decode(["bytes32"], data)[0].rstrip(b"\x00").decode("utf-8")
+    except Exception:
+        return None
+
+
+def _decode_uint(w3, success: bool, data: bytes) -> Optional[int]:
+    """Decodes a uint return value"""
+    if not success or not data:
+        return None
+    try:
+        return w3.codec.decode(["uint256"], data)[0]
+    except Exception:
+        return None
+
+
+def _address_arg(address: str) -> bytes:
+    """ABI-encodes an address argument"""
+    return bytes.fromhex(address[2:]).rjust(32, b"\x00")
+
+
+def _build_erc20_calls(wallet_address: str, token_addresses: List[str],
+                       known_metadata: Dict[str, Dict[str, Any]]) -> List[Tuple[str, bytes]]:
+    """Builds the multicall sub-calls: metadata reads for unknown tokens plus balanceOf for all"""
+    wallet_arg = _address_arg(wallet_address)
+
+    calls = []
+    for token_address in token_addresses:
+        if token_address not in known_metadata:
+            calls.append((token_address, SYMBOL_SELECTOR))
+            calls.append((token_address, NAME_SELECTOR))
+            calls.append((token_address, DECIMALS_SELECTOR))
+        calls.append((token_address, BALANCE_OF_SELECTOR + wallet_arg))
+    return calls
+
+
+def _decode_erc20_results(w3, token_addresses: List[str], known_metadata: Dict[str, Dict[str, Any]],
+                          results: List[Tuple[bool, bytes]]) -> Dict[str, Dict[str, Any]]:
+    """Decodes multicall results in the order produced by _build_erc20_calls"""
+    results = iter(results)
+
+    tokens = {}
+    for token_address in token_addresses:
+        metadata = known_metadata.get(token_address)
+        if metadata is None:
+            symbol = _decode_string(w3, *next(results))
+            name = _decode_string(w3, *next(results))
+            decimals = _decode_uint(w3, *next(results))
+            metadata = {"symbol": symbol, "name": name or symbol, "decimals": decimals}
+        raw_balance = _decode_uint(w3, *next(results))
+
+        if metadata["symbol"] is None or metadata["decimals"] is None or raw_balance is None:
+            logger.warning("Error checking token %s: symbol/decimals/balanceOf call failed", token_address)
+            continue
+
+        tokens[token_address] = {
+            "symbol": metadata["symbol"],
+            "name": metadata["name"],
+            "decimals": metadata["decimals"],
+            "raw_balance": raw_balance
+        }
+
+    return tokens
+
+
+def read_erc20_tokens(w3: Web3, wallet_address: str, token_addresses: List[str],
+                      block_identifier="latest",
+                      known_metadata: Optional[Dict[str, Dict[str, Any]]] = None) -> Dict[str, Dict[str, Any]]:
+    """Reads symbol, name, decimals and balanceOf for every token in one batched multicall.
+
+    Tokens present in known_metadata (checksum address -> symbol/name/decimals) only get
+    a balanceOf call. Returns a dict keyed by checksum token address. Tokens whose symbol,
+    decimals or balance could not be read are left out; a missing name falls back to the symbol.
+    """
+    known_metadata = known_metadata or {}
+    calls = _build_erc20_calls(wallet_address, token_addresses, known_metadata)
+    results = aggregate(w3, calls, block_identifier) if calls else []
+    return _decode_erc20_results(w3, token_addresses, known_metadata, results)
+
+
+def read_erc20_metadata(w3: Web3, token_addresses: List[str], block_identifier="latest") -> Dict[str, Dict[str, Any]]:
+    """Reads symbol, name and decimals of many tokens in batched multicalls.
+
+    Returns a dict keyed by checksum token address; tokens whose symbol or decimals could not
+    be read are left out, and a missing name falls back to the symbol.
+    """
+    calls = []
+    for token_address in token_addresses:
+        calls.extend([(token_address, SYMBOL_SELECTOR), (token_address, NAME_SELECTOR),
+                      (token_address, DECIMALS_SELECTOR)])
+    results = iter(aggregate(w3, calls, block_identifier) if calls else [])
+
+    metadata = {}
+    for token_address in token_addresses:
+        symbol = _decode_string(w3, *next(results))
+        name = _decode_string(w3, *next(results))
+        decimals = _decode_uint(w3, *next(results))
+        if symbol is None or decimals is None:
+            logger.warning("Error checking token %s: symbol/decimals call failed", token_address)
+            continue
+        metadata[token_address] = {"symbol": symbol, "name": name or symbol, "decimals": decimals}
+    return metadata
+
+
+def read_balances(w3: Web3, wallet_tokens: Dict[str, List[str]],
+                  block_identifier="latest") -> Dict[str, Tuple[Optional[int], Dict[str, int]]]:
+    """Reads the ETH balance and token balances of many wallets in batched multicalls.
+
+    wallet_tokens maps each wallet to the token contracts to read. ETH balances come from
+    Multicall3's getEthBalance, so every wallet and (wallet, token) pair shares the same
+    aggregate3 calls. Returns wallet -> (ETH balance or None, {token: raw balance}); balances
+    that could not be read are left out.
+    """
+    calls = []
+    for wallet_address, token_addresses in wallet_tokens.items():
+        wallet_arg = _address_arg(wallet_address)
+        calls.append((MULTICALL3_ADDRESS, GET_ETH_BALANCE_SELECTOR + wallet_arg))
+        calls.extend((token_address, BALANCE_OF_SELECTOR + wallet_arg) for token_address in token_addresses)
+    results = iter(aggregate(w3, calls, block_identifier) if calls else [])
+
+    balances = {}
+    for wallet_address, token_addresses in wallet_tokens.items():
+        eth_balance = _decode_uint(w3, *next(results))
+        token_balances = {}
+        for token_address in token_addresses:
+            raw_balance = _decode_uint(w3, *next(results))
+            if raw_balance is not None:
+                token_balances[token_address] = raw_balance
+        balances[wallet_address] = (eth_balance, token_balances)
+    return balances
+
+
+async def async_aggregate(async_w3: AsyncWeb3, calls: List[Tuple[str, bytes]],
+                          block_identifier="latest") -> List[Tuple[bool, bytes]]:
+    """Async version of aggregate(); chunks are sent concurrently"""
+    multicall_contract = async_w3.eth.contract(address=MULTICALL3_ADDRESS, abi=MULTICALL3_ABI)
+
+    async def run_chunk(chunk):
+        try:
+            chunk_results = await multicall_contract.functions.aggregate3(
+                [(target, True, call_data) for target, call_data in chunk]
+            ).call(block_identifier=block_identifier)
+            return [(success, bytes(return_data)) for success, return_data in chunk_results]
+        except Exception as e:
+            if not await _async_multicall_missing(async_w3):
+                raise
+            logger.warning("Multicall3 is not deployed, falling back to single calls: %s", e)
+            results = []
+            for target, call_data in chunk:
+                try:
+                    return_data = await async_w3.eth.call({"to": target, "data": call_data}, block_identifier)
+                    results.append((True, bytes(return_data)))
+                except ContractLogicError:
+                    results.append((False, b""))
+            return results
+
+    chunks = [calls[start:start + MULTICALL_BATCH_SIZE] for start in range(0, len(calls), MULTICALL_BATCH_SIZE)]
+    chunk_results = await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+    return [result for results in chunk_results for result in results]
+
+
+async def async_read_erc20_tokens(async_w3: AsyncWeb3, wallet_address: str, token_addresses: List[str],
+                                  block_identifier="latest",
+                                  known_metadata: Optional[Dict[str, Dict[str, Any]]] = None) -> Dict[str, Dict[str, Any]]:
+    """Async version of read_erc20_tokens()"""
+    known_metadata = known_metadata or {}
+    calls = _build_erc20_calls(wallet_address, token_addresses, known_metadata)
+    results = await async_aggregate(async_w3, calls, block_identifier) if calls else []
+    return _decode_erc20_results(async_w3, token_addresses, known_metadata, results)
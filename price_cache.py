@@ -0,0 +1,142 @@
+import os
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List
+from tracing import record_cache
+
+logger = logging.getLogger(__name__)
+
+# Prices younger than PRICE_CACHE_TTL seconds are fresh. Up to PRICE_CACHE_STALE_TTL seconds
+# past that they are still served, while a background refresh fetches a new value.
+PRICE_CACHE_TTL = float(os.getenv("PRICE_CACHE_TTL", "60"))
+PRICE_CACHE_STALE_TTL = float(os.getenv("PRICE_CACHE_STALE_TTL", "300"))
+
+
+class PriceCache:
+    """Shared USD price cache with TTL, stale-while-revalidate and request coalescing.
+
+    fetch_prices is called with a list of symbols and returns a symbol -> price dict holding only
+    the symbols it could price. A symbol left out, or a fetch that raises, keeps the last good
+    price, which is served even past its TTL until a later fetch succeeds; symbols never priced
+    are missing from the result. Concurrent lookups of the same missing symbol share a single
+    upstream fetch.
+    """
+
+    def __init__(self, fetch_prices: Callable[[List[str]], Dict[str, float]],
+                 ttl: float = PRICE_CACHE_TTL, stale_ttl: float = PRICE_CACHE_STALE_TTL):
+        self.fetch_prices = fetch_prices
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._prices = {}  # symbol -> (price, fetched_at)
+        self._in_flight = {}  # symbol -> Future resolving to the fetched price dict
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "upstream_fetches": 0}
+
+    def _start_fetch(self, symbols: List[str]) -> Future:
+        """Registers an in-flight future for the symbols (caller holds the lock)"""
+        future = Future()
+        for symbol in symbols:
+            self._in_flight[symbol] = future
+        self._stats["upstream_fetches"] += 1
+        return future
+
+    def _run_fetch(self, symbols: List[str], future: Future):
+        """Fetches prices upstream, stores them and resolves the in-flight future"""
+        try:
+            prices = self.fetch_prices(symbols)
+        except Exception as e:
+            logger.error("Error refreshing prices for %s: %s", symbols, e)
+            prices = {}
+
+        now = time.time()
+        with self._lock:
+            for symbol, price in prices.items():
+                self._prices[symbol] = (price, now)
+            for symbol in symbols:
+                if self._in_flight.get(symbol) is future:
+                    del self._in_flight[symbol]
+            # Symbols the fetch failed for keep their last good price, without renewing its age
+            prices = {**{symbol: self._prices[symbol][0] for symbol in symbols if symbol in self._prices}, **prices}
+        future.set_result(prices)
+
+    def get_prices(self, symbols: List[str]) -> Dict[str, float]:
+        """Returns prices for the symbols, fetching only what is missing or expired"""
+        prices = {}
+        to_fetch = []
+        to_revalidate = []
+        waiting = []
+
+        now = time.time()
+        with self._lock:
+            for symbol in dict.fromkeys(symbols):
+                cached = self._prices.get(symbol)
+                age = now - cached[1] if cached else None
+
+                if cached and age < self.ttl:
+                    self._stats["hits"] += 1
+                    prices[symbol] = cached[0]
+                elif cached and age < self.ttl + self.stale_ttl:
+                    self._stats["stale_hits"] += 1
+                    prices[symbol] = cached[0]
+                    if symbol not in self._in_flight:
+                        to_revalidate.append(symbol)
+                elif symbol in self._in_flight:
+                    self._stats["coalesced"] += 1
+                    waiting.append((symbol, self._in_flight[symbol]))
+                else:
+                    self._stats["misses"] += 1
+                    to_fetch.append(symbol)
+
+            revalidate_future = self._start_fetch(to_revalidate) if to_revalidate else None
+            fetch_future = self._start_fetch(to_fetch) if to_fetch else None
+        record_cache("price", len(prices), len(to_fetch) + len(waiting))
+
+        # Stale entries are refreshed in the background; the caller gets the old price now
+        if revalidate_future:
+            threading.Thread(
+                target=self._run_fetch, args=(to_revalidate, revalidate_future), daemon=True
+            ).start()
+
+        if fetch_future:
+            self._run_fetch(to_fetch, fetch_future)
+            fetched = fetch_future.result()
+            for symbol in to_fetch:
+                if symbol in fetched:
+                    prices[symbol] = fetched[symbol]
+
+        for symbol, future in waiting:
+            fetched = future.result()
+            if symbol in fetched:
+                prices[symbol] = fetched[symbol]
+
+        return prices
+
+    def refresh(self, symbols: List[str]) -> Dict[str, float]:
+        """Refetches the symbols now, even if fresh, and returns their prices.
+
+        Symbols already being fetched are not asked again; their in-flight result is used.
+        """
+        with self._lock:
+            symbols = list(dict.fromkeys(symbols))
+            waiting = [(symbol, self._in_flight[symbol]) for symbol in symbols if symbol in self._in_flight]
+            to_fetch = [symbol for symbol in symbols if symbol not in self._in_flight]
+            future = self._start_fetch(to_fetch) if to_fetch else None
+
+        prices = {}
+        if future:
+            self._run_fetch(to_fetch, future)
+            prices.update(future.result())
+        for symbol, in_flight in waiting:
+            fetched = in_flight.result()
+            if symbol in fetched:
+                prices[symbol] = fetched[symbol]
+        return prices
+
+    def stats(self) -> Dict[str, int]:
+        """Returns a snapshot of the hit/miss counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._prices)
+        return stats
@@ -0,0 +1,217 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from tracing import record_cache
+
+# Number of normalized queries whose parsed allocation is remembered
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1000"))
+
+# Words that may surround an allocation without changing its meaning. Any other word left
+# over after parsing means the query says something the rules do not understand.
+FILLER_WORDS = {
+    "a", "allocate", "allocation", "and", "across", "among", "at", "be", "between", "can", "could",
+    "distribute", "each", "for", "give", "go", "have", "hold", "i", "id", "in", "into", "is", "it",
+    "keep", "like", "make", "me", "my", "of", "on", "please", "portfolio", "put", "rebalance",
+    "set", "should", "split", "target", "the", "them", "to", "tokens", "want", "weight",
+    "weighted", "weights", "with", "would", "you"
+}
+
+# Common names that refer to a wallet symbol
+SYMBOL_ALIASES = {"ETHER": "ETH", "ETHEREUM": "ETH"}
+
+_NUMBER = r"\d+(?:\.\d+)?"
+_WORD = r"[a-z0-9]+"
+_PERCENT = r"\s*(?:%|percent\b|pct\b)"
+_CONNECTOR = r"(?:\s+(?:in|into|of|to|for|on))?"
+
+# "50% ETH", "50 percent in ETH"
+_PERCENT_THEN_SYMBOL = re.compile(rf"\b(?P<number>{_NUMBER}){_PERCENT}{_CONNECTOR}\s*(?P<word>{_WORD})\b")
+# "ETH 50%", "ETH: 50%", "ETH at 50%"
+_SYMBOL_THEN_PERCENT = re.compile(rf"\b(?P<word>{_WORD})(?:\s*[:=]\s*|\s+(?:at\s+|to\s+)?)(?P<number>{_NUMBER}){_PERCENT}")
+# "... and the rest in USDC"
+_REST = re.compile(rf"\b(?:the\s+)?(?:rest|remainder|remaining){_CONNECTOR}\s+(?P<word>{_WORD})\b")
+
+# "60/40 ETH/USDC", "ETH:USDC 1:1", "ETH and USDC 70/30"
+_RATIO_NUMBERS = rf"(?P<numbers>{_NUMBER}(?:\s*[/:]\s*{_NUMBER})+)"
+_RATIO_SYMBOLS = rf"(?P<symbols>{_WORD}(?:\s*(?:[/:,-]|\band\b)\s*{_WORD})+)"
+_RATIO_PATTERNS = [
+    re.compile(rf"\b{_RATIO_NUMBERS}\s+(?:split\s+)?(?:(?:between|of|in|into|for)\s+)?{_RATIO_SYMBOLS}\b"),
+    re.compile(rf"\b{_RATIO_SYMBOLS}\s+(?:(?:at|in|of)\s+(?:a\s+)?)?{_RATIO_NUMBERS}(?:\s+ratio)?\b"),
+]
+
+# "equal weight", "equally", "evenly"
+_EQUAL = re.compile(r"\b(?:equal(?:ly)?|even(?:ly)?)\b(?:[\s-]+weight(?:ed|s)?)?")
+
+# "all in ETH", "everything into ETH", "go all in on ETH"
+_ALL_IN = re.compile(rf"\b(?:all(?:[\s-]+in)?|everything){_CONNECTOR}\s+(?P<word>{_WORD})\b")
+
+
+def normalize_query(query: str) -> str:
+    """Lower-cases the query and collapses whitespace and trailing punctuation"""
+    return " ".join(query.lower().split()).rstrip(".!?")
+
+
+def _symbol_resolver(known_symbols: Iterable[str]) -> Callable[[str], Optional[str]]:
+    """Returns a function mapping a query word to a wallet symbol, or None if it is not one"""
+    known = {symbol.upper(): symbol for symbol in known_symbols}
+
+    def resolve(word: str) -> Optional[str]:
+        upper = word.upper()
+        return known.get(upper) or known.get(SYMBOL_ALIASES.get(upper, ""))
+
+    return resolve
+
+
+def _only_filler(text: str, spans: List[Tuple[int, int]]) -> bool:
+    """Checks that everything outside the parsed spans is filler words or punctuation"""
+    leftover = []
+    position = 0
+    for start, end in sorted(spans):
+        leftover.append(text[position:start])
+        position = max(position, end)
+    leftover.append(text[position:])
+    return all(word in FILLER_WORDS for word in re.findall(r"[a-z0-9]+", " ".join(leftover)))
+
+
+def _sums_to_100(allocation: Dict[str, float]) -> bool:
+    return abs(sum(allocation.values()) - 100) <= 0.5
+
+
+def _parse_percentages(text: str, resolve) -> Optional[Dict[str, float]]:
+    """Parses "50% ETH 50% USDC", "ETH 60%, USDC 40%" and "60% ETH, the rest in USDC" """
+    for pattern in (_PERCENT_THEN_SYMBOL, _SYMBOL_THEN_PERCENT):
+        allocation = {}
+        spans = []
+        for match in pattern.finditer(text):
+            symbol = resolve(match.group("word"))
+            if symbol is None or symbol in allocation:
+                allocation = {}
+                break
+            allocation[symbol] = float(match.group("number"))
+            spans.append(match.span())
+        if not allocation:
+            continue
+
+        rest = _REST.search(text)
+        if rest:
+            symbol = resolve(rest.group("word"))
+            remaining = 100 - sum(allocation.values())
+            if symbol is None or symbol in allocation or remaining <= 0:
+                continue
+            allocation[symbol] = remaining
+            spans.append(rest.span())
+
+        if _only_filler(text, spans) and _sums_to_100(allocation):
+            return allocation
+    return None
+
+
+def _parse_ratio(text: str, resolve) -> Optional[Dict[str, float]]:
+    """Parses "60/40 ETH/USDC" and "ETH:USDC 1:1" """
+    for pattern in _RATIO_PATTERNS:
+        match = pattern.search(text)
+        if not match:
+            continue
+        weights = [float(number) for number in re.split(r"\s*[/:]\s*", match.group("numbers"))]
+        symbols = [resolve(word) for word in re.split(r"\s*(?:[/:,-]|\band\b)\s*", match.group("symbols"))]
+        if (len(weights) != len(symbols) or None in symbols or len(set(symbols)) != len(symbols)
+                or sum(weights) <= 0 or not _only_filler(text, [match.span()])):
+            continue
+        total = sum(weights)
+        return {symbol: weight / total * 100 for symbol, weight in zip(symbols, weights)}
+    return None
+
+
+def _parse_equal_weight(text: str, resolve, known_symbols: List[str]) -> Optional[Dict[str, float]]:
+    """Parses "equal weight ETH, USDC and LINK"; with no symbols named, uses every known symbol"""
+    match = _EQUAL.search(text)
+    if not match:
+        return None
+
+    leftover = text[:match.start()] + " " + text[match.end():]
+    symbols = []
+    for word in re.findall(r"[a-z0-9]+", leftover):
+        symbol = resolve(word)
+        if symbol is not None:
+            if symbol not in symbols:
+                symbols.append(symbol)
+        elif word not in FILLER_WORDS and word not in ("all", "everything"):
+            return None
+
+    symbols = symbols or list(known_symbols)
+    if not symbols:
+        return None
+    return {symbol: 100 / len(symbols) for symbol in symbols}
+
+
+def _parse_all_in(text: str, resolve) -> Optional[Dict[str, float]]:
+    """Parses "all in ETH" and "everything into USDC" """
+    match = _ALL_IN.search(text)
+    if not match:
+        return None
+    symbol = resolve(match.group("word"))
+    if symbol is None or not _only_filler(text, [match.span()]):
+        return None
+    return {symbol: 100.0}
+
+
+def parse_allocation(query: str, known_symbols: Iterable[str] = ()) -> Optional[Dict[str, float]]:
+    """Parses common allocation phrasings without an LLM.
+
+    Handles percentages, ratios, equal weight and "all in X". Every symbol must be one of
+    known_symbols (the wallet's detected tokens); without them nothing tells a symbol from an
+    ordinary word ("I", "A"), so None is returned. Returns None when the query is anything
+    else too, so the caller can fall back to a model.
+    """
+    known_symbols = list(known_symbols)
+    if not known_symbols:
+        return None
+    text = normalize_query(query)
+    resolve = _symbol_resolver(known_symbols)
+
+    return (_parse_percentages(text, resolve)
+            or _parse_ratio(text, resolve)
+            or _parse_equal_weight(text, resolve, known_symbols)
+            or _parse_all_in(text, resolve))
+
+
+class ParsedQueryCache:
+    """LRU of normalized query (plus the wallet's symbols) -> parsed allocation"""
+
+    def __init__(self, max_size: int = QUERY_CACHE_SIZE):
+        self.max_size = max_size
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def key(query: str, known_symbols: Iterable[str] = ()) -> tuple:
+        return normalize_query(query), tuple(sorted(symbol.upper() for symbol in known_symbols))
+
+    def get(self, key: tuple) -> Optional[Dict[str, float]]:
+        with self._lock:
+            allocation = self._lru.get(key)
+            if allocation is None:
+                self._stats["misses"] += 1
+                record_cache("parsed_query", 0, 1)
+                return None
+            self._stats["hits"] += 1
+            record_cache("parsed_query", 1, 0)
+            self._lru.move_to_end(key)
+            return dict(allocation)
+
+    def put(self, key: tuple, allocation: Dict[str, float]):
+        with self._lock:
+            self._lru[key] = dict(allocation)
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns a snapshot of the hit/miss counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._lru)
+        return stats
@@ -0,0 +1,170 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from web3 import Web3
+from multicall import aggregate
+from tracing import record_cache
+
+# Uniswap v2 router and WETH used by the frontend's swaps (Sepolia defaults)
+UNISWAP_ROUTER_ADDRESS = Web3.to_checksum_address(
+    os.getenv("UNISWAP_ROUTER_ADDRESS", "0xC532a74256D3Db42D0Bf7a0400fEFDbad7694008")
+)
+WETH_ADDRESS = Web3.to_checksum_address(os.getenv("WETH_ADDRESS", "0x5f207d42F869fd1c71d7f0f81a2A67Fc20FF7323"))
+
+# Quotes are cached per amount bucket of QUOTE_AMOUNT_PRECISION significant digits, so nearby amounts share an entry
+QUOTE_AMOUNT_PRECISION = int(os.getenv("QUOTE_AMOUNT_PRECISION", "3"))
+QUOTE_CACHE_SIZE = int(os.getenv("QUOTE_CACHE_SIZE", "5000"))
+
+# The pre-trade price is measured with a quote for 1/QUOTE_REFERENCE_DIVISOR of the amount
+QUOTE_REFERENCE_DIVISOR = 10000
+
+# Selector of the router's getAmountsOut (see uniswap_router_abi.json)
+GET_AMOUNTS_OUT_SELECTOR = Web3.keccak(text="getAmountsOut(uint256,address[])")[:4]
+
+
+def amount_bucket(amount_in: int) -> int:
+    """Rounds an amount down to QUOTE_AMOUNT_PRECISION significant digits"""
+    scale = 10 ** max(len(str(amount_in)) - QUOTE_AMOUNT_PRECISION, 0)
+    return amount_in // scale * scale
+
+
+def candidate_paths(token_in: str, token_out: str) -> List[Tuple[str, ...]]:
+    """Direct pool first; token-to-token legs may also route through WETH"""
+    if WETH_ADDRESS in (token_in, token_out):
+        return [(token_in, token_out)]
+    return [(token_in, token_out), (token_in, WETH_ADDRESS, token_out)]
+
+
+class QuoteCache:
+    """LRU of (path, amount bucket, block) -> (amount quoted, amount out, reference amount out) from getAmountsOut.
+
+    A path with no pool is cached as None so it is not asked again in the same block.
+    """
+
+    def __init__(self, max_size: int = QUOTE_CACHE_SIZE):
+        self.max_size = max_size
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def get_many(self, keys: List[tuple]) -> Dict[tuple, Optional[Tuple[int, int]]]:
+        """Returns the cached entries among keys"""
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    found[key] = self._lru[key]
+            self._stats["hits"] += len(found)
+            self._stats["misses"] += len(keys) - len(found)
+        record_cache("quote", len(found), len(keys) - len(found))
+        return found
+
+    def put_many(self, entries: Dict[tuple, Optional[Tuple[int, int]]]):
+        with self._lock:
+            for key, value in entries.items():
+                self._lru[key] = value
+                self._lru.move_to_end(key)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns a snapshot of the hit/miss counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._lru)
+        return stats
+
+
+def _get_amounts_out_call(w3: Web3, amount_in: int, path: Tuple[str, ...]) -> Tuple[str, bytes]:
+    return UNISWAP_ROUTER_ADDRESS, GET_AMOUNTS_OUT_SELECTOR + w3.codec.encode(["uint256", "address[]"], [amount_in, list(path)])
+
+
+def _decode_amount_out(w3: Web3, success: bool, data: bytes) -> Optional[int]:
+    """Returns the last entry of getAmountsOut's amounts, or None if the path has no pool"""
+    if not success or not data:
+        return None
+    try:
+        return w3.codec.decode(["uint256[]"], data)[0][-1]
+    except Exception:
+        return None
+
+
+def _fetch_quotes(w3: Web3, amounts: Dict[tuple, int], block_number: int) -> Dict[tuple, Optional[Tuple[int, int, int]]]:
+    """Quotes each (path, bucket, block) key at its exact amount, plus the reference amount, in one multicall"""
+    keys = list(amounts)
+    calls = []
+    for key in keys:
+        path, amount_in = key[0], amounts[key]
+        calls.append(_get_amounts_out_call(w3, amount_in, path))
+        calls.append(_get_amounts_out_call(w3, max(amount_in // QUOTE_REFERENCE_DIVISOR, 1), path))
+    results = aggregate(w3, calls, block_identifier=block_number)
+
+    quotes = {}
+    for i, key in enumerate(keys):
+        amount_out = _decode_amount_out(w3, *results[2 * i])
+        reference_out = _decode_amount_out(w3, *results[2 * i + 1])
+        quotes[key] = (amounts[key], amount_out, reference_out or 0) if amount_out else None
+    return quotes
+
+
+def quote_legs(w3: Web3, legs: List[Tuple[str, str, int]], block_number: int, cache: QuoteCache,
+               slippage_bps: int = 50) -> List[Dict[str, Any]]:
+    """Quotes (token_in, token_out, amount_in) legs at block_number.
+
+    Every candidate path of every leg that is not cached goes into one getAmountsOut multicall.
+    Each leg gets the path with the best output, the expected amount_out, amount_out_min after
+    slippage_bps, and price_impact: how far the trade's rate is below the pool's pre-trade rate.
+
+    A cached quote is only scaled down to smaller amounts in its bucket. Pool output is concave
+    in the amount, so that never overstates amount_out; a larger amount is quoted exactly.
+    """
+    leg_keys = [
+        [(path, amount_bucket(amount_in), block_number) for path in candidate_paths(token_in, token_out)]
+        for token_in, token_out, amount_in in legs
+    ]
+    all_keys = list(dict.fromkeys(key for keys in leg_keys for key in keys))
+    quotes = cache.get_many(all_keys)
+
+    # Largest amount each key must cover, quoted exactly when the cache cannot scale down to it
+    missing = {}
+    for (_, _, amount_in), keys in zip(legs, leg_keys):
+        for key in keys:
+            quote = key in quotes and quotes[key]
+            if key not in quotes or (quote and quote[0] < amount_in):
+                missing[key] = max(missing.get(key, 0), amount_in)
+    if missing:
+        fetched = _fetch_quotes(w3, missing, block_number)
+        cache.put_many(fetched)
+        quotes.update(fetched)
+
+    results = []
+    for (token_in, token_out, amount_in), keys in zip(legs, leg_keys):
+        best = None
+        for key in keys:
+            quote = quotes.get(key)
+            if quote is None or amount_in == 0:
+                continue
+            # Scale the quote down to the exact amount (equal unless another leg needed more)
+            amount_out = quote[1] * amount_in // quote[0]
+            if best is None or amount_out > best[1]:
+                best = (key[0], amount_out, quote)
+
+        result = {'token_in': token_in, 'token_out': token_out, 'amount_in': str(amount_in)}
+        if best is None:
+            result['error'] = 'No pool found for this pair'
+        else:
+            path, amount_out, (quoted_in, quoted_out, reference_out) = best
+            reference_in = max(quoted_in // QUOTE_REFERENCE_DIVISOR, 1)
+            price_impact = None
+            if reference_out:
+                price_impact = max(0.0, 1 - (quoted_out * reference_in) / (quoted_in * reference_out))
+            result.update({
+                'path': list(path),
+                'amount_out': str(amount_out),
+                'amount_out_min': str(amount_out * (10000 - slippage_bps) // 10000),
+                'price_impact': price_impact
+            })
+        results.append(result)
+    return results
@@ -0,0 +1,288 @@
+import os
+from typing import Any, Dict, List, Optional
+import numpy as np
+from holdings import DEFAULT_DECIMALS, FIXED_ONE, Holding, from_raw, to_fixed
+
+# Allocation differences below this many percentage points are not worth a trade
+MIN_ALLOCATION_DIFF = 0.0000001
+
+# Defaults for the trade filters and cost model; requests may override them
+REBALANCE_MIN_TRADE_USD = float(os.getenv("REBALANCE_MIN_TRADE_USD", "5"))
+REBALANCE_FEE_RATE = float(os.getenv("REBALANCE_FEE_RATE", "0"))
+REBALANCE_SLIPPAGE = float(os.getenv("REBALANCE_SLIPPAGE", "0"))
+
+
+def rebalance_vectors(balances, prices, targets, min_trade_usd: float = REBALANCE_MIN_TRADE_USD,
+                      fee_rate: float = REBALANCE_FEE_RATE, slippage: float = REBALANCE_SLIPPAGE) -> Dict[str, np.ndarray]:
+    """Computes allocations and trades for one or many portfolios in a single pass.
+
+    balances, prices and targets are (..., N) arrays that broadcast against each other, so a
+    batch of P portfolios or K candidate target allocations is a (P, N) or (K, N) input.
+    Targets are percentages; NaN marks a token without a target, which is never traded.
+
+    Trades smaller than min_trade_usd are dropped. Every trade is charged fee_rate + slippage
+    (cost_usd); sells are sized before that cost, buys receive tokens net of it.
+
+    Returns arrays: total_value (...), current_allocation, diff (current minus target, in
+    percentage points), trade_usd, token_amount (always >= 0), cost_usd (...,N) and
+    is_sell / is_trade masks.
+    """
+    balances, prices, targets = np.broadcast_arrays(
+        np.asarray(balances, dtype=float), np.asarray(prices, dtype=float), np.asarray(targets, dtype=float)
+    )
+
+    values = balances * prices
+    total_value = values.sum(axis=-1)
+    safe_total = np.where(total_value == 0, 1.0, total_value)[..., np.newaxis]
+    current_allocation = np.where(total_value[..., np.newaxis] == 0, 0.0, values / safe_total * 100)
+
+    has_target = ~np.isnan(targets)
+    diff = np.where(has_target, current_allocation - np.nan_to_num(targets), 0.0)
+    trade_usd = np.abs(diff) * total_value[..., np.newaxis] / 100
+
+    is_trade = has_target & (np.abs(diff) > MIN_ALLOCATION_DIFF) & (trade_usd >= min_trade_usd) & (prices > 0)
+    is_sell = is_trade & (diff > 0)
+    trade_usd = np.where(is_trade, trade_usd, 0.0)
+
+    cost_rate = fee_rate + slippage
+    safe_prices = np.where(prices > 0, prices, 1.0)
+    token_amount = np.where(is_sell, trade_usd, trade_usd * (1 - cost_rate)) / safe_prices
+
+    return {
+        "total_value": total_value,
+        "current_allocation": current_allocation,
+        "diff": diff,
+        "trade_usd": trade_usd,
+        "token_amount": np.where(is_trade, token_amount, 0.0),
+        "cost_usd": trade_usd * cost_rate,
+        "is_sell": is_sell,
+        "is_trade": is_trade
+    }
+
+
+def exact_trade_amounts(holdings: List[Holding], prices: List[float], targets: List[float], is_trade, is_sell,
+                        cost_rate: float) -> List[int]:
+    """Sizes one portfolio's trades in raw token units with integer arithmetic.
+
+    Prices, targets and cost_rate become FIXED_DECIMALS fixed-point integers, so the only rounding
+    is the final floor to whole raw units. A sell down to a zero target sells the exact balance,
+    and no sell exceeds the balance.
+    """
+    price_fixed = [to_fixed(price) if price > 0 else 0 for price in prices]
+    values = [holding.value(price) for holding, price in zip(holdings, price_fixed)]
+    total_value = sum(values)
+    cost_fixed = to_fixed(cost_rate)
+
+    amounts = []
+    for i, holding in enumerate(holdings):
+        if not is_trade[i]:
+            amounts.append(0)
+            continue
+        target_value = total_value * to_fixed(targets[i]) // (100 * FIXED_ONE)
+        if is_sell[i]:
+            raw_amount = holding.raw_balance if target_value == 0 else min(
+                holding.raw_balance, holding.raw_for_value(values[i] - target_value, price_fixed[i])
+            )
+        else:
+            net_value = (target_value - values[i]) * (FIXED_ONE - cost_fixed) // FIXED_ONE
+            raw_amount = holding.raw_for_value(max(net_value, 0), price_fixed[i])
+        amounts.append(raw_amount)
+    return amounts
+
+
+def _portfolio_result(holdings: List[Holding], target_allocation: Dict[str, float], token_prices: Dict[str, float],
+                      result: Dict[str, Any], cost_rate: float) -> Dict[str, Any]:
+    """Builds the calculate_rebalance response from one portfolio's rebalance_vectors() output.
+
+    Trades that round to zero raw units are dropped.
+    """
+    symbols = [holding.symbol for holding in holdings]
+    raw_amounts = exact_trade_amounts(
+        holdings, [token_prices[symbol] for symbol in symbols], list(_target_vector(symbols, target_allocation)),
+        result["is_trade"], result["is_sell"], cost_rate
+    )
+    actions = [
+        {
+            'token': holding.symbol,
+            'action': "sell" if result["is_sell"][i] else "buy",
+            'amount': from_raw(raw_amounts[i], holding.decimals),
+            'raw_amount': str(raw_amounts[i]),
+            'decimals': holding.decimals,
+            'percentage_change': float(abs(result["diff"][i])),
+            'amount_usd': float(result["trade_usd"][i]),
+            'cost_usd': float(result["cost_usd"][i])
+        }
+        for i, holding in enumerate(holdings) if result["is_trade"][i] and raw_amounts[i] > 0
+    ]
+
+    return {
+        'total_value': float(result["total_value"]),
+        'current_allocation': {symbol: float(result["current_allocation"][i]) for i, symbol in enumerate(symbols)},
+        'target_allocation': target_allocation,
+        'rebalance_actions': actions,
+        'token_prices': {symbol: token_prices[symbol] for symbol in symbols}
+    }
+
+
+def _target_vector(symbols: List[str], target_allocation: Dict[str, float]) -> List[float]:
+    return [float(target_allocation[symbol]) if symbol in target_allocation else np.nan for symbol in symbols]
+
+
+def compute_rebalance(tokens: Dict[str, Dict[str, Any]], target_allocation: Dict[str, float],
+                      token_prices: Dict[str, float], **options) -> Dict[str, Any]:
+    """Computes the calculate_rebalance response for one portfolio.
+
+    tokens maps symbol -> {'raw_balance': ..., 'decimals': ...} as returned by detect_tokens, or
+    {'balance': ...} in whole units; token_prices must cover every symbol. options are passed to
+    rebalance_vectors(). Raises ValueError if the portfolio has no value.
+    """
+    return compute_rebalance_batch([(tokens, target_allocation)], token_prices, **options)[0]
+
+
+def compute_rebalance_batch(portfolios: List[tuple], token_prices: Dict[str, float],
+                            **options) -> List[Optional[Dict[str, Any]]]:
+    """Computes calculate_rebalance responses for many (tokens, target_allocation) pairs at once.
+
+    All portfolios share one symbol axis, with zero balances for tokens a portfolio does not hold,
+    so a what-if sweep over candidate targets or a batch of wallets is one vectorized pass.
+    A single portfolio with no value raises ValueError; in a larger batch its entry is None.
+    """
+    symbols = list(dict.fromkeys(symbol for tokens, _ in portfolios for symbol in tokens))
+    column = {symbol: i for i, symbol in enumerate(symbols)}
+    holdings = [[Holding.from_token(symbol, token) for symbol, token in tokens.items()] for tokens, _ in portfolios]
+
+    balances = np.zeros((len(portfolios), len(symbols)))
+    targets = np.full((len(portfolios), len(symbols)), np.nan)
+    for row, (_, target_allocation) in enumerate(portfolios):
+        for holding in holdings[row]:
+            balances[row, column[holding.symbol]] = holding.balance
+        targets[row] = _target_vector(symbols, target_allocation)
+    prices = np.array([float(token_prices[symbol]) for symbol in symbols])
+
+    result = rebalance_vectors(balances, prices, targets, **options)
+    cost_rate = options.get('fee_rate', REBALANCE_FEE_RATE) + options.get('slippage', REBALANCE_SLIPPAGE)
+
+    responses = []
+    for row, (tokens, target_allocation) in enumerate(portfolios):
+        if result["total_value"][row] == 0:
+            if len(portfolios) == 1:
+                raise ValueError('Total portfolio value is zero')
+            responses.append(None)
+            continue
+
+        # Only report the tokens this portfolio holds, in its own order
+        held = [column[symbol] for symbol in tokens]
+        row_result = {name: values[row] if values.ndim == 1 else values[row, held] for name, values in result.items()}
+        responses.append(_portfolio_result(holdings[row], target_allocation, token_prices, row_result, cost_rate))
+    return responses
+
+
+# Gas used by one router swap and the Uniswap v2 pool fee charged on every hop
+SWAP_GAS_ESTIMATE = int(os.getenv("SWAP_GAS_ESTIMATE", "150000"))
+POOL_FEE_RATE = float(os.getenv("POOL_FEE_RATE", "0.003"))
+
+# Sell/buy remainders below this many USD are rounding noise, not a swap
+_DUST_USD = 1e-9
+
+
+def _swap_method(from_symbol: str, to_symbol: str, eth_symbol: str) -> str:
+    if from_symbol == eth_symbol:
+        return "swapExactETHForTokens"
+    if to_symbol == eth_symbol:
+        return "swapExactTokensForETH"
+    return "swapExactTokensForTokens"
+
+
+def plan_swaps(rebalance_actions: List[Dict[str, Any]], token_prices: Dict[str, float], eth_symbol: str = "ETH",
+               gas_price_wei: Optional[int] = None) -> Dict[str, Any]:
+    """Nets sells against buys into the fewest router swaps.
+
+    The naive plan sells every overweight token for ETH and buys every underweight token
+    with ETH (one swap per non-ETH action), so a sell-X/buy-Y pair costs two transactions and two pool fees. Here the
+    largest remaining sell is matched with the largest remaining buy as one direct X -> Y swap,
+    which needs at most (sells + buys - 1) swaps. Unmatched sells go to ETH and unmatched
+    buys are paid with ETH.
+
+    amount_in of each swap is derived from the sells' exact raw amounts (raw_amount_in, a
+    decimal string); buys paid with ETH are converted at the ETH price. Without a positive ETH
+    price those buys are listed in 'skipped' instead of becoming swaps.
+
+    Savings assume SWAP_GAS_ESTIMATE gas per swap and one POOL_FEE_RATE hop per swap
+    (a direct pool); they are priced in ETH and USD when gas_price_wei is given.
+    """
+    # Sell legs carry their remaining raw amount and decimals, so every swap's amount_in is exact
+    sells = [[action['token'], action['amount_usd'], int(action['raw_amount']), action['decimals']]
+             for action in rebalance_actions if action['action'] == "sell"]
+    buys = [[action['token'], action['amount_usd']] for action in rebalance_actions if action['action'] == "buy"]
+    sells.sort(key=lambda leg: leg[1], reverse=True)
+    buys.sort(key=lambda leg: leg[1], reverse=True)
+
+    swaps = []
+
+    def add_swap(from_symbol: str, to_symbol: str, amount_usd: float, raw_amount_in: int, decimals: int):
+        if from_symbol == to_symbol or amount_usd <= _DUST_USD or raw_amount_in <= 0:
+            return
+        swaps.append({
+            'from': from_symbol,
+            'to': to_symbol,
+            'method': _swap_method(from_symbol, to_symbol, eth_symbol),
+            'amount_in': from_raw(raw_amount_in, decimals),
+            'raw_amount_in': str(raw_amount_in),
+            'amount_usd': amount_usd
+        })
+
+    def take_sell(leg: list, amount_usd: float) -> int:
+        # The last swap of a sell takes whatever raw amount is left, so the swaps add up exactly
+        if leg[1] - amount_usd <= _DUST_USD:
+            raw_amount = leg[2]
+        else:
+            raw_amount = leg[2] * to_fixed(amount_usd) // to_fixed(leg[1])
+        leg[2] -= raw_amount
+        return raw_amount
+
+    # Buys left unmatched are paid with ETH, which needs a positive ETH price to size
+    eth_price_fixed = to_fixed(token_prices.get(eth_symbol) or 0)
+    skipped = []
+
+    while sells and buys:
+        amount_usd = min(sells[0][1], buys[0][1])
+        add_swap(sells[0][0], buys[0][0], amount_usd, take_sell(sells[0], amount_usd), sells[0][3])
+        sells[0][1] -= amount_usd
+        buys[0][1] -= amount_usd
+        if sells[0][1] <= _DUST_USD:
+            sells.pop(0)
+        if buys and buys[0][1] <= _DUST_USD:
+            buys.pop(0)
+
+    for symbol, amount_usd, raw_amount, decimals in sells:
+        add_swap(symbol, eth_symbol, amount_usd, raw_amount, decimals)
+    for symbol, amount_usd in buys:
+        if eth_price_fixed <= 0:
+            skipped.append({'to': symbol, 'amount_usd': amount_usd, 'reason': f"no {eth_symbol} price"})
+            continue
+        add_swap(eth_symbol, symbol, amount_usd,
+                 to_fixed(amount_usd) * 10 ** DEFAULT_DECIMALS // eth_price_fixed, DEFAULT_DECIMALS)
+
+    # In the naive plan ETH actions only fund or receive the other legs
+    naive_legs = [action for action in rebalance_actions if action['token'] != eth_symbol]
+    naive_swap_count = len(naive_legs)
+    naive_pool_fees = sum(action['amount_usd'] for action in naive_legs) * POOL_FEE_RATE
+    pool_fees = sum(swap['amount_usd'] for swap in swaps) * POOL_FEE_RATE
+
+    savings = {
+        'swaps': naive_swap_count - len(swaps),
+        'gas': (naive_swap_count - len(swaps)) * SWAP_GAS_ESTIMATE,
+        'pool_fees_usd': naive_pool_fees - pool_fees
+    }
+    if gas_price_wei is not None:
+        savings['gas_eth'] = savings['gas'] * gas_price_wei / 10 ** 18
+        if eth_symbol in token_prices:
+            savings['gas_usd'] = savings['gas_eth'] * token_prices[eth_symbol]
+
+    return {
+        'swaps': swaps,
+        'naive_swap_count': naive_swap_count,
+        'swap_count': len(swaps),
+        'skipped': skipped,
+        'estimated_savings': savings
+    }
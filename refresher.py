@@ -0,0 +1,184 @@
+import os
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Prices of symbols held by active wallets are refetched every PRICE_REFRESH_INTERVAL seconds,
+# so page loads find them fresh in the price cache
+PRICE_REFRESH_INTERVAL = float(os.getenv("PRICE_REFRESH_INTERVAL", "30"))
+# Seconds between polls for new blocks, which refresh the balances of subscribed wallets
+BLOCK_POLL_INTERVAL = float(os.getenv("BLOCK_POLL_INTERVAL", "4"))
+# A wallet stays active this many seconds after its last detect_tokens call
+ACTIVE_WALLET_TTL = float(os.getenv("ACTIVE_WALLET_TTL", "600"))
+# Seconds between keep-alive comments on an idle update stream
+SSE_KEEPALIVE_INTERVAL = float(os.getenv("SSE_KEEPALIVE_INTERVAL", "15"))
+
+Publisher = Callable[[str, Dict[str, Any]], None]
+
+
+class BackgroundRefresher:
+    """Background thread that keeps prices and balances of active wallets warm and pushes updates.
+
+    A wallet is active for active_ttl seconds after touch(wallet, price_keys) and while it has
+    subscribers. price_keys maps the key each held symbol is priced under (which may tell apart
+    tokens sharing a symbol) to the symbol. Every price_interval seconds refresh_prices(price_keys)
+    is called with the union of keys held by active wallets and returns key -> price. Every block_interval seconds new_block() is polled; when it
+    returns a block number, refresh_wallet(wallet, block_number) is called for each subscribed wallet.
+
+    Subscribers are publish(event, data) callbacks. They receive "prices" events with the prices of
+    their wallet's symbols, and "balances" events whenever refresh_wallet() returns something new.
+    """
+
+    def __init__(self, refresh_prices: Callable[[Dict[str, str]], Dict[str, float]],
+                 new_block: Callable[[], Optional[int]],
+                 refresh_wallet: Callable[[str, int], Dict[str, Any]],
+                 price_interval: float = PRICE_REFRESH_INTERVAL, block_interval: float = BLOCK_POLL_INTERVAL,
+                 active_ttl: float = ACTIVE_WALLET_TTL):
+        self.refresh_prices = refresh_prices
+        self.new_block = new_block
+        self.refresh_wallet = refresh_wallet
+        self.price_interval = price_interval
+        self.block_interval = block_interval
+        self.active_ttl = active_ttl
+        self._wallets = {}  # wallet -> (price key -> symbol, last touched)
+        self._subscribers = {}  # wallet -> list of publish callbacks
+        self._last_balances = {}  # wallet -> last refresh_wallet() result pushed
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"price_refreshes": 0, "blocks": 0, "wallet_refreshes": 0, "events": 0, "errors": 0}
+
+    def touch(self, wallet_address: str, price_keys: Dict[str, str]):
+        """Marks the wallet active and records the symbols it holds, by price key"""
+        with self._lock:
+            self._wallets[wallet_address] = (dict(price_keys), time.time())
+        self.start()
+
+    def subscribe(self, wallet_address: str, publish: Publisher):
+        """Registers publish(event, data) to receive the wallet's updates"""
+        with self._lock:
+            self._subscribers.setdefault(wallet_address, []).append(publish)
+        self.start()
+
+    def unsubscribe(self, wallet_address: str, publish: Publisher):
+        with self._lock:
+            subscribers = self._subscribers.get(wallet_address, [])
+            if publish in subscribers:
+                subscribers.remove(publish)
+            if not subscribers:
+                self._subscribers.pop(wallet_address, None)
+                self._last_balances.pop(wallet_address, None)
+
+    def start(self):
+        """Starts the background thread unless it is already running"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="background-refresher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _active_wallets(self) -> Dict[str, Dict[str, str]]:
+        """Returns wallet -> price keys of every active wallet, forgetting idle ones"""
+        now = time.time()
+        with self._lock:
+            for wallet_address, (_, touched_at) in list(self._wallets.items()):
+                if now - touched_at > self.active_ttl and wallet_address not in self._subscribers:
+                    del self._wallets[wallet_address]
+            return {wallet_address: price_keys for wallet_address, (price_keys, _) in self._wallets.items()}
+
+    def _publish(self, wallet_address: str, event: str, data: Dict[str, Any]):
+        with self._lock:
+            subscribers = list(self._subscribers.get(wallet_address, []))
+        for publish in subscribers:
+            try:
+                publish(event, data)
+                self._count("events")
+            except Exception as e:
+                logger.error("Error pushing %s to a subscriber of %s: %s", event, wallet_address, e)
+                self.unsubscribe(wallet_address, publish)
+
+    def _refresh_prices(self):
+        wallets = self._active_wallets()
+        price_keys = {price_key: symbol for held in wallets.values() for price_key, symbol in held.items()}
+        if not price_keys:
+            return
+
+        try:
+            prices = self.refresh_prices(price_keys)
+        except Exception as e:
+            self._count("errors")
+            logger.error("Error refreshing prices for active wallets: %s", e)
+            return
+        self._count("price_refreshes")
+
+        with self._lock:
+            subscribed = [wallet_address for wallet_address in self._subscribers if wallet_address in wallets]
+        for wallet_address in subscribed:
+            self._publish(wallet_address, "prices", {
+                symbol: prices[price_key] for price_key, symbol in wallets[wallet_address].items() if price_key in prices
+            })
+
+    def _poll_blocks(self):
+        with self._lock:
+            subscribed = list(self._subscribers)
+        if not subscribed:
+            return
+
+        try:
+            block_number = self.new_block()
+        except Exception as e:
+            self._count("errors")
+            logger.error("Error polling for new blocks: %s", e)
+            return
+        if block_number is None:
+            return
+        self._count("blocks")
+
+        for wallet_address in subscribed:
+            try:
+                balances = self.refresh_wallet(wallet_address, block_number)
+            except Exception as e:
+                self._count("errors")
+                logger.error("Error refreshing balances of %s: %s", wallet_address, e)
+                continue
+            self._count("wallet_refreshes")
+
+            # Most blocks do not touch a given wallet; only push what changed
+            with self._lock:
+                if self._last_balances.get(wallet_address) == balances:
+                    continue
+                self._last_balances[wallet_address] = balances
+            self._publish(wallet_address, "balances", {"block_number": block_number, **balances})
+
+    def _run(self):
+        next_prices = next_blocks = time.monotonic()
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= next_prices:
+                self._refresh_prices()
+                next_prices = now + self.price_interval
+            if now >= next_blocks:
+                self._poll_blocks()
+                next_blocks = now + self.block_interval
+            self._stop.wait(max(0.0, min(next_prices, next_blocks) - time.monotonic()))
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Returns a snapshot of the refresh counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["active_wallets"] = len(self._wallets)
+            stats["subscribed_wallets"] = len(self._subscribers)
+        return stats
@@ -3,6 +3,7 @@ let wallet = null;
 let tokens = {};
 let prices = {};
 let customTokens = [];
+let updateStream = null;
 
 document.addEventListener("DOMContentLoaded", function () {
   // Check if MetaMask is installed
@@ -159,6 +160,10 @@ async function switchToSepolia() {
 function disconnectWallet() {
   wallet = null;
   tokens = {};
+  if (updateStream) {
+    updateStream.close();
+    updateStream = null;
+  }
   document.getElementById("wallet-status").innerHTML =
     '<div class="alert alert-secondary">Not connected to MetaMask</div>';
 
@@ -241,6 +246,9 @@ async function detectTokens() {
 
     // Display tokens with the prices we got
     displayTokens();
+
+    // Keep the view warm with prices and balances pushed by the backend
+    subscribeToUpdates();
   } catch (error) {
     console.error("Error detecting tokens:", error);
     document.getElementById(
@@ -249,6 +257,46 @@ async function detectTokens() {
   }
 }
 
+// Helper function to receive price and balance updates for the connected wallet
+function subscribeToUpdates() {
+  if (updateStream && updateStream.wallet === wallet) return;
+  if (updateStream) updateStream.close();
+
+  updateStream = new EventSource(
+    `/api/subscribe?wallet_address=${encodeURIComponent(wallet)}`
+  );
+  updateStream.wallet = wallet;
+
+  updateStream.addEventListener("prices", (event) => {
+    Object.assign(prices, JSON.parse(event.data));
+    redisplayTokens();
+  });
+
+  updateStream.addEventListener("balances", (event) => {
+    tokens = JSON.parse(event.data).tokens;
+    redisplayTokens();
+  });
+}
+
+// Helper function to re-render pushed updates without discarding the user's target allocation
+function redisplayTokens() {
+  const targets = {};
+  document.querySelectorAll(".allocation-input").forEach((input) => {
+    targets[input.getAttribute("data-token")] = input.value;
+  });
+
+  displayTokens();
+
+  Object.keys(targets).forEach((symbol) => {
+    const input = document.getElementById(`allocation-${symbol}`);
+    if (input) {
+      input.value = targets[symbol];
+      document.getElementById(`target-${symbol}`).textContent = `${targets[symbol]}%`;
+    }
+  });
+  updateAllocationTotal();
+}
+
 function displayTokens() {
   const tokensTable = document.getElementById("tokens-table");
   tokensTable.innerHTML = "";
@@ -425,7 +473,8 @@ async function parseNaturalLanguageQuery() {
     headers: {
       "Content-Type": "application/json",
     },
-    body: JSON.stringify({ query }),
+    // Detected symbols let the server parse simple allocations without the LLM
+    body: JSON.stringify({ query, symbols: Object.keys(tokens) }),
   })
     .then((response) => response.json())
     .then((data) => {
@@ -592,6 +641,28 @@ function displayRebalanceResults(data) {
     resultsContainer.appendChild(actionDiv);
   });
 
+  // Show how the actions will be executed
+  const plan = data.swap_plan;
+  if (plan && plan.swaps.length > 0) {
+    const planDiv = document.createElement("div");
+    planDiv.className = "mt-4";
+    const swapItems = plan.swaps
+      .map(
+        (swap) =>
+          `<li>Swap ${swap.amount_in.toFixed(6)} ${swap.from} for ${swap.to} <span class="text-muted">(~$${swap.amount_usd.toFixed(2)})</span></li>`
+      )
+      .join("");
+    const savings = plan.estimated_savings;
+    const gasSaved =
+      savings.gas_usd !== undefined ? ` (~$${savings.gas_usd.toFixed(2)})` : "";
+    planDiv.innerHTML = `
+            <h5>Swap Plan</h5>
+            <ul>${swapItems}</ul>
+            <p class="text-muted">${plan.swap_count} swaps instead of ${plan.naive_swap_count}: saves about ${savings.gas.toLocaleString()} gas${gasSaved} and $${savings.pool_fees_usd.toFixed(2)} in pool fees.</p>
+        `;
+    resultsContainer.appendChild(planDiv);
+  }
+
   // Add explanation
   const explanationDiv = document.createElement("div");
   explanationDiv.id = "rebalance-explanation";
@@ -747,9 +818,33 @@ const UNISWAP_ROUTER_ABI = [
     outputs: [{ name: "amounts", type: "uint256[]" }],
     stateMutability: "nonpayable",
   },
+  {
+    name: "swapExactTokensForTokens",
+    type: "function",
+    inputs: [
+      { name: "amountIn", type: "uint256" },
+      { name: "amountOutMin", type: "uint256" },
+      { name: "path", type: "address[]" },
+      { name: "to", type: "address" },
+      { name: "deadline", type: "uint256" },
+    ],
+    outputs: [{ name: "amounts", type: "uint256[]" }],
+    stateMutability: "nonpayable",
+  },
+  {
+    name: "getAmountsOut",
+    type: "function",
+    inputs: [
+      { name: "amountIn", type: "uint256" },
+      { name: "path", type: "address[]" },
+    ],
+    outputs: [{ name: "amounts", type: "uint256[]" }],
+    stateMutability: "view",
+  },
 ];
 
-async function sellTokenForETH(tokenAddress, amount) {
+// Swap amounts are raw token units (decimal strings), as returned by /api/calculate_rebalance
+async function sellTokenForETH(tokenAddress, rawAmount, quote = null) {
   const web3 = new Web3(window.ethereum);
   const accounts = await web3.eth.requestAccounts();
   const userAddress = accounts[0];
@@ -766,7 +861,7 @@ async function sellTokenForETH(tokenAddress, amount) {
     return;
   }
 
-  if (!amount || amount <= 0) {
+  if (!rawAmount || BigInt(rawAmount) <= 0n) {
     console.error("Invalid amount.");
     return;
   }
@@ -778,9 +873,6 @@ async function sellTokenForETH(tokenAddress, amount) {
     UNISWAP_ROUTER_ADDRESS
   );
 
-  // // Convert amount to raw units based on decimals (assumes 18, adjust if needed)
-  const rawAmount = web3.utils.toWei(amount.toString(), "ether");
-
   try {
     // Step 1: Approve Uniswap to spend the token
     const allowance = await tokenContract.methods
@@ -797,7 +889,8 @@ async function sellTokenForETH(tokenAddress, amount) {
     // Step 2: Swap tokens for ETH
     const deadline = Math.floor(Date.now() / 1000) + 60 * 10; // 10 minutes from now
     const path = [tokenAddress, WETH_ADDRESS];
-    const minETHOut = 0; // WARNING: Accepting any ETH, not safe for production
+    // Without a quote, accept any amount of ETH (not safe for production)
+    const minETHOut = quote ? quote.amount_out_min : 0;
 
     const tx = await uniswapRouter.methods
       .swapExactTokensForETH(rawAmount, minETHOut, path, userAddress, deadline)
@@ -809,7 +902,7 @@ async function sellTokenForETH(tokenAddress, amount) {
   }
 }
 
-async function buyTokenWithETH(tokenAddress, ethAmount) {
+async function buyTokenWithETH(tokenAddress, rawETH, quote = null) {
   const web3 = new Web3(window.ethereum);
   const accounts = await web3.eth.requestAccounts();
   const userAddress = accounts[0];
@@ -821,8 +914,8 @@ async function buyTokenWithETH(tokenAddress, ethAmount) {
 
   const path = [WETH_ADDRESS, tokenAddress]; // ETH -> Token
   const deadline = Math.floor(Date.now() / 1000) + 60 * 10; // 10 minutes from now
-  const minTokensOut = 0; // accept any amount for now (not for production)
-  const rawETH = web3.utils.toWei(ethAmount.toString(), "ether");
+  // Without a quote, accept any amount (not for production)
+  const minTokensOut = quote ? quote.amount_out_min : 0;
 
   try {
     const tx = await router.methods
@@ -838,30 +931,127 @@ async function buyTokenWithETH(tokenAddress, ethAmount) {
   }
 }
 
+async function swapTokenForToken(fromAddress, toAddress, rawAmount, quote = null) {
+  const web3 = new Web3(window.ethereum);
+  const accounts = await web3.eth.requestAccounts();
+  const userAddress = accounts[0];
+
+  const tokenContract = new web3.eth.Contract(ERC20_ABI, fromAddress);
+  const router = new web3.eth.Contract(
+    UNISWAP_ROUTER_ABI,
+    UNISWAP_ROUTER_ADDRESS
+  );
+
+  try {
+    // Step 1: Approve Uniswap to spend the token
+    const allowance = await tokenContract.methods
+      .allowance(userAddress, UNISWAP_ROUTER_ADDRESS)
+      .call();
+
+    if (web3.utils.toBN(allowance).lt(web3.utils.toBN(rawAmount))) {
+      console.log("Approving Uniswap router to spend tokens...");
+      await tokenContract.methods
+        .approve(UNISWAP_ROUTER_ADDRESS, rawAmount)
+        .send({ from: userAddress });
+    }
+
+    // Step 2: Use the quoted path; without a quote, use the direct pool if there is one,
+    // otherwise route through WETH in the same swap
+    let path = quote ? quote.path : [fromAddress, toAddress];
+    if (!quote) {
+      try {
+        await router.methods.getAmountsOut(rawAmount, path).call();
+      } catch (err) {
+        path = [fromAddress, WETH_ADDRESS, toAddress];
+      }
+    }
+
+    const deadline = Math.floor(Date.now() / 1000) + 60 * 10; // 10 minutes from now
+    // Without a quote, accept any amount (not for production)
+    const minTokensOut = quote ? quote.amount_out_min : 0;
+
+    const tx = await router.methods
+      .swapExactTokensForTokens(rawAmount, minTokensOut, path, userAddress, deadline)
+      .send({ from: userAddress });
+
+    console.log("Tokens swapped! Tx hash:", tx.transactionHash);
+  } catch (err) {
+    console.error("Swap failed:", err.message || err);
+  }
+}
+
 async function executeTransactions() {
   let tokens = await getTokens();
   let actions = await getActions(tokens);
 
-  actions = actions["rebalance_actions"];
+  // The swap plan nets sells against buys, so each pair is one direct swap.
+  // Amounts are exact raw units, so only empty or invalid swaps are skipped.
+  const swaps = actions["swap_plan"]["swaps"].filter((swap) => {
+    try {
+      return BigInt(swap.raw_amount_in) > 0n;
+    } catch (err) {
+      return false;
+    }
+  });
+
+  // Quote every swap in one request to set its minimum output
+  const quotes = await getQuotes(tokens, swaps);
 
-  for (const action of actions) {
-    const amount = parseFloat(action.amount);
-    if (isNaN(amount) || amount <= 0.0001) continue; // Skip tiny or invalid amounts
+  for (const [i, swap] of swaps.entries()) {
+    const rawAmount = swap.raw_amount_in;
+    const quote = quotes[i] && !quotes[i].error ? quotes[i] : null;
 
     try {
-      if (action.action === "buy") {
-        await buyTokenWithETH(tokens[action.token].address, amount);
-      } else if (action.action === "sell") {
-        await sellTokenForETH(tokens[action.token].address, amount);
+      if (swap.method === "swapExactETHForTokens") {
+        await buyTokenWithETH(tokens[swap.to].address, rawAmount, quote);
+      } else if (swap.method === "swapExactTokensForETH") {
+        await sellTokenForETH(tokens[swap.from].address, rawAmount, quote);
+      } else {
+        await swapTokenForToken(
+          tokens[swap.from].address,
+          tokens[swap.to].address,
+          rawAmount,
+          quote
+        );
       }
     } catch (err) {
-      console.error(`Failed to ${action.action} ${action.token}:`, err);
+      console.error(`Failed to swap ${swap.from} for ${swap.to}:`, err);
     }
   }
 
   detectTokens();
 }
 
+// Helper function to quote swaps with the router's getAmountsOut; returns [] if quoting fails
+async function getQuotes(currentTokens, swaps) {
+  try {
+    const response = await fetch("/api/quote", {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify({
+        legs: swaps.map((swap) => ({
+          token_in: currentTokens[swap.from].address || "ETH",
+          token_out: currentTokens[swap.to].address || "ETH",
+          amount_in: swap.raw_amount_in,
+        })),
+      }),
+    });
+
+    const data = await response.json();
+
+    if (data.error) {
+      throw new Error(data.error);
+    }
+
+    return data.quotes;
+  } catch (error) {
+    console.error("Error quoting swaps:", error);
+    return [];
+  }
+}
+
 async function getTokens() {
   if (!wallet) return {};
 
@@ -1019,27 +1209,55 @@ async function askPortfolioAgent() {
       body: JSON.stringify({
         user_message: userQuery,
         wallet_address: wallet,
+        stream: true,
       }),
     });
 
-    const data = await response.json();
+    const agentResponse = document.getElementById("agent-response");
+    const responseText = agentResponse.querySelector("pre");
 
-    if (data.error) {
-      throw new Error(data.error);
+    // Servers without streaming support answer with a single JSON body
+    const contentType = response.headers.get("Content-Type") || "";
+    if (!contentType.includes("text/event-stream")) {
+      const data = await response.json();
+
+      if (data.error) {
+        throw new Error(data.error);
+      }
+
+      responseText.textContent = data.response;
+      agentResponse.classList.remove("d-none");
+      showAgentData(data.data);
+      return;
     }
 
-    // Display the AI response
-    const agentResponse = document.getElementById("agent-response");
-    agentResponse.querySelector("pre").textContent = data.response;
+    // Render the answer as it streams in
+    responseText.textContent = "";
     agentResponse.classList.remove("d-none");
+    document.getElementById("agent-loading").classList.add("d-none");
 
-    // Process additional data if available
-    if (data.data) {
-      // Check if we have trending tokens to display
-      if (data.data.trending_tokens && data.data.trending_tokens.length > 0) {
-        displayTrendingTokens(data.data.trending_tokens);
+    const toolStatus = document.getElementById("agent-tool-status");
+    const runningTools = {};
+
+    await readServerSentEvents(response, (event, data) => {
+      if (event === "token") {
+        responseText.textContent += data.content;
+      } else if (event === "tool_start") {
+        runningTools[data.id] = data.tool;
+      } else if (event === "tool_end") {
+        delete runningTools[data.id];
+      } else if (event === "done") {
+        // The final event carries the complete answer and the portfolio data
+        responseText.textContent = data.response;
+        showAgentData(data.data);
+      } else if (event === "error") {
+        throw new Error(data.response);
       }
-    }
+
+      const running = Object.values(runningTools);
+      toolStatus.textContent = running.length ? `Running: ${running.join(", ")}...` : "";
+      toolStatus.classList.toggle("d-none", running.length === 0);
+    });
   } catch (error) {
     console.error("Error querying portfolio agent:", error);
     document.getElementById("agent-response").classList.remove("d-none");
@@ -1051,6 +1269,48 @@ async function askPortfolioAgent() {
   } finally {
     // Hide loading indicator
     document.getElementById("agent-loading").classList.add("d-none");
+    document.getElementById("agent-tool-status").classList.add("d-none");
+  }
+}
+
+// Helper function to read a text/event-stream response, calling onEvent(event, data) per event
+async function readServerSentEvents(response, onEvent) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+
+    // Events are separated by a blank line
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const rawEvent = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = "message";
+      let data = "";
+      for (const line of rawEvent.split("\n")) {
+        if (line.startsWith("event:")) {
+          event = line.slice(6).trim();
+        } else if (line.startsWith("data:")) {
+          data += line.slice(5).trim();
+        }
+      }
+      onEvent(event, data ? JSON.parse(data) : null);
+    }
+  }
+}
+
+// Helper function to display the extra data returned by the portfolio agent
+function showAgentData(agentData) {
+  // Check if we have trending tokens to display
+  if (agentData && agentData.trending_tokens && agentData.trending_tokens.length > 0) {
+    displayTrendingTokens(agentData.trending_tokens);
   }
 }
 
@@ -0,0 +1,141 @@
+import os
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Location of the on-disk metadata store and size of the in-process LRU
+TOKEN_CACHE_PATH = os.getenv("TOKEN_CACHE_PATH", "token_metadata.db")
+TOKEN_CACHE_LRU_SIZE = int(os.getenv("TOKEN_CACHE_LRU_SIZE", "10000"))
+
+
+class TokenMetadataCache:
+    """Stores immutable ERC-20 metadata (symbol, name, decimals) keyed by (chain id, checksum address).
+
+    Reads are served from an in-process LRU; misses fall through to a SQLite file so the
+    data survives restarts. Call warm() at startup to preload the LRU from disk.
+    """
+
+    def __init__(self, path: str = TOKEN_CACHE_PATH, max_size: int = TOKEN_CACHE_LRU_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_metadata ("
+                "chain_id INTEGER NOT NULL, "
+                "address TEXT NOT NULL, "
+                "symbol TEXT NOT NULL, "
+                "name TEXT NOT NULL, "
+                "decimals INTEGER NOT NULL, "
+                "PRIMARY KEY (chain_id, address))"
+            )
+
+    @contextmanager
+    def _connect(self):
+        """Opens a short-lived connection that commits on success and is always closed"""
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _remember(self, key: Tuple[int, str], metadata: Dict[str, Any]):
+        """Inserts into the LRU and evicts the oldest entries (caller holds the lock)"""
+        self._lru[key] = metadata
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
+
+    def warm(self) -> int:
+        """Loads up to max_size entries from disk into the LRU and returns how many were loaded"""
+        try:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    "SELECT chain_id, address, symbol, name, decimals FROM token_metadata LIMIT ?",
+                    (self.max_size,)
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.error("Error warming token metadata cache: %s", e)
+            return 0
+
+        with self._lock:
+            for chain_id, address, symbol, name, decimals in rows:
+                self._remember((chain_id, address), {"symbol": symbol, "name": name, "decimals": decimals})
+        return len(rows)
+
+    def get_many(self, chain_id: int, addresses: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Returns cached metadata for the given checksum addresses; unknown addresses are omitted"""
+        found = {}
+        missing = []
+        with self._lock:
+            for address in addresses:
+                metadata = self._lru.get((chain_id, address))
+                if metadata is None:
+                    missing.append(address)
+                else:
+                    self._lru.move_to_end((chain_id, address))
+                    found[address] = metadata
+
+        if not missing:
+            return found
+
+        try:
+            with self._connect() as conn:
+                rows = []
+                # Stay well under SQLite's bound-parameter limit
+                for start in range(0, len(missing), 500):
+                    chunk = missing[start:start + 500]
+                    placeholders = ",".join("?" for _ in chunk)
+                    rows.extend(conn.execute(
+                        f"SELECT address, symbol, name, decimals FROM token_metadata "
+                        f"WHERE chain_id = ? AND address IN ({placeholders})",
+                        [chain_id] + chunk
+                    ).fetchall())
+        except sqlite3.Error as e:
+            logger.error("Error reading token metadata cache: %s", e)
+            return found
+
+        with self._lock:
+            for address, symbol, name, decimals in rows:
+                metadata = {"symbol": symbol, "name": name, "decimals": decimals}
+                self._remember((chain_id, address), metadata)
+                found[address] = metadata
+        return found
+
+    def get(self, chain_id: int, address: str) -> Optional[Dict[str, Any]]:
+        """Returns cached metadata for a single checksum address, or None"""
+        return self.get_many(chain_id, [address]).get(address)
+
+    def put_many(self, chain_id: int, entries: Dict[str, Dict[str, Any]]):
+        """Stores metadata for checksum addresses in both the LRU and the SQLite file"""
+        if not entries:
+            return
+
+        with self._lock:
+            for address, metadata in entries.items():
+                self._remember((chain_id, address), {
+                    "symbol": metadata["symbol"],
+                    "name": metadata["name"],
+                    "decimals": metadata["decimals"]
+                })
+
+        try:
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO token_metadata (chain_id, address, symbol, name, decimals) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (chain_id, address, metadata["symbol"], metadata["name"], metadata["decimals"])
+                        for address, metadata in entries.items()
+                    ]
+                )
+        except sqlite3.Error as e:
+            logger.error("Error writing token metadata cache: %s", e)
@@ -0,0 +1,264 @@
+import os
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Send a Server-Timing header with per-service upstream time on every API response
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING", "0").lower() in ("1", "true", "yes")
+
+# Histogram buckets (seconds) for request and upstream call durations
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# JSON-RPC method name near the start of a request body
+_RPC_METHOD = re.compile(rb'"method"\s*:\s*"([A-Za-z0-9_]+)"')
+
+
+class Span:
+    """One timed unit of work: a request, an upstream call or a step inside one"""
+
+    __slots__ = ("name", "service", "attributes", "children", "started_at", "duration")
+
+    def __init__(self, name: str, service: Optional[str] = None, **attributes):
+        self.name = name
+        self.service = service
+        self.attributes = attributes
+        self.children: List["Span"] = []
+        self.started_at = time.perf_counter()
+        self.duration: Optional[float] = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def walk(self) -> Iterator["Span"]:
+        yield self
+        for child in list(self.children):
+            yield from child.walk()
+
+    def format_tree(self, depth: int = 0) -> str:
+        """Renders the span and its children, one indented line each"""
+        duration = f"{self.duration * 1000:.1f}ms" if self.duration is not None else "running"
+        label = f"{self.service}:{self.name}" if self.service else self.name
+        attributes = " ".join(f"{key}={value}" for key, value in self.attributes.items())
+        lines = [f"{'  ' * depth}{label} {duration} {attributes}".rstrip()]
+        lines += [child.format_tree(depth + 1) for child in list(self.children)]
+        return "\n".join(lines)
+
+
+class Metrics:
+    """Process-wide counters and histograms, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._help = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> tuple:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, help_text: str, labels: Dict[str, Any], value: float = 1):
+        key = self._key(name, labels)
+        with self._lock:
+            self._help[name] = ("counter", help_text)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, help_text: str, labels: Dict[str, Any], value: float):
+        key = self._key(name, labels)
+        with self._lock:
+            self._help[name] = ("histogram", help_text)
+            histogram = self._histograms.setdefault(key, [0] * (len(DURATION_BUCKETS) + 2))
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @staticmethod
+    def _labels(labels: tuple, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+            help_texts = dict(self._help)
+
+        lines = []
+        for name, (metric_type, help_text) in sorted(help_texts.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {value:g}")
+            else:
+                for (metric, labels), values in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(DURATION_BUCKETS, values):
+                        lines.append(f"{name}_bucket{self._labels(labels, (('le', f'{bound:g}'),))} {count}")
+                    lines.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf'),))} {values[-1]}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {values[-2]:g}")
+                    lines.append(f"{name}_count{self._labels(labels)} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+# Upstream host -> (service name, base path), registered by the modules that own each API
+_services: Dict[str, Tuple[str, str]] = {}
+
+
+def register_service(name: str, base_url: Optional[str]):
+    """Names the upstream service behind base_url for spans and metrics"""
+    if base_url:
+        split = urlsplit(base_url)
+        _services[split.netloc] = (name, split.path.rstrip("/"))
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def submit(executor, fn, *args, **kwargs):
+    """executor.submit() that runs fn inside the caller's trace"""
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
+
+
+@contextmanager
+def span(name: str, service: Optional[str] = None, **attributes) -> Iterator[Span]:
+    """Times a block as a child of the current span.
+
+    Spans with a service are upstream calls and are also counted in the upstream metrics,
+    with status "error" if the block raises or sets status to an error.
+    """
+    parent = _current_span.get()
+    current = Span(name, service, **attributes)
+    if parent is not None:
+        parent.children.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException:
+        current.attributes.setdefault("status", "error")
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.started_at
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            pass  # A streaming generator abandoned by its consumer is closed from another context
+        if service:
+            _record_upstream(current)
+
+
+def _record_upstream(current: Span):
+    labels = {"service": current.service, "operation": current.name}
+    metrics.inc("cointune_upstream_requests_total", "Upstream API calls",
+                {**labels, "status": current.attributes.get("status", "ok")})
+    metrics.observe("cointune_upstream_request_duration_seconds", "Upstream API call duration", labels,
+                    current.duration)
+    if current.attributes.get("bytes"):
+        metrics.inc("cointune_upstream_response_bytes_total", "Bytes received from upstream APIs",
+                    {"service": current.service}, current.attributes["bytes"])
+
+
+def upstream_call(method: str, url: str, params: Any = None, body: Any = None):
+    """Returns a span for an outbound HTTP call, named after its service and operation.
+
+    The operation is the JSON-RPC method, the Etherscan action, or the path below the service's base URL.
+    """
+    split = urlsplit(str(url))
+    service, base_path = _services.get(split.netloc, (split.netloc, ""))
+
+    operation = None
+    if isinstance(body, str):
+        body = body.encode()
+    if isinstance(body, bytes):
+        match = _RPC_METHOD.search(body[:200])
+        operation = match.group(1).decode() if match else None
+    if operation is None and isinstance(params, dict) and params.get("action"):
+        operation = params["action"]
+    if operation is None:
+        path = split.path[len(base_path):] if split.path.startswith(base_path) else split.path
+        operation = path.strip("/") or method.lower()
+
+    # The transport of a call already traced by its client, such as a web3 provider request
+    parent = _current_span.get()
+    if parent is not None and parent.service == service:
+        return span(operation)
+    return span(operation, service)
+
+
+def record_cache(cache: str, hits: int, misses: int):
+    """Counts cache lookups and notes them on the current span"""
+    if hits:
+        metrics.inc("cointune_cache_lookups_total", "Cache lookups", {"cache": cache, "result": "hit"}, hits)
+    if misses:
+        metrics.inc("cointune_cache_lookups_total", "Cache lookups", {"cache": cache, "result": "miss"}, misses)
+    current = _current_span.get()
+    if current is not None:
+        current.attributes[f"{cache}_hits"] = current.attributes.get(f"{cache}_hits", 0) + hits
+        current.attributes[f"{cache}_misses"] = current.attributes.get(f"{cache}_misses", 0) + misses
+
+
+def start_request(method: str, endpoint: str) -> tuple:
+    """Starts the root span of a request; pass the result to end_request() when the request is over"""
+    root = Span(endpoint, method=method)
+    return root, _current_span.set(root)
+
+
+def finish_request(root: Span, status: int) -> Span:
+    """Stops the request's clock when the response starts and records the request metrics.
+
+    Streamed bodies are sent after this, so their upstream calls appear in the trace but not in the duration.
+    """
+    if root.duration is None:
+        root.duration = time.perf_counter() - root.started_at
+        root.attributes["status"] = status
+        labels = {"method": root.attributes["method"], "endpoint": root.name}
+        metrics.inc("cointune_http_requests_total", "API requests served", {**labels, "status": status})
+        metrics.observe("cointune_http_request_duration_seconds", "API request duration", labels, root.duration)
+    return root
+
+
+def end_request(request_trace: tuple):
+    """Leaves the request's trace, finishing it as a 500 if no response was started, and logs it at DEBUG"""
+    root, token = request_trace
+    finish_request(root, 500)
+    _current_span.reset(token)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Trace of %s %s:\n%s", root.attributes["method"], root.name, root.format_tree())
+
+
+def server_timing(root: Span) -> str:
+    """Server-Timing header value: upstream time and call count per service, plus the total.
+
+    Calls that overlap are summed, so a service's time can exceed the request's.
+    """
+    services = {}
+    for current in root.walk():
+        if current.service and current.duration is not None:
+            duration, calls = services.get(current.service, (0.0, 0))
+            services[current.service] = (duration + current.duration, calls + 1)
+
+    entries = [
+        f'{re.sub(r"[^A-Za-z0-9_-]", "_", service)};dur={duration * 1000:.1f};desc="{calls} calls"'
+        for service, (duration, calls) in services.items()
+    ]
+    entries.append(f"total;dur={(root.duration or 0) * 1000:.1f}")
+    return ", ".join(entries)
@@ -0,0 +1,253 @@
+import os
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from tracing import record_cache
+
+# Number of wallets whose latest snapshot is kept in memory
+WALLET_SNAPSHOT_MAX_SIZE = int(os.getenv("WALLET_SNAPSHOT_MAX_SIZE", "1000"))
+# Seconds a scan may be carried to later blocks before the wallet is rescanned. Balances that move
+# without a Transfer event (rebasing or interest-bearing tokens) are at most this stale.
+WALLET_SNAPSHOT_MAX_AGE = float(os.getenv("WALLET_SNAPSHOT_MAX_AGE", "60"))
+
+
+class WalletSnapshotCache:
+    """Latest scan of each wallet (ETH balance plus ERC-20 reads), keyed by (address, block number).
+
+    A snapshot taken at block B is reused at a later block N when is_unchanged(wallet, snapshot, N)
+    reports that no block in between touched the wallet, and is then re-keyed to N, until the scan
+    is max_age seconds old; after that the wallet is rescanned. Token contracts
+    missing from a snapshot are read on their own and merged in instead of rescanning the wallet.
+    Concurrent requests for the same (wallet, block), sync or async, share a single scan.
+
+    scan_wallet(wallet, block_number, extra_addresses) returns a snapshot dict with at least
+    block_number, eth_balance, token_addresses and token_reads, all read at block_number.
+    Contracts whose reads failed go in failed_addresses instead of token_addresses (see
+    address_fields()); they count as missing and are read again when the snapshot is next revalidated
+    or when a caller asks for them.
+    read_tokens(wallet, addresses, block_number) returns token reads for just those contracts at
+    that block. aget() takes async versions of the same callables.
+    """
+
+    def __init__(self, scan_wallet: Callable[[str, int, List[str]], Dict[str, Any]],
+                 read_tokens: Callable[[str, List[str], int], Dict[str, Any]],
+                 is_unchanged: Callable[[str, Dict[str, Any], int], bool],
+                 max_size: int = WALLET_SNAPSHOT_MAX_SIZE, max_age: float = WALLET_SNAPSHOT_MAX_AGE):
+        self.scan_wallet = scan_wallet
+        self.read_tokens = read_tokens
+        self.is_unchanged = is_unchanged
+        self.max_size = max_size
+        self.max_age = max_age
+        self._snapshots = OrderedDict()  # wallet -> snapshot
+        self._in_flight = {}  # (wallet, block_number) -> Future resolving to a snapshot
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "revalidated": 0, "extended": 0, "expired": 0, "misses": 0, "coalesced": 0}
+
+    @staticmethod
+    def missing_addresses(snapshot: Dict[str, Any], token_addresses: Iterable[str]) -> List[str]:
+        """Returns the token contracts not covered by the snapshot"""
+        known = set(snapshot["token_addresses"])
+        return [address for address in dict.fromkeys(token_addresses) if address not in known]
+
+    @staticmethod
+    def address_fields(token_addresses: Iterable[str], token_reads: Dict[str, Any]) -> Dict[str, List[str]]:
+        """Splits the contracts of a scan into token_addresses (read) and failed_addresses (read failed)"""
+        token_addresses = list(dict.fromkeys(token_addresses))
+        return {
+            "token_addresses": [address for address in token_addresses if address in token_reads],
+            "failed_addresses": [address for address in token_addresses if address not in token_reads]
+        }
+
+    @staticmethod
+    def _retry_addresses(snapshot: Dict[str, Any], token_addresses: List[str]) -> List[str]:
+        """Contracts to read when refreshing a snapshot: the requested ones plus those whose reads failed"""
+        return token_addresses + snapshot.get("failed_addresses", [])
+
+    @staticmethod
+    def _merge_reads(snapshot: Dict[str, Any], token_addresses: List[str], token_reads: Dict[str, Any]) -> Dict[str, Any]:
+        """Returns a copy of the snapshot with extra token contracts and their reads merged in"""
+        token_reads = {**snapshot["token_reads"], **token_reads}
+        return {
+            **snapshot,
+            **WalletSnapshotCache.address_fields(
+                snapshot["token_addresses"] + snapshot.get("failed_addresses", []) + token_addresses, token_reads
+            ),
+            "token_reads": token_reads
+        }
+
+    def put(self, wallet_address: str, snapshot: Dict[str, Any]):
+        """Stores a snapshot unless a newer one is already cached"""
+        with self._lock:
+            current = self._snapshots.get(wallet_address)
+            if current is None or current["block_number"] <= snapshot["block_number"]:
+                self._snapshots[wallet_address] = snapshot
+            self._snapshots.move_to_end(wallet_address)
+            while len(self._snapshots) > self.max_size:
+                self._snapshots.popitem(last=False)
+
+    def invalidate(self, wallet_address: str):
+        """Drops the wallet's snapshot so the next request rescans it"""
+        with self._lock:
+            self._snapshots.pop(wallet_address, None)
+
+    def peek(self, wallet_address: str, block_number: int, token_addresses: Iterable[str] = ()) -> Optional[Dict[str, Any]]:
+        """Returns the cached snapshot if it is valid at block_number and covers token_addresses.
+
+        Unlike get() it never scans or revalidates; a None result counts as a miss, since the
+        caller is expected to scan the wallet itself and put() the result.
+        """
+        with self._lock:
+            cached = self._snapshots.get(wallet_address)
+            if (cached and cached["block_number"] >= block_number
+                    and not self.missing_addresses(cached, token_addresses)):
+                self._stats["hits"] += 1
+                self._snapshots.move_to_end(wallet_address)
+                record_cache("wallet_snapshot", 1, 0)
+                return cached
+            self._stats["misses"] += 1
+            record_cache("wallet_snapshot", 0, 1)
+            return None
+
+    def _lookup(self, wallet_address: str, block_number: int, token_addresses: List[str]) -> tuple:
+        """Returns (snapshot, cached, future, owner).
+
+        On a hit only snapshot is set. Otherwise future resolves to the refreshed snapshot and
+        owner says whether this caller must do the refresh (starting from cached) or just wait.
+        """
+        with self._lock:
+            cached = self._snapshots.get(wallet_address)
+            if (cached and cached["block_number"] >= block_number
+                    and not self.missing_addresses(cached, token_addresses)):
+                self._stats["hits"] += 1
+                self._snapshots.move_to_end(wallet_address)
+                record_cache("wallet_snapshot", 1, 0)
+                return cached, None, None, False
+
+            record_cache("wallet_snapshot", 0, 1)
+
+            key = (wallet_address, block_number)
+            if key in self._in_flight:
+                self._stats["coalesced"] += 1
+                return None, None, self._in_flight[key], False
+
+            future = self._in_flight[key] = Future()
+            return None, cached, future, True
+
+    @staticmethod
+    def _rescan_addresses(cached: Optional[Dict[str, Any]], token_addresses: List[str]) -> List[str]:
+        """Contracts a rescan must read besides the discovered ones, keeping those the old snapshot had"""
+        known = cached["token_addresses"] + cached.get("failed_addresses", []) if cached else []
+        return list(dict.fromkeys(token_addresses + known))
+
+    def _expired(self, cached: Dict[str, Any]) -> bool:
+        """True if the snapshot's scan is too old to be carried to a later block"""
+        if time.time() - cached.get("scanned_at", 0) < self.max_age:
+            return False
+        self._count("expired")
+        return True
+
+    def _revalidated(self, cached: Dict[str, Any], block_number: int) -> Dict[str, Any]:
+        """Re-keys an unchanged snapshot to the requested block"""
+        if cached["block_number"] >= block_number:
+            return cached
+        self._count("revalidated")
+        return {**cached, "block_number": block_number}
+
+    def _finish(self, wallet_address: str, block_number: int, future: Future,
+                snapshot: Optional[Dict[str, Any]] = None, error: Optional[BaseException] = None):
+        """Stores the refreshed snapshot and resolves the in-flight future"""
+        if error is None:
+            self.put(wallet_address, snapshot)
+        with self._lock:
+            if self._in_flight.get((wallet_address, block_number)) is future:
+                del self._in_flight[(wallet_address, block_number)]
+        if error is None:
+            future.set_result(snapshot)
+        else:
+            future.set_exception(error)
+
+    def get(self, wallet_address: str, block_number: int, token_addresses: Iterable[str] = ()) -> Dict[str, Any]:
+        """Returns a snapshot of the wallet valid at block_number that covers token_addresses"""
+        token_addresses = list(token_addresses)
+        snapshot, cached, future, owner = self._lookup(wallet_address, block_number, token_addresses)
+        if snapshot:
+            return snapshot
+
+        if not owner:
+            snapshot = future.result()
+            # The shared scan may not cover contracts only this caller asked for
+            if self.missing_addresses(snapshot, token_addresses):
+                return self.get(wallet_address, block_number, token_addresses)
+            return snapshot
+
+        try:
+            if cached and (cached["block_number"] >= block_number
+                           or (not self._expired(cached) and self.is_unchanged(wallet_address, cached, block_number))):
+                snapshot = self._revalidated(cached, block_number)
+                missing = self.missing_addresses(snapshot, self._retry_addresses(snapshot, token_addresses))
+                if missing:
+                    # Read at the snapshot's own block, which may be newer than the one requested
+                    self._count("extended")
+                    snapshot = self._merge_reads(snapshot, missing, self.read_tokens(wallet_address, missing, snapshot["block_number"]))
+            else:
+                self._count("misses")
+                snapshot = {
+                    **self.scan_wallet(wallet_address, block_number, self._rescan_addresses(cached, token_addresses)),
+                    "scanned_at": time.time()
+                }
+        except Exception as e:
+            self._finish(wallet_address, block_number, future, error=e)
+            raise
+
+        self._finish(wallet_address, block_number, future, snapshot)
+        return snapshot
+
+    async def aget(self, wallet_address: str, block_number: int, token_addresses: Iterable[str],
+                   scan_wallet, read_tokens, is_unchanged) -> Dict[str, Any]:
+        """Async version of get(), taking coroutine functions in place of the constructor's callables"""
+        token_addresses = list(token_addresses)
+        snapshot, cached, future, owner = self._lookup(wallet_address, block_number, token_addresses)
+        if snapshot:
+            return snapshot
+
+        if not owner:
+            snapshot = await asyncio.wrap_future(future)
+            if self.missing_addresses(snapshot, token_addresses):
+                return await self.aget(wallet_address, block_number, token_addresses,
+                                       scan_wallet, read_tokens, is_unchanged)
+            return snapshot
+
+        try:
+            if cached and (cached["block_number"] >= block_number
+                           or (not self._expired(cached) and await is_unchanged(wallet_address, cached, block_number))):
+                snapshot = self._revalidated(cached, block_number)
+                missing = self.missing_addresses(snapshot, self._retry_addresses(snapshot, token_addresses))
+                if missing:
+                    self._count("extended")
+                    snapshot = self._merge_reads(snapshot, missing, await read_tokens(wallet_address, missing, snapshot["block_number"]))
+            else:
+                self._count("misses")
+                snapshot = {
+                    **await scan_wallet(wallet_address, block_number, self._rescan_addresses(cached, token_addresses)),
+                    "scanned_at": time.time()
+                }
+        except Exception as e:
+            self._finish(wallet_address, block_number, future, error=e)
+            raise
+
+        self._finish(wallet_address, block_number, future, snapshot)
+        return snapshot
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Returns a snapshot of the hit/miss counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._snapshots)
+        return stats